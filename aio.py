@@ -0,0 +1,69 @@
+"""Run independent Sheets and Twilio calls concurrently.
+
+gspread and the Twilio client block, so independent calls run at the same
+time on one shared pool of threads: a handful of them take as long as the
+slowest one rather than the sum. The caller's metrics scope and quota
+priority travel with each call, so timings and rate limiting are the same
+as if the calls had run one after another.
+
+Code running on an event loop (asgi.py) awaits blocking calls with run(),
+on the same pool, so the loop stays free while they wait.
+"""
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import metrics
+import quota
+
+WORKERS = 8
+
+_lock = threading.Lock()
+_local = threading.local()
+_executor = {'pid': None, 'pool': None}
+
+def _mark_pool_thread():
+    _local.in_pool = True
+
+def _get_executor():
+    """Call pool, recreated after a fork since threads do not survive it"""
+    with _lock:
+        if _executor['pid'] != os.getpid():
+            _executor['pool'] = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='aio',
+                                                   initializer=_mark_pool_thread)
+            _executor['pid'] = os.getpid()
+        return _executor['pool']
+
+def _on_behalf_of_caller(fn, *args):
+    """fn bound to the calling thread's metrics scope and quota priority, to run on another thread"""
+    current = metrics.current_scope()
+    priority = quota.explicit_priority()
+
+    def _call():
+        with metrics.attached(current), quota.priority(priority):
+            return fn(*args)
+
+    return _call
+
+async def run(fn, *args):
+    """Await a blocking call on the pool, so the event loop is free while it waits"""
+    return await asyncio.get_running_loop().run_in_executor(_get_executor(), _on_behalf_of_caller(fn, *args))
+
+def gather(*fns):
+    """Run zero-argument blocking calls concurrently; returns their results in order
+
+    The first call runs on the calling thread and the rest on the pool. The
+    first error is raised once every call has finished, so none is left
+    running in the background.
+    """
+    # A call already on the pool runs nested calls itself, so the pool cannot wait on itself
+    if len(fns) < 2 or getattr(_local, 'in_pool', False):
+        return [fn() for fn in fns]
+
+    futures = [_get_executor().submit(_on_behalf_of_caller(fn)) for fn in fns[1:]]
+    try:
+        first = fns[0]()
+    finally:
+        wait(futures)
+    return [first] + [future.result() for future in futures]
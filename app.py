@@ -1,13 +1,38 @@
-from flask import Flask, render_template, request, jsonify
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-from twilio.rest import Client
+from flask import Flask, Response, render_template, request, jsonify, g, has_request_context
 import os
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from collections import OrderedDict
+import csv
+import gzip
+import hashlib
+import io
 import json
+import sqlite3
+import threading
 import time
 
+try:
+    import brotli
+except ImportError:  # Optional - responses fall back to gzip
+    brotli = None
+
+import aio
+import archive
+import cache
+import events
+import history
+import local_db
+import metrics
+import outbox
+import purchase_log
+import quota
+import renderer
+import search
+import storage
+import suggestions
+import sync
+
 load_dotenv()
 
 app = Flask(__name__)
@@ -22,403 +47,1089 @@ WHATSAPP_TO = os.getenv('WHATSAPP_TO')
 
 # Cache configuration
 CACHE_TTL = 300  # 5 minutes cache
-_cache = {}
-
-def cached_fetch(key, fetch_function, ttl=CACHE_TTL):
-    """Generic caching function with TTL"""
-    now = time.time()
-    
-    if key in _cache:
-        data, timestamp = _cache[key]
-        if now - timestamp < ttl:
-            return data
-    
-    # Cache miss or expired - fetch fresh data
-    data = fetch_function()
-    _cache[key] = (data, now)
-    return data
-
-def invalidate_cache(key=None):
-    """Invalidate cache - specific key or all"""
-    if key:
-        _cache.pop(key, None)
+HISTORY_CACHE_TTL = 60  # Shorter TTL for history
+HISTORY_CACHE_SIZE = 10  # Recent lists kept in the history cache
+DATA_DIR = os.getenv('DATA_DIR', 'data')
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'memory')  # memory, file or sqlite - file/sqlite are shared by all workers
+CACHE_PATH = os.getenv('CACHE_PATH') or os.path.join(
+    DATA_DIR, 'cache.sqlite3' if CACHE_BACKEND == 'sqlite' else 'cache')
+
+cache.configure(CACHE_BACKEND, CACHE_PATH)
+
+# Local state shared by all workers on this machine (ID sequence etc.)
+LOCAL_DB_PATH = os.getenv('LOCAL_DB_PATH') or os.path.join(DATA_DIR, 'shopping.sqlite3')
+
+history.configure(LOCAL_DB_PATH)
+purchase_log.configure(LOCAL_DB_PATH)
+events.configure(LOCAL_DB_PATH)
+
+# Lists older than this many days move from Shopping_History into local archive segments (0 = never)
+HISTORY_ARCHIVE_DAYS = int(os.getenv('HISTORY_ARCHIVE_DAYS', 90))
+HISTORY_ARCHIVE_DIR = os.getenv('HISTORY_ARCHIVE_DIR') or os.path.join(DATA_DIR, 'history_archive')
+
+archive.configure(LOCAL_DB_PATH, HISTORY_ARCHIVE_DIR)
+
+# Requests (and queued jobs) slower than this are logged with a breakdown of their API calls
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', 1000))
+
+metrics.configure(LOCAL_DB_PATH, slow_ms=SLOW_REQUEST_MS)
+cache.add_observer(metrics.record_cache_event)
+COUNT_COMPACT_DELAY = 10  # Seconds logged increments wait, so several sends fold into one write
+COUNT_COMPACT_QUEUE = 'purchase_counts'
+
+# Where items, categories and history live: sheets (the workbook) or sqlite (LOCAL_DB_PATH).
+# An empty sqlite store is seeded from the workbook on first use if credentials are present.
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sheets')
+# With sqlite storage the workbook is kept as a mirror by a background sync (0 turns it off)
+SHEETS_SYNC = os.getenv('SHEETS_SYNC', '1') == '1'
+SYNC_PUSH_INTERVAL = float(os.getenv('SYNC_PUSH_INTERVAL', 2))
+SYNC_POLL_INTERVAL = float(os.getenv('SYNC_POLL_INTERVAL', 30))
+
+# Sheets API budget shared by all workers (0 turns the limiter off) - Google allows ~60 requests/minute
+SHEETS_REQUESTS_PER_MINUTE = float(os.getenv('SHEETS_REQUESTS_PER_MINUTE', 60))
+SHEETS_BURST = int(os.getenv('SHEETS_BURST', 20))
+
+quota.configure(LOCAL_DB_PATH, per_minute=SHEETS_REQUESTS_PER_MINUTE, burst=SHEETS_BURST)
+
+# Client libraries - gspread, oauth2client and twilio take about half a second to import,
+# so they are loaded on first use and health checks never wait for them
+gspread = None
+ServiceAccountCredentials = None
+Client = None
+
+def load_sheets_libraries():
+    """Import gspread and oauth2client, once"""
+    global gspread, ServiceAccountCredentials
+    if gspread is None:
+        import gspread as module
+        gspread = module
+    if ServiceAccountCredentials is None:
+        from oauth2client.service_account import ServiceAccountCredentials as credentials_class
+        ServiceAccountCredentials = credentials_class
+
+def load_twilio_library():
+    """Import the Twilio client, once"""
+    global Client
+    if Client is None:
+        from twilio.rest import Client as client_class
+        Client = client_class
+
+# Google Sheets connection
+SHEETS_SCOPE = ['https://spreadsheets.google.com/feeds',
+                'https://www.googleapis.com/auth/drive']
+
+_sheets_lock = threading.RLock()
+_sheets = {'pid': None, 'client': None, 'workbook': None, 'workbook_id': None, 'worksheets': {}, 'headers': {}}
+
+def _count_sheets_event(name):
+    """Count a Sheets handshake for the current request"""
+    if has_request_context():
+        counters = g.setdefault('sheets_counters', {})
+        counters[name] = counters.get(name, 0) + 1
+
+def _sheets_handle(target, detail):
+    """Time every call on a gspread object and run it through the shared quota"""
+    return quota.Scheduled(metrics.Instrumented(target, 'sheets', detail), detail)
+
+def _connect_google_sheet():
+    """Authorize a new client and open the workbook (caller holds the lock)"""
+    load_sheets_libraries()
+    creds = ServiceAccountCredentials.from_json_keyfile_name(GOOGLE_SHEETS_CREDS_FILE, SHEETS_SCOPE)
+    with metrics.span('sheets', 'authorize'):
+        # Every call on the client, workbook and worksheets is timed and rate limited from here on
+        client = _sheets_handle(gspread.authorize(creds), 'client')
+    _count_sheets_event('authorize')
+    
+    # Opening by title is a Drive search - reuse the key once we know it
+    if _sheets['workbook_id']:
+        workbook = client.open_by_key(_sheets['workbook_id'])
     else:
-        _cache.clear()
+        workbook = client.open(SPREADSHEET_NAME)
+    workbook = _sheets_handle(workbook, 'workbook')
+    _count_sheets_event('open')
+    
+    _sheets.update(pid=os.getpid(), client=client, workbook=workbook,
+                   workbook_id=workbook.id, worksheets={}, headers={})
 
 def get_google_sheet():
-    """Connect to Google Sheets and return the workbook"""
+    """Return the shared workbook handle, connecting on first use"""
     try:
-        scope = ['https://spreadsheets.google.com/feeds',
-                 'https://www.googleapis.com/auth/drive']
-        creds = ServiceAccountCredentials.from_json_keyfile_name(GOOGLE_SHEETS_CREDS_FILE, scope)
-        client = gspread.authorize(creds)
-        workbook = client.open(SPREADSHEET_NAME)
-        return workbook
+        with _sheets_lock:
+            # Handles must not be shared across forked gunicorn workers
+            if _sheets['pid'] != os.getpid():
+                _sheets.update(client=None, workbook=None, worksheets={}, headers={})
+            
+            # gspread's authorized session refreshes the access token itself when it expires
+            if _sheets['workbook'] is None:
+                _connect_google_sheet()
+            
+            return _sheets['workbook']
     except Exception as e:
         print(f"Error connecting to Google Sheets: {e}")
+        reset_google_sheet(e)
         return None
 
-def generate_next_item_id():
-    """Generate next sequential item ID like ID1, ID2, ID3, etc."""
-    try:
-        workbook = get_google_sheet()
-        if not workbook:
-            return "ID1"
-        
-        sheet = workbook.worksheet('Items')
+def get_worksheet(title):
+    """Return a cached worksheet handle, or None if Sheets is unavailable"""
+    workbook = get_google_sheet()
+    if not workbook:
+        return None
+    
+    with _sheets_lock:
+        sheet = _sheets['worksheets'].get(title)
+    if sheet is not None:
+        return sheet
+    
+    # Opened without the lock, as the call can wait on the quota and cached handles must not
+    # wait with it. Raises WorksheetNotFound for missing sheets, nothing is cached then.
+    sheet = _sheets_handle(workbook.worksheet(title), title)
+    _count_sheets_event('worksheet')
+    with _sheets_lock:
+        # Keep the first handle if another thread opened it too; skip caching after a reset
+        if _sheets['workbook'] is workbook:
+            sheet = _sheets['worksheets'].setdefault(title, sheet)
+    return sheet
+
+def get_sheet_headers(title):
+    """Return the header row of a worksheet, read once per connection"""
+    sheet = get_worksheet(title)
+    if not sheet:
+        return None
+    
+    with _sheets_lock:
+        headers = _sheets['headers'].get(title)
+    if headers is None:
         headers = sheet.row_values(1)
+        with _sheets_lock:
+            _sheets['headers'][title] = headers
+    return headers
+
+def _is_connection_error(error):
+    """True if the error means the cached client or handles are stale"""
+    if gspread is None:
+        # Nothing has talked to Sheets yet, so the error did not come from it
+        return False
+    if isinstance(error, gspread.exceptions.SpreadsheetNotFound):
+        return True
+    if isinstance(error, gspread.exceptions.APIError):
+        status = getattr(error.response, 'status_code', None)
+        # 400 "Unable to parse range" means a cached worksheet was deleted or renamed
+        return status in (401, 403, 404) or (status == 400 and 'parse range' in str(error))
+    return False
+
+def reset_google_sheet(error=None):
+    """Drop cached handles, or only after an auth or not-found error if one is given"""
+    if error is not None and not _is_connection_error(error):
+        return
+    
+    with _sheets_lock:
+        if error is not None and isinstance(error, gspread.exceptions.SpreadsheetNotFound):
+            _sheets['workbook_id'] = None
+        _sheets.update(pid=None, client=None, workbook=None, worksheets={}, headers={})
+
+def get_sheets_counters():
+    """Handshake counters for the current request"""
+    if has_request_context():
+        return dict(g.get('sheets_counters', {}))
+    return {}
+
+# Storage backend
+sheets_storage = storage.SheetsStorage(get_google_sheet, get_worksheet, get_sheet_headers)
+
+_storage_lock = threading.Lock()
+_storage = {'backend': None}
+
+def _on_remote_change():
+    """A sync pull changed local data - reload it (stale copies are served meanwhile)"""
+    for key in ('items', 'categories', 'history'):
+        cache.invalidate(key)
+
+def get_storage():
+    """Return the configured storage backend, seeding a new local store on first use"""
+    with _storage_lock:
+        if _storage['backend'] is None:
+            if STORAGE_BACKEND == 'sqlite':
+                mirrored = SHEETS_SYNC and os.path.exists(GOOGLE_SHEETS_CREDS_FILE)
+                backend = storage.SqliteStorage(LOCAL_DB_PATH, track_changes=mirrored)
+                if backend.is_empty() and os.path.exists(GOOGLE_SHEETS_CREDS_FILE):
+                    try:
+                        backend.import_from(sheets_storage)
+                    except Exception as e:
+                        # Start empty rather than not at all; the sync pull fills it in later
+                        print(f"Error seeding local storage from Google Sheets: {e}")
+                        reset_google_sheet(e)
+                if mirrored:
+                    sync.configure(backend, sheets_storage, on_error=reset_google_sheet,
+                                   on_change=_on_remote_change, push_interval=SYNC_PUSH_INTERVAL,
+                                   poll_interval=SYNC_POLL_INTERVAL)
+                _storage['backend'] = backend
+            else:
+                _storage['backend'] = sheets_storage
         
-        if 'Item_ID' not in headers:
-            return "ID1"
-        
-        id_col = headers.index('Item_ID') + 1
-        all_ids = sheet.col_values(id_col)[1:]  # Skip header
-        
-        # Filter out empty values
-        all_ids = [id for id in all_ids if id and id.startswith('ID')]
-        
-        if not all_ids:
-            return "ID1"
+        # Once per worker process, including after a fork - not in a master about to fork
+        if not _startup['preloading']:
+            sync.start()
+        return _storage['backend']
+
+# Item ID allocation
+ID_SEQUENCE_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS sequences (name TEXT PRIMARY KEY, value INTEGER NOT NULL)',
+]
+
+_ids_lock = threading.Lock()
+_ids = {'seed_version': None, 'seed': 0, 'last': 0}
+
+def _item_id_number(item_id):
+    """Numeric part of an ID like ID42, 0 for anything else"""
+    item_id = str(item_id or '')
+    if not item_id.startswith('ID'):
+        return 0
+    try:
+        return int(item_id[2:])
+    except ValueError:
+        return 0
+
+def _highest_cached_item_id():
+    """Highest ID in the cached items, rescanned only when the cached items change"""
+    version = cache.get_version("items")
+    if version is None:
+        get_all_items()
+        version = cache.get_version("items")
+    
+    if version is None or version != _ids['seed_version']:
+        items = cache.peek("items") or []
+        _ids['seed'] = max((_item_id_number(item.get('Item_ID')) for item in items), default=0)
+        if version is not None:
+            _ids['seed_version'] = version
+    return _ids['seed']
+
+def allocate_item_ids(count=1):
+    """Reserve a block of sequential item IDs, unique across all workers"""
+    floor = _highest_cached_item_id()
+    
+    with _ids_lock:
+        try:
+            # The local sequence serializes allocation between gunicorn workers
+            conn = local_db.connect(LOCAL_DB_PATH, ID_SEQUENCE_SCHEMA)
+            with local_db.transaction(conn):
+                row = conn.execute("SELECT value FROM sequences WHERE name = 'item_id'").fetchone()
+                start = max(row[0] if row else 0, floor, _ids['last']) + 1
+                conn.execute("INSERT OR REPLACE INTO sequences (name, value) VALUES ('item_id', ?)",
+                             (start + count - 1,))
+        except sqlite3.Error as e:
+            print(f"Error using local ID sequence, falling back to memory: {e}")
+            start = max(floor, _ids['last']) + 1
         
-        # Extract numbers and find max
-        numbers = []
-        for id_str in all_ids:
+        _ids['last'] = start + count - 1
+    
+    return [f"ID{num}" for num in range(start, start + count)]
+
+def generate_next_item_id():
+    """Generate next sequential item ID like ID1, ID2, ID3, etc."""
+    return allocate_item_ids(1)[0]
+
+def read_with_pending_counts(read):
+    """Result of read() plus the logged count increments not folded into the store yet"""
+    for attempt in range(5):
+        before = purchase_log.state()
+        result = read()
+        pending = purchase_log.pending_totals()
+        # A compaction writing mid-read could count its deltas twice, or not at all. One whose
+        # job is no longer running (its worker died or it gave up) will not write until resumed.
+        if purchase_log.state() == before and not (before[1] and outbox.is_running(COUNT_COMPACT_QUEUE)):
+            break
+        time.sleep(0.2)
+    return result, pending
+
+def load_items_with_pending_counts():
+    """Stored items plus the logged count increments not folded into them yet"""
+    return read_with_pending_counts(get_storage().load_items)
+
+def prepare_categories(categories):
+    """Categories with Aisle_Order as an int"""
+    for category in categories:
+        category['Aisle_Order'] = search.to_int(category.get('Aisle_Order', 999), 999)
+    return categories
+
+def prepare_items(items, categories, pending_counts):
+    """Normalize stored items and add pending counts and aisle order"""
+    category_map = {cat['Category']: cat for cat in categories}
+    
+    for item in items:
+        # Set defaults
+        if not item.get('Purchase_Count'):
+            item['Purchase_Count'] = 0
+        else:
             try:
-                num = int(id_str.replace('ID', ''))
-                numbers.append(num)
+                item['Purchase_Count'] = int(item['Purchase_Count'])
             except:
-                continue
+                item['Purchase_Count'] = 0
+        item['Purchase_Count'] += pending_counts.get(item.get('Item_ID'), 0)
         
-        if not numbers:
-            return "ID1"
+        # Unit type
+        unit_type = str(item.get('Unit_Type', '')).lower().strip()
+        if unit_type in ['weight', 'kg', 'g', 'weighted']:
+            item['Unit_Type'] = 'weight'
+        else:
+            item['Unit_Type'] = 'quantity'
         
-        next_num = max(numbers) + 1
-        return f"ID{next_num}"
+        # Aisle order, as an int so sorting never compares sheet strings
+        category_name = item.get('Category', '')
+        if category_name in category_map:
+            item['Aisle_Order'] = search.to_int(category_map[category_name].get('Aisle_Order', 999), 999)
+        else:
+            item['Aisle_Order'] = 999
     
-    except Exception as e:
-        print(f"Error generating ID: {e}")
-        return "ID1"
+    return items
 
 def get_all_items():
     """Fetch all items from Items sheet with caching"""
     def _fetch_items():
-        workbook = get_google_sheet()
-        if not workbook:
-            return []
-        
         try:
-            items_sheet = workbook.worksheet('Items')
-            items = items_sheet.get_all_records()
-            
-            # Filter out empty items
-            items = [item for item in items if item.get('Item', '').strip()]
-            
-            # Get categories
-            categories_sheet = workbook.worksheet('Categories')
-            categories = categories_sheet.get_all_records()
-            category_map = {cat['Category']: cat for cat in categories}
-            
-            # Enrich items
-            for item in items:
-                # Set defaults
-                if not item.get('Purchase_Count'):
-                    item['Purchase_Count'] = 0
-                else:
-                    try:
-                        item['Purchase_Count'] = int(item['Purchase_Count'])
-                    except:
-                        item['Purchase_Count'] = 0
-                
-                # Unit type
-                unit_type = str(item.get('Unit_Type', '')).lower().strip()
-                if unit_type in ['weight', 'kg', 'g', 'weighted']:
-                    item['Unit_Type'] = 'weight'
-                else:
-                    item['Unit_Type'] = 'quantity'
-                
-                # Aisle order
-                category_name = item.get('Category', '')
-                if category_name in category_map:
-                    item['Aisle_Order'] = category_map[category_name].get('Aisle_Order', 999)
-                else:
-                    item['Aisle_Order'] = 999
-            
-            return items
+            # Empty rows are already filtered out by the backend
+            # Two independent reads, made at the same time
+            (items, pending_counts), categories = aio.gather(load_items_with_pending_counts,
+                                                             get_storage().load_categories)
+            return prepare_items(items, categories, pending_counts)
         except Exception as e:
             print(f"Error fetching items: {e}")
-            return []
+            reset_google_sheet(e)
+            raise
     
-    return cached_fetch("items", _fetch_items)
+    return cache.fetch("items", _fetch_items, ttl=CACHE_TTL)
 
 def get_all_categories():
     """Fetch all categories with caching"""
     def _fetch_categories():
-        workbook = get_google_sheet()
-        if not workbook:
-            return []
-        
         try:
-            sheet = workbook.worksheet('Categories')
-            return sheet.get_all_records()
+            return prepare_categories(get_storage().load_categories())
         except Exception as e:
             print(f"Error fetching categories: {e}")
-            return []
+            reset_google_sheet(e)
+            raise
     
-    return cached_fetch("categories", _fetch_categories)
+    return cache.fetch("categories", _fetch_categories, ttl=CACHE_TTL)
+
+def warm_bootstrap_caches():
+    """Load whichever of items, categories and history is not cached with one batched read"""
+    if all(cache.peek(key) is not None for key in ('items', 'categories', 'history')):
+        return
+    
+    try:
+        started = time.time()
+        store = get_storage()
+        (items, categories, recent), pending_counts = read_with_pending_counts(
+            lambda: store.load_bootstrap(HISTORY_CACHE_SIZE))
+        categories = prepare_categories(categories)
+        cache.put("categories", categories, started)
+        cache.put("items", prepare_items(items, categories, pending_counts), started)
+        cache.put("history", recent, started)
+    except Exception as e:
+        # The separate loaders still get their chance
+        print(f"Error loading bootstrap data: {e}")
+        reset_google_sheet(e)
 
 def get_shopping_history(limit=3):
-    """Get last N shopping lists with caching"""
+    """Get last N shopping lists (history.ShoppingList, newest first) with caching"""
+    fetch_count = max(limit, HISTORY_CACHE_SIZE)
+    
     def _fetch_history():
-        workbook = get_google_sheet()
-        if not workbook:
-            return []
-        
         try:
-            sheet = workbook.worksheet('Shopping_History')
-            all_records = sheet.get_all_records()
-            
-            if not all_records:
-                return []
-            
-            # Get last N records
-            recent = all_records[-limit:] if len(all_records) >= limit else all_records
-            recent = list(reversed(recent))
-            
-            # Parse and enrich
-            for record in recent:
-                try:
-                    record['items'] = json.loads(record.get('Items_JSON', '[]'))
-                except:
-                    record['items'] = []
-                
-                # Check editability
-                timestamp_str = record.get('Timestamp', '')
-                if timestamp_str:
-                    try:
-                        list_time = datetime.fromisoformat(timestamp_str)
-                        now = datetime.now()
-                        time_diff = (now - list_time).total_seconds() / 60
-                        record['is_editable'] = time_diff < 60
-                        record['minutes_ago'] = int(time_diff)
-                    except:
-                        record['is_editable'] = False
-                        record['minutes_ago'] = 999
-                else:
-                    record['is_editable'] = False
-                    record['minutes_ago'] = 999
-            
-            return recent
+            return get_storage().recent_history(fetch_count)
         except Exception as e:
             print(f"Error fetching shopping history: {e}")
-            return []
+            reset_google_sheet(e)
+            raise
+    
+    if limit > HISTORY_CACHE_SIZE:
+        # Rare deep look-back - not worth keeping in the cache
+        try:
+            return _fetch_history()
+        except Exception as e:
+            raise cache.Unavailable(f"Could not load history: {e}") from e
     
-    return cached_fetch("history", _fetch_history, ttl=60)  # Shorter TTL for history
+    recent = cache.fetch("history", _fetch_history, ttl=HISTORY_CACHE_TTL)
+    return recent[:limit]
 
 def add_item_to_sheet(item_name, category, unit_type='quantity'):
-    """Add new item and invalidate cache"""
+    """Add new item and write it through to the items cache"""
     try:
-        workbook = get_google_sheet()
-        if not workbook:
-            return False, None
-        
-        sheet = workbook.worksheet('Items')
         item_id = generate_next_item_id()
-        headers = sheet.row_values(1)
-        
         unit_type = 'weight' if unit_type.lower() in ['weight', 'kg', 'g'] else 'quantity'
+        item = {
+            'Item': item_name,
+            'Category': category,
+            'Item_ID': item_id,
+            'Purchase_Count': 0,
+            'Unit_Type': unit_type,
+        }
         
-        if 'Item_ID' in headers and 'Purchase_Count' in headers and 'Unit_Type' in headers:
-            sheet.append_row([item_name, category, item_id, 0, unit_type])
-        elif 'Item_ID' in headers and 'Purchase_Count' in headers:
-            sheet.append_row([item_name, category, item_id, 0])
-        elif 'Item_ID' in headers:
-            sheet.append_row([item_name, category, item_id])
-        else:
-            sheet.append_row([item_name, category])
-        
-        # Invalidate caches
-        invalidate_cache("items")
-        invalidate_cache("categories")
+        get_storage().append_items([item])
+        publish_event('item_added', {'items': apply_new_items_to_cache([item])})
         
         return True, item_id
     except Exception as e:
         print(f"Error adding item: {e}")
+        reset_google_sheet(e)
         return False, None
 
-def update_purchase_counts(item_counts):
-    """Update purchase counts and invalidate cache"""
-    try:
-        workbook = get_google_sheet()
-        if not workbook:
-            return False
-        
-        sheet = workbook.worksheet('Items')
-        headers = sheet.row_values(1)
-        
-        if 'Item_ID' not in headers or 'Purchase_Count' not in headers:
-            return False
-        
-        id_col = headers.index('Item_ID') + 1
-        count_col = headers.index('Purchase_Count') + 1
-        all_ids = sheet.col_values(id_col)
+# Bulk import
+BULK_MAX_ITEMS = 1000  # Rows accepted per bulk request
+BULK_COLUMNS = {  # Accepted column / field names (normalized) -> field
+    'item': 'item_name', 'item_name': 'item_name', 'name': 'item_name',
+    'category': 'category',
+    'unit_type': 'unit_type', 'unit': 'unit_type',
+}
+
+def parse_bulk_rows(req):
+    """Rows of {item_name, category, unit_type} from a JSON body, a CSV body or an uploaded CSV file"""
+    upload = req.files.get('file')
+    if upload is not None or req.mimetype in ('text/csv', 'text/plain'):
+        text = upload.read().decode('utf-8-sig') if upload is not None else req.get_data(as_text=True)
+        records = list(csv.DictReader(io.StringIO(text)))
+    else:
+        data = req.get_json(silent=True)
+        records = data.get('items') if isinstance(data, dict) else data
+        if not isinstance(records, list):
+            raise ValueError('Expected a JSON list of items, {"items": [...]} or a CSV file')
+    
+    rows = []
+    for record in records:
+        row = {'item_name': '', 'category': '', 'unit_type': ''}
+        if isinstance(record, dict):
+            for key, value in record.items():
+                field = BULK_COLUMNS.get(search.normalize(key).replace(' ', '_'))
+                if field and value is not None:
+                    row[field] = str(value).strip()
+        rows.append(row)
+    return rows
+
+def add_items_in_bulk(rows):
+    """Validate, deduplicate and add rows with one ID allocation, one append and one cache patch
+
+    Returns (added items, skipped rows with the reason). Categories must already exist; names
+    matching an existing item or an earlier row, ignoring case and diacritics, are skipped.
+    """
+    categories = {search.normalize(cat['Category']): cat['Category'] for cat in get_all_categories()}
+    taken = {search.normalize(item.get('Item', '')) for item in get_all_items()}
+    
+    accepted = []
+    skipped = []
+    for number, row in enumerate(rows, 1):
+        name = row['item_name']
+        category = categories.get(search.normalize(row['category']))
+        reason = None
+        if not name:
+            reason = 'missing item name'
+        elif category is None:
+            reason = f"unknown category '{row['category']}'" if row['category'] else 'missing category'
+        elif search.normalize(name) in taken:
+            reason = 'duplicate'
         
-        for item_id, quantity in item_counts.items():
-            try:
-                if item_id in all_ids:
-                    row_idx = all_ids.index(item_id) + 1
-                    current_count = sheet.cell(row_idx, count_col).value
-                    try:
-                        current_count = int(current_count) if current_count else 0
-                    except:
-                        current_count = 0
-                    
-                    new_count = current_count + quantity
-                    sheet.update_cell(row_idx, count_col, new_count)
-            except Exception as e:
-                print(f"Error updating count for {item_id}: {e}")
-                continue
+        if reason:
+            skipped.append({'row': number, 'item_name': name, 'reason': reason})
+            continue
+        taken.add(search.normalize(name))
+        unit_type = 'weight' if row['unit_type'].lower() in ['weight', 'kg', 'g'] else 'quantity'
+        accepted.append({'Item': name, 'Category': category, 'Purchase_Count': 0, 'Unit_Type': unit_type})
+    
+    if not accepted:
+        return [], skipped
+    
+    for item, item_id in zip(accepted, allocate_item_ids(len(accepted))):
+        item['Item_ID'] = item_id
+    try:
+        get_storage().append_items(accepted)
+    except Exception as e:
+        reset_google_sheet(e)
+        raise
+    added = apply_new_items_to_cache(accepted)
+    publish_event('item_added', {'items': added})
+    return added, skipped
+
+def update_purchase_counts(item_counts, trip=None):
+    """Log purchase count increments for a trip and write the new counts through to the cache"""
+    if not item_counts:
+        return True
+    
+    try:
+        # Atomic local append - the store is updated later by the compaction job
+        added = purchase_log.record(item_counts, trip)
+        schedule_count_compaction()
         
-        # Invalidate items cache
-        invalidate_cache("items")
+        # Patch the cached catalog instead of forcing a full reload
+        cached = {item.get('Item_ID'): item.get('Purchase_Count', 0) for item in cache.peek("items") or []}
+        new_counts = {item_id: (cached[item_id] or 0) + delta
+                      for item_id, delta in added.items() if item_id in cached}
+        apply_purchase_counts_to_cache(new_counts)
+        if new_counts:
+            publish_event('counts_changed', {'counts': new_counts})
         
         return True
     except Exception as e:
-        print(f"Error updating purchase counts: {e}")
+        print(f"Error logging purchase counts: {e}")
         return False
 
-def ensure_history_sheet():
-    """Ensure Shopping_History sheet exists"""
+def schedule_count_compaction():
+    """Queue a compaction for unclaimed increments, unless one is already waiting to run"""
+    # Not keyed on a log row ID: the log empties after each compaction and IDs are reused
+    if purchase_log.oldest_pending_id() is not None and not outbox.is_waiting(COUNT_COMPACT_QUEUE):
+        outbox.enqueue('compact_counts', {}, delay=COUNT_COMPACT_DELAY)
+
+def process_count_compaction(payload, step):
+    """Outbox handler: fold logged increments into the stored purchase counts"""
+    batch = step.run('claim', purchase_log.claim)
+    if batch:
+        # A batch resumed from an earlier job may already be in the store
+        if not batch.get('written'):
+            try:
+                step.run('write', lambda: get_storage().add_purchase_counts(batch['totals']))
+            except Exception as e:
+                reset_google_sheet(e)
+                raise
+            step.run('written', lambda: purchase_log.written(batch['batch']))
+        step.run('finish', lambda: purchase_log.finish(batch['batch']))
+    
+    # Increments logged while this one ran
+    schedule_count_compaction()
+    return {'items': len(batch['totals']) if batch else 0}
+
+def apply_purchase_counts_to_cache(new_counts):
+    """Write new purchase counts through to the cached items"""
+    if not new_counts:
+        return
+    
+    def _patch(items):
+        return [dict(item, Purchase_Count=new_counts[item.get('Item_ID')])
+                if item.get('Item_ID') in new_counts else item
+                for item in items]
+    
+    # Move the changed items within the sorted orders instead of rebuilding them
+    old_version = cache.get_version("items")
+    search.apply_counts(new_counts, old_version, cache.update("items", _patch))
+
+def apply_new_items_to_cache(new_items):
+    """Write newly added items through to the cached items in one update; returns them with Aisle_Order"""
+    categories = cache.peek("categories") or []
+    category_map = {cat.get('Category'): cat for cat in categories}
+    new_items = [dict(item, Aisle_Order=search.to_int(category_map.get(item['Category'], {})
+                                                        .get('Aisle_Order', 999), 999))
+                 for item in new_items]
+    
+    def _patch(items):
+        cached_ids = {i.get('Item_ID') for i in items}
+        missing = [item for item in new_items if not item['Item_ID'] or item['Item_ID'] not in cached_ids]
+        return items + missing if missing else items
+    
+    old_version = cache.get_version("items")
+    search.apply_new_items(new_items, old_version, cache.update("items", _patch))
+    return new_items
+
+def publish_event(kind, payload):
+    """Tell open pages about a change; the change itself already succeeded, so failures are only logged"""
     try:
-        workbook = get_google_sheet()
-        if not workbook:
-            return False
-        
-        try:
-            workbook.worksheet('Shopping_History')
-            return True
-        except:
-            sheet = workbook.add_worksheet(title='Shopping_History', rows=100, cols=6)
-            sheet.append_row(['Timestamp', 'Date', 'Total_Items', 'Unique_Items', 'Items_JSON', 'Items_Display'])
-            return True
+        events.publish(kind, payload)
     except Exception as e:
-        print(f"Error ensuring history sheet: {e}")
-        return False
+        print(f"Error publishing live update: {e}")
+
+def build_history_row(items_data):
+    """Build a Shopping_History row for a list of selected items"""
+    timestamp = datetime.now().isoformat()
+    date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    
+    total_items = sum(item.get('quantity', 1) for item in items_data)
+    unique_items = len(items_data)
+    
+    items_json = json.dumps([{
+        'item_id': item.get('Item_ID', ''),
+        'name': item.get('Item', ''),
+        'category': item.get('Category', ''),
+        'quantity': item.get('quantity', 1),
+        'unit_type': item.get('Unit_Type', 'quantity')
+    } for item in items_data])
+    
+    items_display = '; '.join([
+        f"{item.get('Item', 'Unknown')} ({item.get('quantity', 1)}{'kg' if item.get('Unit_Type') == 'weight' else 'x'})"
+        for item in items_data
+    ])
+    
+    return [timestamp, date, total_items, unique_items, items_json, items_display]
 
 def save_shopping_history(items_data):
-    """Save shopping list to history and invalidate cache"""
+    """Save shopping list to history and write it through to the cache"""
     try:
-        ensure_history_sheet()
-        workbook = get_google_sheet()
-        if not workbook:
-            return False
-        
-        sheet = workbook.worksheet('Shopping_History')
-        
-        timestamp = datetime.now().isoformat()
-        date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        
-        total_items = sum(item.get('quantity', 1) for item in items_data)
-        unique_items = len(items_data)
-        
-        items_json = json.dumps([{
-            'item_id': item.get('Item_ID', ''),
-            'name': item.get('Item', ''),
-            'category': item.get('Category', ''),
-            'quantity': item.get('quantity', 1),
-            'unit_type': item.get('Unit_Type', 'quantity')
-        } for item in items_data])
-        
-        items_display = '; '.join([
-            f"{item.get('Item', 'Unknown')} ({item.get('quantity', 1)}{'kg' if item.get('Unit_Type') == 'weight' else 'x'})"
-            for item in items_data
-        ])
+        saved = get_storage().append_history(build_history_row(items_data))
         
-        sheet.append_row([timestamp, date, total_items, unique_items, items_json, items_display])
+        def _patch(recent):
+            if recent and recent[0].timestamp == saved.timestamp:
+                return recent
+            return [saved] + recent[:HISTORY_CACHE_SIZE - 1]
         
-        # Invalidate history cache
-        invalidate_cache("history")
+        cache.update("history", _patch)
+        publish_event('history_updated', {'list': saved.to_dict(datetime.now()), 'replaced': False})
+        record_history_stats(saved)
+        schedule_history_archive()
         
         return True
     except Exception as e:
         print(f"Error saving shopping history: {e}")
+        reset_google_sheet(e)
         return False
 
-def update_last_shopping_list(items_data):
-    """Update most recent shopping list and invalidate cache"""
+def update_last_shopping_list(items_data, expected_timestamp=None):
+    """Update most recent shopping list and write it through to the cache
+
+    Returns False if there is no list it may update (too old, or not the expected one);
+    Sheets errors are raised, so a send job retries instead of saving a new list.
+    """
     try:
-        workbook = get_google_sheet()
-        if not workbook:
-            return False
-        
-        sheet = workbook.worksheet('Shopping_History')
-        all_records = sheet.get_all_records()
+        store = get_storage()
+        recent = store.recent_history(1)
         
-        if not all_records:
+        # Only lists sent within the last hour can be updated
+        if not recent or not recent[0].is_editable():
             return False
         
-        last_row = len(all_records) + 1
-        last_record = all_records[-1]
-        timestamp_str = last_record.get('Timestamp', '')
-        
-        if timestamp_str:
-            try:
-                list_time = datetime.fromisoformat(timestamp_str)
-                now = datetime.now()
-                time_diff = (now - list_time).total_seconds() / 60
-                
-                if time_diff >= 60:
-                    return False
-            except:
-                return False
-        else:
+        # Another list was sent since the diff was taken - this one is saved as new instead
+        if expected_timestamp is not None and recent[0].timestamp != expected_timestamp:
             return False
         
-        timestamp = datetime.now().isoformat()
-        date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        total_items = sum(item.get('quantity', 1) for item in items_data)
-        unique_items = len(items_data)
-        
-        items_json = json.dumps([{
-            'item_id': item.get('Item_ID', ''),
-            'name': item.get('Item', ''),
-            'category': item.get('Category', ''),
-            'quantity': item.get('quantity', 1),
-            'unit_type': item.get('Unit_Type', 'quantity')
-        } for item in items_data])
+        last_row = recent[0].row
+        updated = store.replace_history(last_row, build_history_row(items_data))
         
-        items_display = '; '.join([
-            f"{item.get('Item', 'Unknown')} ({item.get('quantity', 1)}{'kg' if item.get('Unit_Type') == 'weight' else 'x'})"
-            for item in items_data
-        ])
+        def _patch(recent):
+            return [updated] + [l for l in recent if l.row != last_row][:HISTORY_CACHE_SIZE - 1]
         
-        sheet.update(f'A{last_row}:F{last_row}', [[timestamp, date, total_items, unique_items, items_json, items_display]])
-        
-        # Invalidate history cache
-        invalidate_cache("history")
+        cache.update("history", _patch)
+        publish_event('history_updated', {'list': updated.to_dict(datetime.now()), 'replaced': True})
+        record_history_stats(updated, replaces=recent[0].timestamp)
         
         return True
     except Exception as e:
         print(f"Error updating shopping history: {e}")
-        return False
+        reset_google_sheet(e)
+        raise
+
+def record_history_stats(shopping_list, replaces=None):
+    """Roll a saved list into the per-item statistics; the list is saved either way"""
+    try:
+        archive.record_list(shopping_list, replaces)
+    except Exception as e:
+        print(f"Error updating item statistics: {e}")
+
+def schedule_history_archive():
+    """Queue the day's archive run, once per day"""
+    if HISTORY_ARCHIVE_DAYS > 0:
+        outbox.enqueue('archive_history', {}, idempotency_key=f"archive-history-{datetime.now():%Y-%m-%d}")
+    else:
+        ensure_history_stats()
+
+def ensure_history_stats():
+    """Queue a one-off build of the item statistics if they predate the current version"""
+    try:
+        if not archive.stats_built():
+            outbox.enqueue('archive_history', {}, idempotency_key=f"history-stats-v{archive.STATS_VERSION}")
+    except Exception as e:
+        print(f"Error scheduling item statistics build: {e}")
+
+def process_history_archive(payload, step):
+    """Outbox handler: build the item statistics if needed, then archive lists older than HISTORY_ARCHIVE_DAYS"""
+    store = get_storage()
+    
+    if not archive.stats_built():
+        # First run - statistics for everything saved before they were kept
+        step.run('stats', lambda: archive.rebuild_stats(list(archive.iter_archived()) + store.load_history()))
+    if HISTORY_ARCHIVE_DAYS <= 0:
+        return {'archived': 0}
+    
+    cutoff = step.run('cutoff', lambda: (datetime.now() - timedelta(days=HISTORY_ARCHIVE_DAYS)).isoformat())
+    
+    def _archive():
+        lists = store.history_before(cutoff)
+        archive.archive_lists(lists)
+        return [shopping_list.timestamp for shopping_list in lists]
+    
+    timestamps = step.run('archive', _archive)
+    if not timestamps:
+        return {'archived': 0}
+    
+    try:
+        if isinstance(store, storage.SqliteStorage) and store.track_changes:
+            # Trim the workbook mirror first, or the next pull would bring the rows back
+            step.run('delete_mirror', lambda: sheets_storage.delete_history(set(timestamps)))
+        deleted = step.run('delete', lambda: store.delete_history(set(timestamps) & archive.archived_timestamps()))
+    except Exception as e:
+        reset_google_sheet(e)
+        raise
+    
+    # Cached lists carry row numbers that have just shifted
+    cache.invalidate("history")
+    return {'archived': len(timestamps), 'deleted': deleted}
 
 def sort_items_by_aisle(items):
-    """Sort items by aisle order"""
-    return sorted(items, key=lambda x: x.get('Aisle_Order', 999))
+    """Sort items by aisle order, using the catalog's precomputed aisle ranking"""
+    return search.current_index().sort_selection(items, 'aisle')
+
+# WhatsApp sending
+_twilio = {'pid': None, 'client': None}
+_twilio_lock = threading.Lock()
+
+def get_twilio_client():
+    """Return the shared Twilio client, one per worker process"""
+    with _twilio_lock:
+        if _twilio['pid'] != os.getpid():
+            load_twilio_library()
+            _twilio['client'] = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+            _twilio['pid'] = os.getpid()
+        return _twilio['client']
+
+def compare_with_last_list(selected_items):
+    """(timestamp of the last saved list, quantities new or increased compared to it, changed lines)
+
+    The changed lines are items marked added, changed (with old_quantity) or removed, for
+    rendering an update as just its changes; None if the last list can no longer be updated.
+    """
+    recent = get_storage().recent_history(1)
+    if not recent:
+        return None, {}, None
+    
+    old_item_map = recent[0].quantities()
+    
+    item_count_diff = {}
+    changes = []
+    for item in selected_items:
+        item_id = item.get('Item_ID', '')
+        new_quantity = item.get('quantity', 1)
+        
+        if item_id:
+            old_quantity = old_item_map.get(item_id, 0)
+            
+            if old_quantity == 0:
+                # New item added to list
+                item_count_diff[item_id] = new_quantity
+                changes.append(dict(item, change='added'))
+            elif new_quantity > old_quantity:
+                # Quantity increased
+                item_count_diff[item_id] = new_quantity - old_quantity
+            if old_quantity and new_quantity != old_quantity:
+                changes.append(dict(item, change='changed', old_quantity=old_quantity))
+    
+    selected_ids = {item.get('Item_ID') for item in selected_items}
+    for old_item in recent[0].items:
+        if old_item.item_id and old_item.item_id not in selected_ids:
+            changes.append({'Item_ID': old_item.item_id, 'Item': old_item.name, 'Category': old_item.category,
+                            'quantity': old_item.quantity, 'Unit_Type': old_item.unit_type, 'change': 'removed'})
+    
+    return recent[0].timestamp, item_count_diff, changes if recent[0].is_editable() else None
+
+def _require(ok, action):
+    """Turn a False result from a sheet helper into an error so the job is retried"""
+    if not ok:
+        raise RuntimeError(f"Failed to {action}")
+    return ok
+
+def process_send_job(payload, step):
+    """Outbox handler: send the message, then record history and purchase counts"""
+    selected_items = payload['items']
+    is_update = payload['is_update']
+    # Jobs queued before lists were split carry a single message
+    messages = payload.get('messages') or [payload['message']]
+    
+    def _compare():
+        # Diff against the previous list before it is overwritten, and only overwrite that same list
+        return step.run('compare', lambda: compare_with_last_list(selected_items))
+    
+    def _send(body):
+        with metrics.span('twilio', 'messages.create'):
+            return get_twilio_client().messages.create(
+                body=body,
+                from_=TWILIO_WHATSAPP_FROM,
+                to=WHATSAPP_TO
+            ).sid
+    
+    def _send_all(messages):
+        # One step per part, so a retry resends only the parts that did not go out, in order
+        return [step.run('send' if number == 1 else f'send_{number}', lambda body=body: _send(body))
+                for number, body in enumerate(messages, 1)]
+    
+    if not is_update:
+        message_sids = _send_all(messages)
+    elif payload.get('changes_only'):
+        base_timestamp, item_count_diff, changes = _compare()
+        if changes is not None:
+            messages = step.run('render', lambda: renderer.render_changes(sort_items_by_aisle(changes)))
+        message_sids = _send_all(messages)
+    else:
+        # The whole list does not depend on the diff, so the history read and the send overlap
+        (base_timestamp, item_count_diff, _), message_sids = aio.gather(_compare, lambda: _send_all(messages))
+    
+    saved_as = 'saved'
+    item_counts = {}
+    if is_update:
+        if step.run('history', lambda: update_last_shopping_list(selected_items, base_timestamp)):
+            saved_as = 'updated'
+            item_counts = item_count_diff
+    
+    if saved_as == 'saved':
+        # New list, or the last one is too old to update - count every item
+        step.run('save', lambda: _require(save_shopping_history(selected_items), 'save shopping history'))
+        for item in selected_items:
+            item_id = item.get('Item_ID', '')
+            if item_id:
+                item_counts[item_id] = item.get('quantity', 1)
+    
+    if item_counts:
+        # The job ID names the trip, so a retry cannot log the same increments twice
+        step.run('counts', lambda: _require(update_purchase_counts(item_counts, trip=step.job_id),
+                                            'update purchase counts'))
+    
+    return {'message_sid': message_sids[0], 'message_sids': message_sids, 'history': saved_as}
+
+outbox.configure(LOCAL_DB_PATH, workers=int(os.getenv('OUTBOX_WORKERS', 2)))
+outbox.register('send_list', metrics.job('send_list', process_send_job), queue='whatsapp')
+outbox.register('compact_counts', metrics.job('compact_counts', process_count_compaction), queue=COUNT_COMPACT_QUEUE)
+# Shares the send queue, so rows never shift under a history update
+outbox.register('archive_history', metrics.job('archive_history', process_history_archive), queue='whatsapp')
+
+# Startup warm-up - what to prepare before the first request: off, connect (client libraries and
+# the workbook handle) or caches (also items, categories, recent history and the search index)
+STARTUP_WARMUP = os.getenv('STARTUP_WARMUP', 'caches').lower()
+
+_startup = {'preloading': False, 'warm': False}
+
+def warm_up(preloading=False):
+    """Import the client libraries, open the workbook and fill the page caches; errors are only logged
+
+    With preloading set this runs in the gunicorn master before it forks the workers, so it starts
+    no threads and closes its database connections, and every worker inherits what it loaded.
+    """
+    if STARTUP_WARMUP == 'off':
+        return
+    
+    _startup['preloading'] = preloading
+    try:
+        load_sheets_libraries()
+        load_twilio_library()
+        if STORAGE_BACKEND == 'sheets' or SHEETS_SYNC:
+            get_google_sheet()
+        if STORAGE_BACKEND == 'sqlite':
+            get_storage()
+        
+        if STARTUP_WARMUP == 'caches':
+            warm_bootstrap_caches()
+            version, _ = cache.get_meta("items")
+            search.get_index(get_all_items(), version)
+        _startup['warm'] = True
+    except Exception as e:
+        print(f"Error warming up: {e}")
+    finally:
+        _startup['preloading'] = False
+        if preloading:
+            local_db.close_all()
+
+def start_warm_up():
+    """Warm up in a background thread, so the worker takes requests meanwhile"""
+    if STARTUP_WARMUP != 'off':
+        threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
+# Conditional JSON responses
+RESPONSE_MEMO_SIZE = 128  # Serialized bodies kept, keyed by endpoint and query string
+COMPRESS_MIN_BYTES = 1024
+
+_response_memo = OrderedDict()
+_response_memo_lock = threading.Lock()
+
+def _memoized_body(memo_key, version, build):
+    """Serialized body and its ETag, reused while the data version is unchanged"""
+    if memo_key is not None and version is not None:
+        with _response_memo_lock:
+            memo = _response_memo.get(memo_key)
+            if memo is not None and memo['version'] == version:
+                _response_memo.move_to_end(memo_key)
+                return memo
+    
+    body = (app.json.dumps(build()) + '\n').encode('utf-8')
+    memo = {'version': version, 'body': body, 'etag': hashlib.md5(body).hexdigest(), 'encoded': {}}
+    
+    if memo_key is not None and version is not None:
+        with _response_memo_lock:
+            _response_memo[memo_key] = memo
+            while len(_response_memo) > RESPONSE_MEMO_SIZE:
+                _response_memo.popitem(last=False)
+    return memo
+
+def _encoded_body(memo):
+    """Pick brotli or gzip if the client accepts it, compressing once per version"""
+    if len(memo['body']) < COMPRESS_MIN_BYTES:
+        return None, memo['body']
+    
+    if brotli is not None and request.accept_encodings['br']:
+        encoding = 'br'
+    elif request.accept_encodings['gzip']:
+        encoding = 'gzip'
+    else:
+        return None, memo['body']
+    
+    if encoding not in memo['encoded']:
+        if encoding == 'br':
+            memo['encoded'][encoding] = brotli.compress(memo['body'])
+        else:
+            memo['encoded'][encoding] = gzip.compress(memo['body'], compresslevel=6)
+    return encoding, memo['encoded'][encoding]
+
+def conditional_json(memo_key, version, modified_at, build):
+    """JSON response with ETag/Last-Modified that answers revalidation with 304"""
+    memo = _memoized_body(memo_key, version, build)
+    last_modified = datetime.fromtimestamp(int(modified_at), timezone.utc) if modified_at else None
+    
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(memo['etag'])
+    else:
+        not_modified = bool(last_modified and request.if_modified_since and
+                            last_modified <= request.if_modified_since)
+    
+    if not_modified:
+        response = app.response_class(status=304)
+    else:
+        encoding, body = _encoded_body(memo)
+        response = app.response_class(body, mimetype='application/json')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    
+    # Weak, because the same data is served in several encodings
+    response.set_etag(memo['etag'], weak=True)
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept-Encoding')
+    return response
 
-def sort_items_by_popularity(items):
-    """Sort items by purchase count"""
-    return sorted(items, key=lambda x: x.get('Purchase_Count', 0), reverse=True)
+@app.before_request
+def start_request_metrics():
+    metrics.begin(request.url_rule.rule if request.url_rule else 'unmatched')
+
+@app.after_request
+def add_server_timing_header(response):
+    current = metrics.end()
+    if current is not None:
+        response.headers['Server-Timing'] = metrics.finish_request(current, request.method, response.status_code)
+    return response
+
+@app.after_request
+def add_sheets_counters_header(response):
+    """Report how many Sheets handshakes the request caused"""
+    counters = get_sheets_counters()
+    response.headers['X-Sheets-Handshakes'] = str(sum(counters.values()))
+    return response
+
+# Live updates - streams end after STREAM_MAX_SECONDS and the browser reconnects.
+# Each open stream holds a request thread, so only STREAM_MAX_CONNECTIONS may be open per
+# worker; gunicorn.conf.py adds that many threads on top of WEB_THREADS for API requests.
+STREAM_MAX_SECONDS = 300
+STREAM_KEEPALIVE = 15
+STREAM_RETRY_MS = 3000
+STREAM_MAX_CONNECTIONS = int(os.getenv('STREAM_MAX_CONNECTIONS', 24))
+STREAM_BUSY_RETRY_SECONDS = 30
+
+_stream_slots = threading.BoundedSemaphore(STREAM_MAX_CONNECTIONS)
+
+# Page bootstrap
+BOOTSTRAP_PAGE_SIZE = 100  # Items in the first page, as the frontend pages them
+
+def build_bootstrap(limit=BOOTSTRAP_PAGE_SIZE, history_limit=3):
+    """First page of items, all categories and recent history - everything the page needs to start"""
+    warm_bootstrap_caches()
+    
+    version = cache.get_version("items")
+    items = get_all_items()
+    page, total = search.get_index(items, version).search(sort='popularity', limit=limit)
+    now = datetime.now()
+    return {
+        'success': True,
+        'items': page,
+        'total': total,
+        'next_cursor': str(len(page)) if len(page) < total else None,
+        'categories': get_all_categories(),
+        'history': [shopping_list.to_dict(now) for shopping_list in get_shopping_history(history_limit)],
+    }
 
 # Routes
+@app.route('/healthz')
+def healthz():
+    """Liveness check that never touches Sheets or Twilio"""
+    return jsonify({'status': 'ok', 'warm': _startup['warm']})
+
 @app.route('/')
 def index():
-    return render_template('index.html')
+    # Rendered into the page so the first paint needs no further requests
+    try:
+        bootstrap = build_bootstrap()
+    except Exception as e:
+        print(f"Error building bootstrap data: {e}")
+        bootstrap = None
+    return render_template('index.html', bootstrap=bootstrap)
+
+@app.route('/api/bootstrap', methods=['GET'])
+def api_bootstrap():
+    try:
+        limit = max(1, min(request.args.get('limit', BOOTSTRAP_PAGE_SIZE, type=int), search.MAX_LIMIT))
+        history_limit = request.args.get('history', 3, type=int)
+        payload = build_bootstrap(limit, history_limit)
+        # History's minutes_ago changes every minute, so the body is hashed rather than memoized
+        return conditional_json(None, None, None, lambda: payload)
+    except cache.Unavailable as e:
+        return jsonify({'success': False, 'error': str(e)}), 503
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/items', methods=['GET'])
 def api_items():
     try:
+        # Read the version first so a concurrent write can only make the index newer
+        version, modified_at = cache.get_meta("items")
         items = get_all_items()
-        return jsonify({'success': True, 'items': sort_items_by_popularity(items)})
+        memo_key = ('items', tuple(sorted(request.args.items(multi=True))))
+        
+        item_ids = request.args.getlist('id')
+        names = request.args.getlist('name')
+        if item_ids or names:
+            return conditional_json(memo_key, version, modified_at, lambda: {
+                'success': True,
+                'items': search.get_index(items, version).lookup(item_ids, names)
+            })
+        
+        sort = request.args.get('sort', 'popularity')
+        if sort not in search.SORTS:
+            return jsonify({'success': False, 'error': f"sort must be one of {', '.join(search.SORTS)}"}), 400
+        
+        limit = request.args.get('limit', type=int)
+        if limit is not None:
+            limit = max(1, min(limit, search.MAX_LIMIT))
+        
+        cursor = request.args.get('cursor', '0')
+        if not cursor.isdigit():
+            return jsonify({'success': False, 'error': 'Invalid cursor'}), 400
+        offset = int(cursor)
+        
+        def _build():
+            page, total = search.get_index(items, version).search(
+                query=request.args.get('q', ''),
+                category=request.args.get('category', ''),
+                sort=sort,
+                limit=limit,
+                offset=offset
+            )
+            next_offset = offset + len(page)
+            return {
+                'success': True,
+                'items': page,
+                'total': total,
+                'next_cursor': str(next_offset) if next_offset < total else None
+            }
+        
+        return conditional_json(memo_key, version, modified_at, _build)
+    except cache.Unavailable as e:
+        return jsonify({'success': False, 'error': str(e)}), 503
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -452,11 +1163,41 @@ def add_item():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/items/bulk', methods=['POST'])
+def add_items_bulk():
+    """Add many items at once from JSON or CSV (columns Item, Category, Unit_Type)"""
+    try:
+        try:
+            rows = parse_bulk_rows(request)
+        except (ValueError, csv.Error) as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        
+        if not rows:
+            return jsonify({'success': False, 'error': 'No items given'}), 400
+        if len(rows) > BULK_MAX_ITEMS:
+            return jsonify({'success': False, 'error': f'At most {BULK_MAX_ITEMS} items per request'}), 400
+        
+        added, skipped = add_items_in_bulk(rows)
+        return jsonify({
+            'success': True,
+            'message': f'{len(added)} items added, {len(skipped)} skipped',
+            'items': added,
+            'skipped': skipped
+        })
+    except cache.Unavailable as e:
+        return jsonify({'success': False, 'error': str(e)}), 503
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/api/categories', methods=['GET'])
 def api_categories():
     try:
+        version, modified_at = cache.get_meta("categories")
         cats = get_all_categories()
-        return jsonify({'success': True, 'categories': cats})
+        return conditional_json(('categories',), version, modified_at,
+                                lambda: {'success': True, 'categories': cats})
+    except cache.Unavailable as e:
+        return jsonify({'success': False, 'error': str(e)}), 503
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -464,8 +1205,115 @@ def api_categories():
 def api_history():
     try:
         limit = int(request.args.get('limit', 3))
-        hist = get_shopping_history(limit)
-        return jsonify({'success': True, 'history': hist})
+        _, modified_at = cache.get_meta("history")
+        now = datetime.now()
+        hist = [shopping_list.to_dict(now) for shopping_list in get_shopping_history(limit)]
+        # minutes_ago changes every minute, so history is hashed rather than memoized
+        return conditional_json(None, None, modified_at, lambda: {'success': True, 'history': hist})
+    except cache.Unavailable as e:
+        return jsonify({'success': False, 'error': str(e)}), 503
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/stream', methods=['GET'])
+def api_stream():
+    """Server-Sent Events: item_added, counts_changed and history_updated deltas"""
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    last_event_id = int(last_event_id) if last_event_id and last_event_id.isdigit() else None
+    
+    # Streams must not take the threads API requests need; the page retries later
+    if not _stream_slots.acquire(blocking=False):
+        response = jsonify({'success': False, 'error': 'Too many open live update streams'})
+        response.headers['Retry-After'] = str(STREAM_BUSY_RETRY_SECONDS)
+        return response, 503
+    
+    try:
+        subscription, missed = events.subscribe(last_event_id)
+    except Exception:
+        _stream_slots.release()
+        raise
+    
+    def _stream():
+        # Ask the browser to wait a few seconds before reconnecting
+        yield f"retry: {STREAM_RETRY_MS}\n\n"
+        if missed is None:
+            yield "event: reload\ndata: {}\n\n"
+            return
+        for event in missed:
+            yield events.format_sse(event)
+        
+        deadline = time.monotonic() + STREAM_MAX_SECONDS
+        while time.monotonic() < deadline:
+            event = subscription.get(timeout=STREAM_KEEPALIVE)
+            if subscription.overflowed:
+                yield "event: reload\ndata: {}\n\n"
+                return
+            # A comment line keeps proxies from closing an idle connection
+            yield events.format_sse(event) if event else ": keepalive\n\n"
+    
+    def _close():
+        # Also runs if the client went away before the stream started
+        events.unsubscribe(subscription)
+        _stream_slots.release()
+    
+    response = Response(_stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.call_on_close(_close)
+    return response
+
+@app.route('/api/history/stats', methods=['GET'])
+def api_history_stats():
+    try:
+        ensure_history_stats()
+        limit = request.args.get('limit', type=int)
+        return jsonify({'success': True,
+                        'items': archive.item_stats(request.args.getlist('id') or None, limit)})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/suggestions', methods=['GET'])
+def api_suggestions():
+    """Usual items, items due again and items bought with the picked ones, as catalog items"""
+    try:
+        ensure_history_stats()
+        limit = max(1, min(request.args.get('limit', 10, type=int), search.MAX_LIMIT))
+        picked = request.args.getlist('picked')
+        
+        ranked = {
+            'usual': suggestions.usual(limit, exclude=set(picked)),
+            'due': suggestions.due(limit, exclude=set(picked)),
+            'together': suggestions.together(picked, limit),
+        }
+        
+        # Items deleted from the catalog since they were bought are left out
+        version, _ = cache.get_meta("items")
+        wanted = {entry['item_id'] for entries in ranked.values() for entry in entries}
+        found = {item['Item_ID']: item for item in search.get_index(get_all_items(), version).lookup(wanted)}
+        result = {'success': True}
+        for kind, entries in ranked.items():
+            result[kind] = [dict(found[entry['item_id']], Suggestion=entry)
+                            for entry in entries if entry['item_id'] in found]
+        return jsonify(result)
+    except cache.Unavailable as e:
+        return jsonify({'success': False, 'error': str(e)}), 503
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/cache/stats', methods=['GET'])
+def api_cache_stats():
+    return jsonify({'success': True, 'stats': cache.get_stats()})
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/sync/status', methods=['GET'])
+def api_sync_status():
+    if not isinstance(get_storage(), storage.SqliteStorage) or not get_storage().track_changes:
+        return jsonify({'success': True, 'enabled': False})
+    try:
+        return jsonify({'success': True, 'enabled': True, 'status': sync.get_status()})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -493,119 +1341,45 @@ def send_whatsapp():
         if not selected_items:
             return jsonify({'success': False, 'error': 'No items selected'}), 400
         
-        sorted_items = sort_items_by_aisle(selected_items)
-        
-        if is_update:
-            message = "🛒 *Shopping List (UPDATED)*\n\n"
-        else:
-            message = "🛒 *Shopping List*\n\n"
-        
-        current_category = None
-        
-        for item in sorted_items:
-            category = item.get('Category', 'Other')
-            if category != current_category:
-                message += f"\n📍 *{category}*\n"
-                current_category = category
-            
-            item_name = item.get('Item', 'Unknown')
-            quantity = item.get('quantity', 1)
-            unit_type = item.get('Unit_Type', 'quantity')
-            
-            if unit_type == 'weight':
-                message += f"  • {item_name} - {quantity} kg\n"
-            elif quantity > 1:
-                message += f"  • {item_name} × {quantity}\n"
-            else:
-                message += f"  • {item_name}\n"
-        
-        message += "\n✅ Happy shopping!"
-        
         if not all([TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, TWILIO_WHATSAPP_FROM, WHATSAPP_TO]):
             return jsonify({'success': False, 'error': 'Twilio credentials not configured'}), 500
         
-        client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-        twilio_message = client.messages.create(
-            body=message,
-            from_=TWILIO_WHATSAPP_FROM,
-            to=WHATSAPP_TO
-        )
-        
-        # Save or update history and handle purchase counts
-        if is_update:
-            # Get the previous list to calculate difference
-            workbook = get_google_sheet()
-            if workbook:
-                try:
-                    sheet = workbook.worksheet('Shopping_History')
-                    all_records = sheet.get_all_records()
-                    
-                    if all_records:
-                        last_record = all_records[-1]
-                        old_items_json = last_record.get('Items_JSON', '[]')
-                        
-                        try:
-                            old_items = json.loads(old_items_json)
-                            
-                            # Calculate NEW items and INCREASED quantities
-                            old_item_map = {item['item_id']: item['quantity'] for item in old_items if item.get('item_id')}
-                            
-                            item_count_diff = {}
-                            for item in selected_items:
-                                item_id = item.get('Item_ID', '')
-                                new_quantity = item.get('quantity', 1)
-                                
-                                if item_id:
-                                    old_quantity = old_item_map.get(item_id, 0)
-                                    
-                                    if old_quantity == 0:
-                                        # New item added to list
-                                        item_count_diff[item_id] = new_quantity
-                                    elif new_quantity > old_quantity:
-                                        # Quantity increased
-                                        item_count_diff[item_id] = new_quantity - old_quantity
-                            
-                            # Update purchase counts only for NEW or INCREASED items
-                            if item_count_diff:
-                                update_purchase_counts(item_count_diff)
-                        except:
-                            # JSON parse error - treat as new list
-                            pass
-                except:
-                    pass
-            
-            # Update history
-            updated = update_last_shopping_list(selected_items)
-            if not updated:
-                # Update failed (list too old) - save as new list
-                save_shopping_history(selected_items)
-                # Count all items as it's a new shopping trip
-                item_counts = {}
-                for item in selected_items:
-                    item_id = item.get('Item_ID', '')
-                    quantity = item.get('quantity', 1)
-                    if item_id:
-                        item_counts[item_id] = quantity
-                update_purchase_counts(item_counts)
-        else:
-            # New list - save history and update all purchase counts
-            save_shopping_history(selected_items)
-            item_counts = {}
-            for item in selected_items:
-                item_id = item.get('Item_ID', '')
-                quantity = item.get('quantity', 1)
-                if item_id:
-                    item_counts[item_id] = quantity
-            update_purchase_counts(item_counts)
+        # Updates go out as just their changes unless the whole list is asked for
+        changes_only = is_update and data.get('changes_only', True)
+        # Also sent for an update with no earlier list to compare against
+        messages = renderer.render_list(sort_items_by_aisle(selected_items), is_update)
+        
+        # The same key from a retried request returns the job already queued. Prefixed, so a
+        # client's key can never match an internal job such as history-stats-v2.
+        request_key = request.headers.get('Idempotency-Key') or data.get('request_id')
+        idempotency_key = f"send:{request_key}" if request_key else None
+        job_id, _ = outbox.enqueue('send_list', {
+            'messages': messages,
+            'items': selected_items,
+            'is_update': is_update,
+            'changes_only': changes_only,
+        }, idempotency_key=idempotency_key)
         
         return jsonify({
             'success': True,
-            'message': 'Shopping list updated successfully!' if is_update else 'Shopping list sent successfully!',
-            'message_sid': twilio_message.sid,
+            'message': 'Shopping list queued for sending',
+            'job_id': job_id,
+            'status': outbox.get_job(job_id)['status'],
             'was_update': is_update
-        })
+        }), 202
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def api_job_status(job_id):
+    try:
+        job = outbox.get_job(job_id)
+        if not job:
+            return jsonify({'success': False, 'error': 'Job not found'}), 404
+        return jsonify({'success': True, 'job': job})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
 if __name__ == '__main__':
+    start_warm_up()
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,249 @@
+"""History archive segments and rolled-up per-item statistics.
+
+Old shopping lists are moved out of the live store into gzip JSON-lines
+segments, one file per month of sending, so Shopping_History only holds
+recent trips. A segment line keeps just the timestamp, date and item lines;
+totals and the display text are derived from those. Segments are only ever
+appended to (each append is a new gzip member, which readers see as one
+stream), and the archived_lists table records which lists each holds, so an
+interrupted run can be repeated without writing duplicates.
+
+Per-item statistics (trips, total quantity, first and last purchase) live in
+item_stats and are updated with each saved or updated list, so analytics
+never scan raw rows. The average interval between purchases follows from
+the first and last purchase and the trip count. Alongside them:
+
+- item_recency holds a recency-weighted trip count per item. Each trip adds
+  2 ** (days since EPOCH / RECENCY_HALF_LIFE_DAYS), so decaying every item
+  to "now" is one common factor and the stored weights already rank them.
+- item_pairs is the sparse item-by-item co-occurrence matrix: how many
+  trips had both items, stored in both directions for lookups by either.
+
+Each applied list's lines are kept in item_stats_lists, which makes
+applying a list idempotent and lets an updated list replace exactly what
+the previous version added.
+"""
+import gzip
+import json
+import os
+from datetime import datetime
+
+import history
+import local_db
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS archived_lists (timestamp TEXT PRIMARY KEY, segment TEXT NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS item_stats (key TEXT PRIMARY KEY, item_id TEXT NOT NULL, name TEXT NOT NULL, '
+    'trips INTEGER NOT NULL, total_quantity REAL NOT NULL, first_at TEXT NOT NULL, last_at TEXT NOT NULL, '
+    'previous_at TEXT)',
+    'CREATE TABLE IF NOT EXISTS item_stats_lists (timestamp TEXT PRIMARY KEY, lines TEXT NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS item_recency (key TEXT PRIMARY KEY, weight REAL NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS idx_item_recency_weight ON item_recency (weight)',
+    'CREATE TABLE IF NOT EXISTS item_pairs (key TEXT NOT NULL, other TEXT NOT NULL, trips INTEGER NOT NULL, '
+    'PRIMARY KEY (key, other))',
+    'CREATE TABLE IF NOT EXISTS archive_state (name TEXT PRIMARY KEY, value TEXT)',
+]
+
+STATS_VERSION = 2  # Bumped when the rolled-up tables change, so they are rebuilt once
+EPOCH = datetime(2020, 1, 1)
+RECENCY_HALF_LIFE_DAYS = 45  # A trip this long ago counts half as much as one today
+
+_config = {'path': None, 'directory': None}
+
+def configure(path, directory):
+    """Keep the indexes and statistics in a SQLite file and segments under `directory`"""
+    _config['path'] = path
+    _config['directory'] = directory
+
+def connect():
+    """Connection to the archive indexes and statistics, for modules that query them"""
+    return local_db.connect(_config['path'], SCHEMA)
+
+# Segments
+
+def _segment_name(shopping_list):
+    sent_at = shopping_list.sent_at
+    return f"{sent_at:%Y-%m}.jsonl.gz" if sent_at else 'undated.jsonl.gz'
+
+def _encode(shopping_list):
+    return json.dumps({
+        'timestamp': shopping_list.timestamp,
+        'date': shopping_list.date,
+        'items': [[item.item_id, item.name, item.category, item.quantity, item.unit_type]
+                  for item in shopping_list.items],
+    }, separators=(',', ':'))
+
+def _decode(line):
+    record = json.loads(line)
+    items = [dict(zip(('item_id', 'name', 'category', 'quantity', 'unit_type'), item)) for item in record['items']]
+    total = sum(item['quantity'] for item in items)
+    display = '; '.join(f"{item['name']} ({item['quantity']}{'kg' if item['unit_type'] == 'weight' else 'x'})"
+                        for item in items)
+    return history.ShoppingList.from_values(None, [record['timestamp'], record['date'], total, len(items),
+                                                   json.dumps(items), display])
+
+def archive_lists(lists):
+    """Append lists to their monthly segments, skipping ones already archived; returns how many were written"""
+    conn = connect()
+    archived = {row[0] for row in conn.execute('SELECT timestamp FROM archived_lists')}
+    by_segment = {}
+    for shopping_list in lists:
+        if shopping_list.timestamp and shopping_list.timestamp not in archived:
+            by_segment.setdefault(_segment_name(shopping_list), []).append(shopping_list)
+    if not by_segment:
+        return 0
+
+    os.makedirs(_config['directory'], exist_ok=True)
+    written = 0
+    for segment, segment_lists in sorted(by_segment.items()):
+        data = ''.join(_encode(shopping_list) + '\n' for shopping_list in segment_lists).encode('utf-8')
+        with open(os.path.join(_config['directory'], segment), 'ab') as f:
+            f.write(gzip.compress(data))
+            f.flush()
+            os.fsync(f.fileno())
+        with local_db.transaction(conn):
+            conn.executemany('INSERT OR IGNORE INTO archived_lists (timestamp, segment) VALUES (?, ?)',
+                             [(shopping_list.timestamp, segment) for shopping_list in segment_lists])
+        written += len(segment_lists)
+    return written
+
+def archived_timestamps():
+    return {row[0] for row in connect().execute('SELECT timestamp FROM archived_lists')}
+
+def iter_archived():
+    """Every archived ShoppingList, oldest segment first"""
+    directory = _config['directory']
+    if not directory or not os.path.isdir(directory):
+        return
+    for segment in sorted(os.listdir(directory)):
+        if not segment.endswith('.jsonl.gz'):
+            continue
+        with gzip.open(os.path.join(directory, segment), 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield _decode(line)
+
+# Per-item statistics
+
+def _lines(shopping_list):
+    """(key, item_id, name, quantity) per item line; lines without an ID are keyed by name"""
+    lines = {}
+    for item in shopping_list.items:
+        key = item.item_id or f'name:{item.name.strip().lower()}'
+        if key in lines:
+            lines[key][3] += item.quantity
+        else:
+            lines[key] = [key, item.item_id, item.name, item.quantity]
+    return list(lines.values())
+
+def recency_weight(timestamp):
+    """Weight one trip at `timestamp` adds to its items' recency score, 0 if it has no usable time"""
+    try:
+        days = (datetime.fromisoformat(timestamp) - EPOCH).total_seconds() / 86400
+    except (TypeError, ValueError):
+        return 0.0
+    return 2 ** (days / RECENCY_HALF_LIFE_DAYS)
+
+def _pairs(lines):
+    keys = [line[0] for line in lines]
+    return [(key, other) for key in keys for other in keys if key != other]
+
+def _add(conn, timestamp, lines):
+    if conn.execute('SELECT 1 FROM item_stats_lists WHERE timestamp = ?', (timestamp,)).fetchone():
+        return False
+    for key, item_id, name, quantity in lines:
+        conn.execute(
+            'INSERT INTO item_stats (key, item_id, name, trips, total_quantity, first_at, last_at) '
+            'VALUES (?, ?, ?, 1, ?, ?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET name = excluded.name, trips = trips + 1, '
+            'total_quantity = total_quantity + excluded.total_quantity, '
+            'first_at = MIN(first_at, excluded.first_at), '
+            'previous_at = CASE WHEN excluded.last_at >= last_at THEN last_at ELSE previous_at END, '
+            'last_at = MAX(last_at, excluded.last_at)',
+            (key, item_id, name, quantity, timestamp, timestamp))
+    weight = recency_weight(timestamp)
+    conn.executemany('INSERT INTO item_recency (key, weight) VALUES (?, ?) '
+                     'ON CONFLICT (key) DO UPDATE SET weight = weight + excluded.weight',
+                     [(line[0], weight) for line in lines])
+    conn.executemany('INSERT INTO item_pairs (key, other, trips) VALUES (?, ?, 1) '
+                     'ON CONFLICT (key, other) DO UPDATE SET trips = trips + 1', _pairs(lines))
+    conn.execute('INSERT INTO item_stats_lists (timestamp, lines) VALUES (?, ?)', (timestamp, json.dumps(lines)))
+    return True
+
+def _remove(conn, timestamp):
+    row = conn.execute('SELECT lines FROM item_stats_lists WHERE timestamp = ?', (timestamp,)).fetchone()
+    if not row:
+        return
+    lines = json.loads(row[0])
+    weight = recency_weight(timestamp)
+    conn.executemany('UPDATE item_recency SET weight = weight - ? WHERE key = ?', [(weight, line[0]) for line in lines])
+    conn.executemany('UPDATE item_pairs SET trips = trips - 1 WHERE key = ? AND other = ?', _pairs(lines))
+    conn.execute('DELETE FROM item_pairs WHERE trips <= 0')
+    for key, _, _, quantity in lines:
+        # Only the most recent list can be updated, so its trip is each item's last one
+        conn.execute('UPDATE item_stats SET trips = trips - 1, total_quantity = total_quantity - ?, '
+                     'last_at = CASE WHEN last_at = ? THEN COALESCE(previous_at, first_at) ELSE last_at END, '
+                     'previous_at = CASE WHEN last_at = ? THEN NULL ELSE previous_at END '
+                     'WHERE key = ?', (quantity, timestamp, timestamp, key))
+    conn.execute('DELETE FROM item_stats WHERE trips <= 0')
+    conn.execute('DELETE FROM item_recency WHERE key NOT IN (SELECT key FROM item_stats)')
+    conn.execute('DELETE FROM item_stats_lists WHERE timestamp = ?', (timestamp,))
+
+def record_list(shopping_list, replaces=None):
+    """Add a saved list to the statistics, first taking out the version it replaces; idempotent"""
+    if not shopping_list.timestamp:
+        return False
+    conn = connect()
+    with local_db.transaction(conn):
+        if replaces and replaces != shopping_list.timestamp:
+            _remove(conn, replaces)
+        return _add(conn, shopping_list.timestamp, _lines(shopping_list))
+
+def stats_built():
+    """True once the rolled-up tables have been built from the whole history at the current version"""
+    row = connect().execute("SELECT value FROM archive_state WHERE name = 'stats_version'").fetchone()
+    return row is not None and row[0] == str(STATS_VERSION)
+
+def rebuild_stats(lists):
+    """Recompute the statistics from every list (archived and live), oldest first"""
+    conn = connect()
+    with local_db.transaction(conn):
+        for table in ('item_stats', 'item_stats_lists', 'item_recency', 'item_pairs'):
+            conn.execute(f'DELETE FROM {table}')
+        for shopping_list in sorted(lists, key=lambda l: l.timestamp or ''):
+            if shopping_list.timestamp:
+                _add(conn, shopping_list.timestamp, _lines(shopping_list))
+        conn.execute("INSERT OR REPLACE INTO archive_state (name, value) VALUES ('stats_version', ?)",
+                     (str(STATS_VERSION),))
+
+def _days_between(start, end):
+    try:
+        return (datetime.fromisoformat(end) - datetime.fromisoformat(start)).total_seconds() / 86400
+    except (TypeError, ValueError):
+        return None
+
+def item_stats(item_ids=None, limit=None):
+    """Statistics per item, most bought first"""
+    query = 'SELECT item_id, name, trips, total_quantity, first_at, last_at FROM item_stats'
+    params = []
+    if item_ids:
+        query += f" WHERE item_id IN ({', '.join('?' * len(item_ids))})"
+        params.extend(item_ids)
+    query += ' ORDER BY trips DESC, total_quantity DESC, name'
+    if limit:
+        query += ' LIMIT ?'
+        params.append(limit)
+
+    result = []
+    for item_id, name, trips, total_quantity, first_at, last_at in connect().execute(query, params):
+        span = _days_between(first_at, last_at)
+        result.append({
+            'item_id': item_id,
+            'name': name,
+            'trips': trips,
+            'total_quantity': int(total_quantity) if total_quantity == int(total_quantity) else total_quantity,
+            'first_purchase': first_at,
+            'last_purchase': last_at,
+            'avg_interval_days': round(span / (trips - 1), 1) if span is not None and trips > 1 else None,
+        })
+    return result
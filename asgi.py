@@ -0,0 +1,84 @@
+"""Async serving mode: the same app behind an ASGI server.
+
+    gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+
+Live update streams (/api/stream) run on the worker's event loop and hold no
+thread while they wait for events, so a worker keeps dozens of them open at
+once. Every other route is the Flask view from app.py, run on a pool of
+ASGI_THREADS threads; their Sheets and Twilio calls already overlap through
+aio.gather, so the number of in-flight API requests is bounded by that pool
+rather than by the streams.
+"""
+import asyncio
+import os
+from urllib.parse import parse_qs
+
+from a2wsgi import WSGIMiddleware
+
+import aio
+import app as wsgi
+import events
+
+ASGI_THREADS = int(os.getenv('ASGI_THREADS', 32))
+
+_wsgi = WSGIMiddleware(wsgi.app, workers=ASGI_THREADS)
+
+def _last_event_id(scope):
+    """Last-Event-ID header, or the last_event_id query parameter, as an int"""
+    headers = dict(scope['headers'])
+    value = headers.get(b'last-event-id', b'').decode('latin-1')
+    if not value:
+        value = parse_qs(scope['query_string'].decode('latin-1')).get('last_event_id', [''])[0]
+    return int(value) if value.isdigit() else None
+
+async def _stream(scope, receive, send):
+    """Server-Sent Events without a thread per stream; same output as app.api_stream"""
+    loop = asyncio.get_running_loop()
+    subscription = events.AsyncSubscription(loop)
+    _, missed = await aio.run(events.subscribe, _last_event_id(scope), subscription)
+
+    async def _write(text, more=True):
+        await send({'type': 'http.response.body', 'body': text.encode('utf-8'), 'more_body': more})
+
+    # Stop as soon as the client goes away rather than at the next keepalive
+    disconnected = asyncio.Event()
+
+    async def _watch():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+
+    watcher = asyncio.create_task(_watch())
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ]})
+        # Ask the browser to wait a few seconds before reconnecting
+        await _write(f"retry: {wsgi.STREAM_RETRY_MS}\n\n")
+        if missed is None:
+            await _write("event: reload\ndata: {}\n\n", more=False)
+            return
+        for event in missed:
+            await _write(events.format_sse(event))
+
+        deadline = loop.time() + wsgi.STREAM_MAX_SECONDS
+        while not disconnected.is_set() and loop.time() < deadline:
+            event = await subscription.next(min(wsgi.STREAM_KEEPALIVE, deadline - loop.time()))
+            if subscription.overflowed:
+                await _write("event: reload\ndata: {}\n\n", more=False)
+                return
+            # A comment line keeps proxies from closing an idle connection
+            await _write(events.format_sse(event) if event else ": keepalive\n\n")
+        await _write("", more=False)
+    finally:
+        watcher.cancel()
+        events.unsubscribe(subscription)
+
+async def app(scope, receive, send):
+    """ASGI entry point"""
+    if scope['type'] == 'http' and scope['path'] == '/api/stream' and scope['method'] == 'GET':
+        await _stream(scope, receive, send)
+    else:
+        await _wsgi(scope, receive, send)
@@ -0,0 +1 @@
+"""Benchmarks for the Flask app, run with python -m benchmarks.run"""
@@ -0,0 +1,305 @@
+"""In-process stand-ins for gspread and the Twilio client.
+
+They keep the workbook in memory and behave like the real libraries as far
+as app.py is concerned, with knobs for what the real services do to us:
+per-call latency, the per-minute request quota (answered with a 429
+APIError, like Sheets), and randomly injected errors. Every call is counted
+so a benchmark can report API calls per request.
+"""
+import json
+import random
+import re
+import threading
+import time
+import types
+from datetime import datetime, timedelta
+
+import gspread
+from twilio.base.exceptions import TwilioRestException
+
+class FakeResponse:
+    """Enough of a requests.Response for gspread.exceptions.APIError"""
+
+    def __init__(self, status_code, message):
+        self.status_code = status_code
+        self.text = message
+
+    def json(self):
+        return {'error': {'code': self.status_code, 'message': self.text}}
+
+class Service:
+    """Latency, quota and error injection shared by every fake object of one service"""
+
+    def __init__(self, latency=0.0, jitter=0.0, quota_per_minute=None, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.quota_per_minute = quota_per_minute
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls = []
+        self._window = []
+        self._lock = threading.Lock()
+
+    def call(self, name, error):
+        """Record a call, then fail it or wait out its latency"""
+        with self._lock:
+            now = time.monotonic()
+            self.calls.append(name)
+            if self.quota_per_minute is not None:
+                self._window = [t for t in self._window if now - t < 60]
+                if len(self._window) >= self.quota_per_minute:
+                    raise error(429, 'Quota exceeded')
+                self._window.append(now)
+            if self.error_rate and self.random.random() < self.error_rate:
+                raise error(503, 'Injected failure')
+            delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+
+    def count(self):
+        with self._lock:
+            return len(self.calls)
+
+def _sheets_error(status, message):
+    return gspread.exceptions.APIError(FakeResponse(status, message))
+
+def _column_number(letters):
+    number = 0
+    for ch in letters:
+        number = number * 26 + ord(ch) - 64
+    return number
+
+def _parse_a1(a1):
+    match = re.match(r'([A-Z]*)(\d*)$', a1)
+    letters, digits = match.groups()
+    return (int(digits) if digits else None), (_column_number(letters) if letters else None)
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, title, rows):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.id = len(spreadsheet.sheets)
+        self.rows = [list(row) for row in rows]
+
+    def _call(self, name, write=False):
+        self.spreadsheet.service.call(f'{self.title}.{name}', _sheets_error)
+        if write:
+            self.spreadsheet.touch()
+
+    @property
+    def row_count(self):
+        return max(len(self.rows), 1000)
+
+    def _bounds(self, a1_range):
+        start, _, end = a1_range.partition(':')
+        (r1, c1), (r2, c2) = _parse_a1(start), _parse_a1(end or start)
+        return r1 or 1, c1 or 1, r2 or len(self.rows), c2 or 26
+
+    def _values(self, a1_range):
+        r1, c1, r2, c2 = self._bounds(a1_range)
+        values = [[str(value) for value in row[c1 - 1:c2]] for row in self.rows[r1 - 1:r2]]
+        # Like the API, trailing empty rows are not returned
+        while values and not any(values[-1]):
+            values.pop()
+        return values
+
+    def _set(self, row, col, value):
+        while len(self.rows) < row:
+            self.rows.append([])
+        cells = self.rows[row - 1]
+        while len(cells) < col:
+            cells.append('')
+        cells[col - 1] = value
+
+    def _write(self, a1_range, values):
+        r1, c1, _, _ = self._bounds(a1_range)
+        for i, row in enumerate(values):
+            for j, value in enumerate(row):
+                self._set(r1 + i, c1 + j, value)
+
+    def get_all_records(self, **kwargs):
+        self._call('get_all_records')
+        if not self.rows:
+            return []
+        headers = self.rows[0]
+        records = []
+        for row in self.rows[1:]:
+            row = list(row) + [''] * (len(headers) - len(row))
+            records.append({header: _numeric(value) for header, value in zip(headers, row)})
+        return records
+
+    def get_all_values(self, **kwargs):
+        self._call('get_all_values')
+        return [[str(value) for value in row] for row in self.rows]
+
+    def row_values(self, row, **kwargs):
+        self._call('row_values')
+        return [str(value) for value in self.rows[row - 1]] if row <= len(self.rows) else []
+
+    def col_values(self, col, **kwargs):
+        self._call('col_values')
+        values = [str(row[col - 1]) if len(row) >= col else '' for row in self.rows]
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def cell(self, row, col, **kwargs):
+        self._call('cell')
+        cells = self.rows[row - 1] if row <= len(self.rows) else []
+        return types.SimpleNamespace(row=row, col=col, value=cells[col - 1] if len(cells) >= col else '')
+
+    def get(self, a1_range=None, **kwargs):
+        self._call('get')
+        return self._values(a1_range) if a1_range else [[str(v) for v in row] for row in self.rows]
+
+    def batch_get(self, ranges, **kwargs):
+        self._call('batch_get')
+        return [self._values(a1_range) for a1_range in ranges]
+
+    def append_row(self, values, **kwargs):
+        self._call('append_row', write=True)
+        self.rows.append(list(values))
+        row = len(self.rows)
+        return {'updates': {'updatedRange': f"'{self.title}'!A{row}:F{row}"}}
+
+    def append_rows(self, values, **kwargs):
+        self._call('append_rows', write=True)
+        first = len(self.rows) + 1
+        self.rows.extend(list(row) for row in values)
+        return {'updates': {'updatedRange': f"'{self.title}'!A{first}:F{len(self.rows)}"}}
+
+    def update(self, a1_range, values=None, **kwargs):
+        self._call('update', write=True)
+        self._write(a1_range, values)
+
+    def update_cell(self, row, col, value):
+        self._call('update_cell', write=True)
+        self._set(row, col, value)
+
+    def delete_rows(self, start_index, end_index=None):
+        self._call('delete_rows', write=True)
+        del self.rows[start_index - 1:end_index or start_index]
+
+    def batch_update(self, data, **kwargs):
+        self._call('batch_update', write=True)
+        for update in data:
+            self._write(update['range'], update['values'])
+
+def _numeric(value):
+    """get_all_records turns numeric strings into numbers"""
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            try:
+                return float(value)
+            except ValueError:
+                return value
+    return value
+
+class FakeSpreadsheet:
+    id = 'benchmark-workbook'
+
+    def __init__(self, service, sheets):
+        self.service = service
+        self.sheets = {}
+        self.modified = datetime(2026, 1, 1)
+        for title, rows in sheets.items():
+            self.sheets[title] = FakeWorksheet(self, title, rows)
+
+    def touch(self):
+        self.modified += timedelta(microseconds=1)
+
+    def worksheet(self, title):
+        self.service.call('worksheet', _sheets_error)
+        if title not in self.sheets:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self.sheets[title]
+
+    def worksheets(self):
+        self.service.call('worksheets', _sheets_error)
+        return list(self.sheets.values())
+
+    def add_worksheet(self, title, rows, cols):
+        self.service.call('add_worksheet', _sheets_error)
+        self.sheets[title] = FakeWorksheet(self, title, [])
+        return self.sheets[title]
+
+    def values_batch_get(self, ranges, **kwargs):
+        self.service.call('values_batch_get', _sheets_error)
+        value_ranges = []
+        for a1_range in ranges:
+            title, _, cells = a1_range.partition('!')
+            sheet = self.sheets[title.strip("'")]
+            value_ranges.append({'range': a1_range,
+                                 'values': sheet._values(cells) if cells else sheet._values('A1:Z')})
+        return {'valueRanges': value_ranges}
+
+    def get_lastUpdateTime(self):
+        self.service.call('get_lastUpdateTime', _sheets_error)
+        return self.modified.isoformat() + 'Z'
+
+class FakeSheetsClient:
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+
+    def open(self, title):
+        self.spreadsheet.service.call('open', _sheets_error)
+        return self.spreadsheet
+
+    def open_by_key(self, key):
+        self.spreadsheet.service.call('open_by_key', _sheets_error)
+        return self.spreadsheet
+
+class FakeTwilioClient:
+    """twilio.rest.Client(account_sid, auth_token).messages.create(...)"""
+    service = Service()
+    sent = []
+
+    def __init__(self, account_sid=None, auth_token=None):
+        self.messages = self
+
+    def create(self, body, from_, to):
+        self.service.call('messages.create',
+                          lambda status, message: TwilioRestException(status, '/Messages.json', message))
+        FakeTwilioClient.sent.append(body)
+        return types.SimpleNamespace(sid=f'SM{len(FakeTwilioClient.sent):032d}')
+
+def make_workbook(service, items=300, categories=12, history_rows=50, seed=0):
+    """Spreadsheet with the app's three sheets filled with generated data"""
+    rng = random.Random(seed)
+    category_names = [f'Category {i}' for i in range(1, categories + 1)]
+
+    category_rows = [['Category', 'Aisle_Order']] + [[name, i] for i, name in enumerate(category_names, start=1)]
+    item_rows = [['Item', 'Category', 'Item_ID', 'Purchase_Count', 'Unit_Type']]
+    for i in range(1, items + 1):
+        item_rows.append([f'Item {i}', rng.choice(category_names), f'ID{i}', rng.randint(0, 50),
+                          'kg' if rng.random() < 0.2 else ''])
+
+    history_rows_values = [['Timestamp', 'Date', 'Total_Items', 'Unique_Items', 'Items_JSON', 'Items_Display']]
+    start = datetime(2024, 1, 1)
+    for i in range(history_rows):
+        sent_at = start + timedelta(hours=12 * i)
+        lines = [{'item_id': f'ID{rng.randint(1, items)}', 'name': 'Item', 'category': rng.choice(category_names),
+                  'quantity': rng.randint(1, 3), 'unit_type': 'quantity'} for _ in range(rng.randint(3, 20))]
+        history_rows_values.append([sent_at.isoformat(), sent_at.strftime('%Y-%m-%d %H:%M:%S'),
+                                    sum(line['quantity'] for line in lines), len(lines), json.dumps(lines),
+                                    '; '.join(f"Item ({line['quantity']}x)" for line in lines)])
+
+    return FakeSpreadsheet(service, {
+        'Items': item_rows,
+        'Categories': category_rows,
+        'Shopping_History': history_rows_values,
+    })
+
+def install(app_module, spreadsheet, twilio_service=None):
+    """Point app.py's gspread, oauth2client and Twilio entry points at the fakes"""
+    app_module.load_sheets_libraries()
+    app_module.ServiceAccountCredentials = types.SimpleNamespace(from_json_keyfile_name=lambda *args: object())
+    app_module.gspread.authorize = lambda credentials: FakeSheetsClient(spreadsheet)
+    FakeTwilioClient.service = twilio_service or Service()
+    app_module.Client = FakeTwilioClient
+    app_module.TWILIO_ACCOUNT_SID = 'ACbenchmark'
+    app_module.TWILIO_AUTH_TOKEN = 'benchmark'
+    app_module.TWILIO_WHATSAPP_FROM = 'whatsapp:+10000000000'
+    app_module.WHATSAPP_TO = 'whatsapp:+10000000001'
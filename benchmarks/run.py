@@ -0,0 +1,211 @@
+"""Benchmark the Flask routes against the in-process Sheets and Twilio fakes.
+
+    python -m benchmarks.run                          # print a report
+    python -m benchmarks.run --save benchmarks/baseline.json
+    python -m benchmarks.run --compare benchmarks/baseline.json
+
+Each scenario drives app.app through Flask's test client in one process, so
+requests/second is what a single sync gunicorn worker could serve. Queued
+send jobs are run inline and included in the send timings. API calls per
+request counts every fake Sheets and Twilio call the request made.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+SCENARIOS = ['items_cold', 'items_warm', 'add_item_burst', 'send_50', 'send_50_update', 'history_10k']
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+class Bench:
+    """The app wired to fresh fakes, plus helpers to time requests against it"""
+
+    def __init__(self, args):
+        from benchmarks import fakes
+
+        self.args = args
+        self.fakes = fakes
+        self.sheets = fakes.Service(latency=args.sheets_latency, jitter=args.sheets_latency / 2,
+                                    quota_per_minute=args.quota, error_rate=args.error_rate)
+        self.twilio = fakes.Service(latency=args.twilio_latency, jitter=args.twilio_latency / 2,
+                                    error_rate=args.error_rate)
+        self.workbook = fakes.make_workbook(self.sheets, items=args.items, history_rows=args.history)
+
+        import app
+        self.app = app
+        fakes.install(app, self.workbook, self.twilio)
+        self.client = app.app.test_client()
+
+    def api_calls(self):
+        return self.sheets.count() + self.twilio.count()
+
+    def reset_caches(self):
+        self.app.cache.clear()
+        self.app.search._current.update(version=None, index=None)
+        self.app._response_memo.clear()
+
+    def run(self, iterations, request, setup=None):
+        latencies = []
+        calls = []
+        errors = 0
+        started = time.perf_counter()
+        for i in range(iterations):
+            if setup:
+                setup(i)
+            before = self.api_calls()
+            t0 = time.perf_counter()
+            ok = request(i)
+            latencies.append((time.perf_counter() - t0) * 1000)
+            calls.append(self.api_calls() - before)
+            errors += 0 if ok else 1
+        elapsed = time.perf_counter() - started
+
+        return {
+            'iterations': iterations,
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+            'mean_ms': round(sum(latencies) / len(latencies), 3),
+            # Setup time is included, so this is a floor for a single worker
+            'requests_per_second': round(iterations / elapsed, 1),
+            'api_calls_per_request': round(sum(calls) / len(calls), 2),
+            'errors': errors,
+        }
+
+    def items_cold(self):
+        return self.run(self.args.iterations,
+                        lambda i: self.client.get('/api/items').status_code == 200,
+                        setup=lambda i: self.reset_caches())
+
+    def items_warm(self):
+        self.client.get('/api/items')
+        return self.run(self.args.iterations * 10,
+                        lambda i: self.client.get('/api/items').status_code == 200)
+
+    def add_item_burst(self):
+        self.client.get('/api/items')
+        return self.run(self.args.iterations,
+                        lambda i: self.client.post('/api/items', json={
+                            'item_name': f'Benchmark item {time.time_ns()}',
+                            'category': 'Category 1',
+                            'unit_type': 'quantity',
+                        }).status_code == 200)
+
+    def _selection(self, count=50):
+        items = self.client.get(f'/api/items?limit={count}').json['items']
+        return [dict(item, quantity=1 + i % 3) for i, item in enumerate(items)]
+
+    def _send(self, items, is_update):
+        response = self.client.post('/api/send-whatsapp', json={'items': items, 'is_update': is_update})
+        if response.status_code != 202:
+            return False
+        # Run the queued job here so the timing covers Twilio, history and counts
+        self.app.outbox.run_pending()
+        job = self.app.outbox.get_job(response.json['job_id'])
+        return job['status'] == 'done'
+
+    def send_50(self):
+        items = self._selection()
+        return self.run(self.args.iterations, lambda i: self._send(items, False))
+
+    def send_50_update(self):
+        items = self._selection()
+        self._send(items, False)
+
+        def _request(i):
+            items[i % len(items)]['quantity'] += 1
+            return self._send(items, True)
+
+        return self.run(self.args.iterations, _request)
+
+    def history_10k(self):
+        history = self.workbook.sheets['Shopping_History']
+        fresh = self.fakes.make_workbook(self.sheets, items=10, history_rows=10000)
+        history.rows = fresh.sheets['Shopping_History'].rows
+        self.app.history.reindex(history)
+        return self.run(self.args.iterations,
+                        lambda i: self.client.get('/api/history?limit=3').status_code == 200,
+                        setup=lambda i: self.reset_caches())
+
+def compare(results, baseline):
+    """Lines showing how each metric moved against the baseline"""
+    lines = []
+    for name, metrics in results['scenarios'].items():
+        base = baseline.get('scenarios', {}).get(name)
+        if not base:
+            lines.append(f'{name}: no baseline')
+            continue
+        parts = []
+        for metric in ('p50_ms', 'p99_ms', 'requests_per_second', 'api_calls_per_request'):
+            old, new = base.get(metric), metrics.get(metric)
+            if old:
+                parts.append(f'{metric} {old} -> {new} ({(new - old) / old * 100:+.1f}%)')
+            else:
+                parts.append(f'{metric} {old} -> {new}')
+        lines.append(f'{name}: ' + ', '.join(parts))
+    return lines
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+                        help=f"scenarios to run (default: all of {', '.join(SCENARIOS)})")
+    parser.add_argument('--iterations', type=int, default=30)
+    parser.add_argument('--items', type=int, default=300, help='rows in the Items sheet')
+    parser.add_argument('--history', type=int, default=50, help='rows in Shopping_History')
+    parser.add_argument('--sheets-latency', type=float, default=0.02, help='seconds per Sheets call')
+    parser.add_argument('--twilio-latency', type=float, default=0.05, help='seconds per Twilio call')
+    parser.add_argument('--quota', type=int, default=None, help='Sheets requests allowed per minute')
+    parser.add_argument('--rate-limit', type=float, default=0,
+                        help="the app's own Sheets requests per minute (default: off)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of API calls that fail')
+    parser.add_argument('--storage', choices=['sheets', 'sqlite'], default='sheets')
+    parser.add_argument('--save', metavar='PATH', help='write the results as a baseline')
+    parser.add_argument('--compare', metavar='PATH', help='show changes against a saved baseline')
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario: {', '.join(sorted(unknown))}")
+
+    # The app reads its configuration at import time
+    data_dir = tempfile.mkdtemp(prefix='shopping-bench-')
+    creds_file = os.path.join(data_dir, 'credentials.json')
+    with open(creds_file, 'w') as f:
+        f.write('{}')
+    os.environ.update(DATA_DIR=data_dir, OUTBOX_WORKERS='0', STORAGE_BACKEND=args.storage,
+                      SHEETS_SYNC='0', SHEETS_REQUESTS_PER_MINUTE=str(args.rate_limit),
+                      GOOGLE_SHEETS_CREDS_FILE=creds_file)
+
+    bench = Bench(args)
+    results = {
+        'settings': {key: value for key, value in vars(args).items()
+                     if key not in ('scenarios', 'save', 'compare')},
+        'scenarios': {},
+    }
+    for name in args.scenarios or SCENARIOS:
+        results['scenarios'][name] = getattr(bench, name)()
+        metrics = results['scenarios'][name]
+        print(f"{name:16} p50 {metrics['p50_ms']:9.2f} ms  p99 {metrics['p99_ms']:9.2f} ms  "
+              f"{metrics['requests_per_second']:8.1f} req/s  {metrics['api_calls_per_request']:6.2f} calls/req  "
+              f"errors {metrics['errors']}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            for line in compare(results, json.load(f)):
+                print(line)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,398 @@
+"""Stale-while-revalidate cache with write-through updates.
+
+Entries live in process memory. An optional shared backend (a directory of
+pickle files or a SQLite database) lets every gunicorn worker reuse one warm
+copy: each read does a cheap version check against the backend and only
+unpickles the payload when another worker has stored something newer.
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+
+try:
+    import fcntl
+except ImportError:  # Windows - the file backend falls back to no cross-process lock
+    fcntl = None
+
+MAX_STALE = 3600  # Serve stale data for up to an hour past its TTL while refreshing
+LOAD_TIMEOUT = 30  # Seconds a request waits on another thread's load of the same key
+REFRESH_WORKERS = 4
+
+_lock = threading.RLock()
+_entries = {}  # key -> {'data', 'fetched_at', 'modified_at', 'version', 'invalidated', 'token'}
+_inflight = {}  # key -> Future of the load currently running for that key
+_pending_patches = {}  # key -> updates made while a load was in flight
+_stats = {}
+_observers = []  # fn(key, stat, amount), e.g. per-request metrics
+_backend = None
+_executor = {'pid': None, 'pool': None}
+
+class Unavailable(Exception):
+    """Nothing is cached for a key and loading it failed"""
+
+class FileBackend:
+    """One pickle file per key in a shared directory"""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, f"{key}.pickle")
+
+    def token(self, key):
+        """Cheap change marker for a key, None if it is not stored"""
+        try:
+            stat = os.stat(self._file(key))
+            return (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            return None
+
+    def load(self, key):
+        try:
+            with open(self._file(key), 'rb') as f:
+                entry = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        entry['token'] = self.token(key)
+        return entry
+
+    def store(self, key, entry):
+        tmp_path = f"{self._file(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({k: v for k, v in entry.items() if k != 'token'}, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._file(key))
+        return self.token(key)
+
+    def delete(self, key=None):
+        keys = [key] if key else [name[:-7] for name in os.listdir(self.path) if name.endswith('.pickle')]
+        for k in keys:
+            try:
+                os.remove(self._file(k))
+            except FileNotFoundError:
+                pass
+
+    @contextmanager
+    def locked(self):
+        """Serialize read-modify-write cycles across processes"""
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.path, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+class SqliteBackend:
+    """Entries stored as pickled blobs in a shared SQLite database"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS cache ('
+                     'key TEXT PRIMARY KEY, version TEXT, fetched_at REAL, modified_at REAL, '
+                     'invalidated INTEGER DEFAULT 0, data BLOB)')
+
+    def _conn(self):
+        # One connection per thread, and never reuse one across a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def token(self, key):
+        row = self._conn().execute('SELECT version, invalidated FROM cache WHERE key = ?', (key,)).fetchone()
+        return tuple(row) if row else None
+
+    def load(self, key):
+        row = self._conn().execute(
+            'SELECT version, fetched_at, modified_at, invalidated, data FROM cache WHERE key = ?', (key,)).fetchone()
+        if not row:
+            return None
+        version, fetched_at, modified_at, invalidated, data = row
+        return {'data': pickle.loads(data), 'fetched_at': fetched_at, 'modified_at': modified_at, 'version': version,
+                'invalidated': bool(invalidated), 'token': (version, invalidated)}
+
+    def store(self, key, entry):
+        self._conn().execute(
+            'INSERT OR REPLACE INTO cache (key, version, fetched_at, modified_at, invalidated, data) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (key, entry['version'], entry['fetched_at'], entry['modified_at'], int(entry['invalidated']),
+             pickle.dumps(entry['data'], pickle.HIGHEST_PROTOCOL)))
+        return (entry['version'], int(entry['invalidated']))
+
+    def delete(self, key=None):
+        if key:
+            self._conn().execute('DELETE FROM cache WHERE key = ?', (key,))
+        else:
+            self._conn().execute('DELETE FROM cache')
+
+    @contextmanager
+    def locked(self):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')
+
+def configure(backend='memory', path=None):
+    """Select the shared backend: 'memory' (per worker), 'file' or 'sqlite'"""
+    global _backend
+    with _lock:
+        _entries.clear()
+        if backend == 'file':
+            _backend = FileBackend(path or 'cache')
+        elif backend == 'sqlite':
+            _backend = SqliteBackend(path or 'cache.sqlite3')
+        else:
+            _backend = None
+
+def _new_version():
+    return f"{time.time_ns():x}-{os.getpid():x}"
+
+def _get_executor():
+    """Refresh pool, recreated after a fork since threads do not survive it"""
+    with _lock:
+        if _executor['pid'] != os.getpid():
+            _executor['pool'] = ThreadPoolExecutor(max_workers=REFRESH_WORKERS,
+                                                   thread_name_prefix='cache-refresh')
+            _executor['pid'] = os.getpid()
+        return _executor['pool']
+
+def _record(key, name, amount=1):
+    with _lock:
+        stats = _stats.setdefault(key, {
+            'hits': 0, 'stale_hits': 0, 'misses': 0, 'refreshes': 0, 'errors': 0,
+            'writes': 0, 'backend_loads': 0, 'refresh_ms_total': 0.0, 'refresh_ms_max': 0.0,
+        })
+        stats[name] += amount
+        if name == 'refresh_ms_total':
+            stats['refresh_ms_max'] = max(stats['refresh_ms_max'], amount)
+    for observer in _observers:
+        observer(key, name, amount)
+
+def add_observer(fn):
+    """Call fn(key, stat, amount) for every hit, miss, refresh etc."""
+    _observers.append(fn)
+
+def _current_entry(key):
+    """Local entry for a key, replaced by the backend copy if another worker stored a newer one"""
+    entry = _entries.get(key)
+    if _backend is None:
+        return entry
+
+    try:
+        token = _backend.token(key)
+        if token is None or (entry is not None and entry.get('token') == token):
+            return entry
+        shared = _backend.load(key)
+    except Exception as e:
+        print(f"Error reading shared cache '{key}': {e}")
+        return entry
+
+    if shared is not None:
+        _record(key, 'backend_loads')
+        _entries[key] = shared
+        return shared
+    return entry
+
+def _store(key, data, fetched_at):
+    entry = {'data': data, 'fetched_at': fetched_at, 'modified_at': time.time(),
+             'version': _new_version(), 'invalidated': False}
+    if _backend is not None:
+        try:
+            entry['token'] = _backend.store(key, entry)
+        except Exception as e:
+            print(f"Error writing shared cache '{key}': {e}")
+    _entries[key] = entry
+    return entry
+
+def _run_load(key, loader, future):
+    """Run a loader for a key and publish its result to everyone waiting on it"""
+    started = time.time()
+    try:
+        data = loader()
+    except Exception as e:
+        print(f"Error refreshing cache '{key}': {e}")
+        _record(key, 'errors')
+        with _lock:
+            _inflight.pop(key, None)
+            _pending_patches.pop(key, None)
+        future.set_exception(e)
+        return
+
+    _record(key, 'refreshes')
+    _record(key, 'refresh_ms_total', (time.time() - started) * 1000)
+
+    with _lock:
+        # Re-apply writes that landed while the loader was reading the old data
+        for patch in _pending_patches.pop(key, []):
+            data = patch(data)
+        _store(key, data, started)
+        _inflight.pop(key, None)
+    future.set_result(data)
+
+def _load(key, loader, fallback):
+    """Blocking load for a miss; concurrent callers share one loader run
+
+    If the load fails, the fallback entry's data is served however old it is;
+    with no fallback the failure is raised as Unavailable.
+    """
+    with _lock:
+        future = _inflight.get(key)
+        owner = future is None
+        if owner:
+            future = Future()
+            _inflight[key] = future
+
+    if owner:
+        _run_load(key, loader, future)
+    try:
+        return future.result(timeout=LOAD_TIMEOUT)
+    except Exception as e:
+        if fallback is None:
+            raise Unavailable(f"Could not load {key}: {e}") from e
+        _record(key, 'stale_hits')
+        return fallback['data']
+
+def _refresh_in_background(key, loader):
+    """Start a refresh for a stale key unless one is already running"""
+    with _lock:
+        if key in _inflight:
+            return
+        future = Future()
+        _inflight[key] = future
+    _get_executor().submit(_run_load, key, loader, future)
+
+def fetch(key, loader, ttl, max_stale=MAX_STALE):
+    """Return cached data, serving stale data while one background refresh runs
+
+    Raises Unavailable if there is no cached data at all and the loader fails.
+    """
+    with _lock:
+        entry = _current_entry(key)
+
+    if entry is not None:
+        age = time.time() - entry['fetched_at']
+        if age < ttl and not entry['invalidated']:
+            _record(key, 'hits')
+            return entry['data']
+        if age < ttl + max_stale:
+            _record(key, 'stale_hits')
+            _refresh_in_background(key, loader)
+            return entry['data']
+
+    _record(key, 'misses')
+    return _load(key, loader, entry)
+
+def peek(key):
+    """Cached data for a key without loading or counting it, None if absent"""
+    with _lock:
+        entry = _current_entry(key)
+    return entry['data'] if entry is not None else None
+
+def get_version(key):
+    """Version string that changes whenever the cached data for a key changes"""
+    with _lock:
+        entry = _current_entry(key)
+    return entry['version'] if entry is not None else None
+
+def get_meta(key):
+    """(version, modified_at) of the cached data for a key, (None, None) if absent"""
+    with _lock:
+        entry = _current_entry(key)
+    if entry is None:
+        return None, None
+    return entry['version'], entry.get('modified_at')
+
+def update(key, patch):
+    """Apply a write to cached data in place of invalidating it.
+
+    `patch` takes the current data and returns the new data without mutating
+    its argument. It may run twice - once now and again on top of a refresh
+    that was already in flight - so it must be idempotent. Returns the new
+    version, or None if the key was not cached.
+    """
+    lock = _backend.locked() if _backend is not None else nullcontext()
+    with _lock, lock:
+        if key in _inflight:
+            _pending_patches.setdefault(key, []).append(patch)
+
+        entry = _current_entry(key)
+        if entry is None:
+            return None
+
+        new_entry = dict(entry, data=patch(entry['data']), modified_at=time.time(), version=_new_version())
+        if _backend is not None:
+            try:
+                new_entry['token'] = _backend.store(key, new_entry)
+            except Exception as e:
+                print(f"Error writing shared cache '{key}': {e}")
+        _entries[key] = new_entry
+        _record(key, 'writes')
+        return new_entry['version']
+
+def put(key, data, fetched_at=None):
+    """Cache data for a key that was loaded outside fetch(), e.g. by a batched read of several keys"""
+    with _lock:
+        _store(key, data, fetched_at or time.time())
+
+def invalidate(key=None):
+    """Mark a key (or everything) stale; the data is still served while it reloads"""
+    with _lock:
+        keys = [key] if key else list(_entries)
+        for k in keys:
+            entry = _entries.get(k)
+            if entry is None:
+                continue
+            entry = dict(entry, invalidated=True, version=_new_version())
+            if _backend is not None:
+                try:
+                    entry['token'] = _backend.store(k, entry)
+                except Exception as e:
+                    print(f"Error writing shared cache '{k}': {e}")
+            _entries[k] = entry
+
+def clear():
+    """Drop every entry locally and in the shared backend"""
+    with _lock:
+        _entries.clear()
+        if _backend is not None:
+            _backend.delete()
+
+def get_stats():
+    """Hit, miss and refresh latency counters per key for this worker"""
+    with _lock:
+        result = {}
+        for key, stats in _stats.items():
+            stats = dict(stats)
+            served = stats['hits'] + stats['stale_hits'] + stats['misses']
+            stats['hit_ratio'] = round((stats['hits'] + stats['stale_hits']) / served, 3) if served else None
+            stats['refresh_ms_avg'] = round(stats['refresh_ms_total'] / stats['refreshes'], 1) if stats['refreshes'] else None
+            stats['refresh_ms_total'] = round(stats['refresh_ms_total'], 1)
+            stats['refresh_ms_max'] = round(stats['refresh_ms_max'], 1)
+            entry = _entries.get(key)
+            stats['age_seconds'] = round(time.time() - entry['fetched_at'], 1) if entry else None
+            result[key] = stats
+        return {
+            'pid': os.getpid(),
+            'backend': type(_backend).__name__ if _backend is not None else 'memory',
+            'keys': result,
+        }
@@ -0,0 +1,174 @@
+"""Live update events for open pages, shared between gunicorn workers.
+
+publish() appends a small delta (item added, counts changed, history
+updated) to an events table in the local SQLite database. In every worker
+with open streams, one dispatcher thread polls the table for new rows and
+hands them to each subscriber's queue, so a change made in any worker
+reaches every browser tab.
+
+Streams served on an asyncio event loop (asgi.py) use AsyncSubscription,
+which the dispatcher thread hands events to through the loop.
+
+Event IDs are the table's row IDs. A reconnecting client sends the last one
+it saw and is replayed what it missed, or told to reload if those events
+were already pruned.
+"""
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+
+import local_db
+
+POLL_INTERVAL = 0.5  # Seconds between checks for events from other workers
+EVENTS_KEPT = 1000  # Rows kept for replay to reconnecting clients
+SUBSCRIBER_QUEUE_SIZE = 100  # A client further behind than this is told to reload
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, '
+    'payload TEXT NOT NULL, created_at REAL NOT NULL)',
+]
+
+_config = {'path': None}
+_subscribers = set()
+_lock = threading.Lock()
+_wakeup = threading.Event()
+_dispatcher = {'pid': None, 'thread': None, 'last_id': None}
+
+def configure(path):
+    """Point the event log at a SQLite file"""
+    _config['path'] = path
+
+def _conn():
+    return local_db.connect(_config['path'], SCHEMA)
+
+def publish(kind, payload):
+    """Broadcast an event to every open stream in every worker; returns its ID"""
+    conn = _conn()
+    with local_db.transaction(conn):
+        event_id = conn.execute('INSERT INTO events (kind, payload, created_at) VALUES (?, ?, ?)',
+                                (kind, json.dumps(payload, default=str), time.time())).lastrowid
+        conn.execute('DELETE FROM events WHERE id <= ?', (event_id - EVENTS_KEPT,))
+    # Streams in this worker need not wait for the next poll
+    _wakeup.set()
+    return event_id
+
+def _read_since(last_id, limit=500):
+    rows = _conn().execute('SELECT id, kind, payload FROM events WHERE id > ? ORDER BY id LIMIT ?',
+                           (last_id, limit)).fetchall()
+    return [{'id': event_id, 'kind': kind, 'data': json.loads(payload)} for event_id, kind, payload in rows]
+
+def _latest_id():
+    row = _conn().execute('SELECT MAX(id) FROM events').fetchone()
+    return row[0] or 0
+
+def _oldest_id():
+    row = _conn().execute('SELECT MIN(id) FROM events').fetchone()
+    return row[0]
+
+class Subscription:
+    """Queue of events for one open stream"""
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.overflowed = False
+
+    def deliver(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            # The stream tells the client to reload rather than dropping events silently
+            self.overflowed = True
+
+    def get(self, timeout):
+        """Next event, or None if none arrived within timeout"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+class AsyncSubscription(Subscription):
+    """Queue of events for one open stream served on an asyncio event loop"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.overflowed = False
+
+    def deliver(self, event):
+        # Runs on the dispatcher thread, and asyncio queues may only be touched from their loop
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # The loop has closed; the stream is gone
+            self.overflowed = True
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    async def next(self, timeout):
+        """Next event, or None if none arrived within timeout"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+def _dispatch_loop():
+    while True:
+        _wakeup.wait(POLL_INTERVAL)
+        _wakeup.clear()
+        # Held while delivering, so a new subscriber's replay position cannot fall between two batches
+        with _lock:
+            if not _subscribers:
+                _dispatcher['last_id'] = None
+                continue
+            try:
+                events = _read_since(_dispatcher['last_id'])
+            except Exception as e:
+                print(f"Error reading live update events: {e}")
+                continue
+            for event in events:
+                _dispatcher['last_id'] = event['id']
+                for subscription in _subscribers:
+                    subscription.deliver(event)
+
+def _start_dispatcher():
+    """Start this process's dispatcher thread once (again after a fork); caller holds the lock"""
+    if _dispatcher['pid'] == os.getpid():
+        return
+    _subscribers.clear()
+    _dispatcher.update(pid=os.getpid(), last_id=None)
+    _dispatcher['thread'] = threading.Thread(target=_dispatch_loop, name='events-dispatch', daemon=True)
+    _dispatcher['thread'].start()
+
+def subscribe(last_event_id=None, subscription=None):
+    """Open a subscription; returns (subscription, missed events), missed is None if the client must reload"""
+    subscription = subscription or Subscription()
+    with _lock:
+        _start_dispatcher()
+        if _dispatcher['last_id'] is None:
+            _dispatcher['last_id'] = _latest_id()
+        # Everything after this position arrives through the queue
+        position = _dispatcher['last_id']
+        _subscribers.add(subscription)
+
+    missed = []
+    if last_event_id is not None and last_event_id < position:
+        oldest = _oldest_id()
+        if oldest is None or oldest > last_event_id + 1:
+            return subscription, None
+        missed = [event for event in _read_since(last_event_id, limit=EVENTS_KEPT) if event['id'] <= position]
+    return subscription, missed
+
+def unsubscribe(subscription):
+    with _lock:
+        _subscribers.discard(subscription)
+
+def format_sse(event):
+    """One event in the text/event-stream wire format"""
+    return f"id: {event['id']}\nevent: {event['kind']}\ndata: {json.dumps(event['data'])}\n\n"
@@ -0,0 +1,25 @@
+"""Gunicorn settings, read automatically when gunicorn starts in this directory.
+
+The app is loaded once in the master and warmed up there (app.warm_up) before
+the workers fork, so each worker starts with the client libraries imported,
+the workbook ID known and the caches filled, instead of repeating that work
+on its first request. Each worker then opens its own workbook handle in the
+background, as handles cannot be shared across a fork.
+
+The async serving mode (gunicorn asgi:app -k uvicorn.workers.UvicornWorker)
+uses the same hooks; threads does not apply there, see asgi.py.
+"""
+import os
+
+worker_class = 'gthread'
+# Threads for API requests, plus one for each live update stream a worker accepts (app.api_stream)
+threads = int(os.getenv('WEB_THREADS', 8)) + int(os.getenv('STREAM_MAX_CONNECTIONS', 24))
+preload_app = True
+
+def when_ready(server):
+    import app
+    app.warm_up(preloading=True)
+
+def post_fork(server, worker):
+    import app
+    app.start_warm_up()
@@ -0,0 +1,257 @@
+"""Shopping_History model and bounded reads from the end of the sheet.
+
+History only ever grows, so instead of downloading the whole sheet we keep a
+local index of row number -> timestamp and fetch just the last few rows. Each
+tail read also asks for a few rows past the known end, which is how rows
+appended by other workers (or by hand) are noticed without a full download.
+
+Rows are decoded once into ShoppingList objects and kept by row number; the
+time-dependent fields (is_editable, minutes_ago) are only worked out when a
+response is built.
+"""
+import json
+import re
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+
+import local_db
+
+COLUMNS = ('A', 'F')  # Timestamp .. Items_Display
+TAIL_PROBE = 5  # Extra rows requested past the known end to spot new rows
+EDITABLE_MINUTES = 60  # The last list can be updated for this long after sending
+PARSED_ROWS_KEPT = 200  # Decoded rows kept in memory, counted back from the newest
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS history_index (row INTEGER PRIMARY KEY, timestamp TEXT NOT NULL)',
+]
+
+_config = {'path': None}
+_lock = threading.Lock()
+_parsed = {}  # row -> (raw values, ShoppingList)
+
+@dataclass(slots=True)
+class HistoryItem:
+    """One line of a saved shopping list"""
+    item_id: str
+    name: str
+    category: str
+    quantity: float
+    unit_type: str
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            item_id=data.get('item_id', ''),
+            name=data.get('name', ''),
+            category=data.get('category', ''),
+            quantity=data.get('quantity', 1),
+            unit_type=data.get('unit_type', 'quantity'),
+        )
+
+    def to_dict(self):
+        return {
+            'item_id': self.item_id,
+            'name': self.name,
+            'category': self.category,
+            'quantity': self.quantity,
+            'unit_type': self.unit_type,
+        }
+
+@dataclass(slots=True)
+class ShoppingList:
+    """A Shopping_History row, decoded once"""
+    row: int
+    timestamp: str
+    date: str
+    total_items: float
+    unique_items: int
+    items: tuple
+    display: str
+    sent_at: datetime = None
+
+    @classmethod
+    def from_values(cls, row, values):
+        """Decode a raw sheet row (Timestamp .. Items_Display)"""
+        values = list(values) + [''] * (6 - len(values))
+        timestamp, date, total_items, unique_items, items_json, display = values[:6]
+
+        try:
+            items = tuple(HistoryItem.from_dict(item) for item in json.loads(items_json or '[]'))
+        except (ValueError, TypeError, AttributeError):
+            items = ()
+
+        try:
+            sent_at = datetime.fromisoformat(timestamp) if timestamp else None
+        except ValueError:
+            sent_at = None
+
+        return cls(row=row, timestamp=timestamp, date=date, total_items=_number(total_items),
+                   unique_items=_number(unique_items), items=items, display=display, sent_at=sent_at)
+
+    def minutes_ago(self, now=None):
+        if self.sent_at is None:
+            return 999
+        return int(((now or datetime.now()) - self.sent_at).total_seconds() / 60)
+
+    def is_editable(self, now=None):
+        if self.sent_at is None:
+            return False
+        return ((now or datetime.now()) - self.sent_at).total_seconds() / 60 < EDITABLE_MINUTES
+
+    def quantities(self):
+        """Item ID -> quantity for the lines of this list"""
+        return {item.item_id: item.quantity for item in self.items if item.item_id}
+
+    def to_dict(self, now=None):
+        """API representation, with editability worked out as of now"""
+        now = now or datetime.now()
+        return {
+            'Timestamp': self.timestamp,
+            'Date': self.date,
+            'Total_Items': self.total_items,
+            'Unique_Items': self.unique_items,
+            'Items_Display': self.display,
+            'items': [item.to_dict() for item in self.items],
+            'is_editable': self.is_editable(now),
+            'minutes_ago': self.minutes_ago(now),
+        }
+
+def _number(value):
+    try:
+        return float(value) if '.' in str(value) else int(value)
+    except (TypeError, ValueError):
+        return 0
+
+def parse_row(row, values):
+    """ShoppingList for a row, reusing the decoded copy while the raw values are unchanged"""
+    values = tuple(values)
+    if row is None:
+        return ShoppingList.from_values(row, values)
+
+    with _lock:
+        cached = _parsed.get(row)
+        if cached is not None and cached[0] == values:
+            return cached[1]
+
+        shopping_list = ShoppingList.from_values(row, values)
+        _parsed[row] = (values, shopping_list)
+
+        # Only the newest rows are ever asked for again
+        if len(_parsed) > PARSED_ROWS_KEPT * 2:
+            newest = max(_parsed)
+            for old_row in [r for r in _parsed if r <= newest - PARSED_ROWS_KEPT]:
+                del _parsed[old_row]
+        return shopping_list
+
+def configure(path):
+    """Point the row index at a SQLite file"""
+    _config['path'] = path
+
+def _conn():
+    return local_db.connect(_config['path'], SCHEMA)
+
+def _last_indexed_row():
+    row = _conn().execute('SELECT MAX(row) FROM history_index').fetchone()
+    return row[0] if row and row[0] else None
+
+def reindex(sheet):
+    """Rebuild the index from the Timestamp column; returns the last data row"""
+    timestamps = sheet.col_values(1)
+    conn = _conn()
+    with local_db.transaction(conn):
+        conn.execute('DELETE FROM history_index')
+        conn.executemany('INSERT INTO history_index (row, timestamp) VALUES (?, ?)',
+                         [(row, ts) for row, ts in enumerate(timestamps, start=1) if row > 1 and ts])
+    # Header only (or an empty sheet) still counts as row 1
+    return max(len(timestamps), 1)
+
+def record_row(row, timestamp):
+    """Note a row we just wrote so the next tail read does not need to find it"""
+    if not row or not timestamp:
+        return
+    _conn().execute('INSERT OR REPLACE INTO history_index (row, timestamp) VALUES (?, ?)', (row, timestamp))
+
+def forget_rows(count):
+    """Shift the index up after the first `count` data rows were deleted from the sheet"""
+    if count <= 0:
+        return
+    conn = _conn()
+    with local_db.transaction(conn):
+        conn.execute('DELETE FROM history_index WHERE row < ?', (2 + count,))
+        # Through negative numbers, so no row collides with one not moved yet
+        conn.execute('UPDATE history_index SET row = -(row - ?)', (count,))
+        conn.execute('UPDATE history_index SET row = -row')
+    with _lock:
+        _parsed.clear()
+
+def appended_row_number(response):
+    """Row number from an append_row response ('Shopping_History!A12:F12' -> 12)"""
+    try:
+        updated_range = response['updates']['updatedRange']
+    except (KeyError, TypeError):
+        return None
+    match = re.search(r'![A-Z]+(\d+)', updated_range)
+    return int(match.group(1)) if match else None
+
+def _index_matches(start, values):
+    """True if the fetched rows agree with the timestamps we have indexed for them"""
+    known = dict(_conn().execute('SELECT row, timestamp FROM history_index WHERE row >= ?', (start,)).fetchall())
+    for offset, values_row in enumerate(values):
+        expected = known.get(start + offset)
+        if expected is not None and values_row and values_row[0] != expected:
+            return False
+    return True
+
+def _tail_bounds(last_row, count):
+    return max(2, last_row - count + 1), last_row + TAIL_PROBE
+
+def _is_stale(start, end, last_row, values):
+    """True if rows were deleted, rewritten or more were appended than the probe covers"""
+    fetched_last = start + len(values) - 1
+    return fetched_last < last_row or len(values) == end - start + 1 or not _index_matches(start, values)
+
+def _remember_tail(start, values, count):
+    rows = []
+    for offset, values_row in enumerate(values):
+        if values_row and values_row[0]:
+            row = start + offset
+            record_row(row, values_row[0])
+            rows.append((row, values_row))
+    return list(reversed(rows))[:count]
+
+def read_tail(sheet, count):
+    """Return up to `count` (row_number, values) pairs from the end of history, newest first"""
+    # No lock around the reads - they may wait on the Sheets rate limit, and a concurrent
+    # reindex writes the same rows from the same sheet
+    last_row = _last_indexed_row() or reindex(sheet)
+
+    for attempt in range(2):
+        start, end = _tail_bounds(last_row, count)
+        values = sheet.get(f'{COLUMNS[0]}{start}:{COLUMNS[1]}{end}')
+        if not _is_stale(start, end, last_row, values) or attempt == 1:
+            break
+        last_row = reindex(sheet)
+
+    return _remember_tail(start, values, count)
+
+def tail_range(count):
+    """A1 range holding the last `count` lists, None until the row index has been built"""
+    last_row = _last_indexed_row()
+    if not last_row:
+        return None
+    start, end = _tail_bounds(last_row, count)
+    return f'{COLUMNS[0]}{start}:{COLUMNS[1]}{end}'
+
+def lists_from_tail(a1_range, values, count):
+    """ShoppingLists from a tail_range() read made elsewhere, None if the index turned out stale"""
+    start, end = (int(re.sub(r'[A-Z]', '', bound)) for bound in a1_range.split(':'))
+    last_row = _last_indexed_row()
+    if not last_row or _is_stale(start, end, last_row, values):
+        return None
+    rows = _remember_tail(start, values, count)
+    return [parse_row(row, values_row) for row, values_row in rows]
+
+def recent_lists(sheet, count):
+    """Up to `count` most recent ShoppingLists, newest first"""
+    return [parse_row(row, values) for row, values in read_tail(sheet, count)]
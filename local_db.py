@@ -0,0 +1,55 @@
+"""Local SQLite connections for state shared between gunicorn workers.
+
+Connections are kept per thread and per process, so a connection opened in
+the gunicorn master is never reused by a forked worker.
+"""
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+_local = threading.local()
+
+def connect(path, schema=()):
+    """Return this thread's connection to `path`, creating the schema on first use"""
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.conns = {}
+        _local.applied = set()
+
+    conn = _local.conns.get(path)
+    if conn is None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # Autocommit mode - multi-statement writes use transaction()
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        _local.conns[path] = conn
+
+    # Several modules share one database file, each bringing its own tables
+    for statement in schema:
+        if (path, statement) not in _local.applied:
+            conn.execute(statement)
+            _local.applied.add((path, statement))
+    return conn
+
+@contextmanager
+def transaction(conn):
+    """Exclusive write transaction, serialized across processes"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    else:
+        conn.execute('COMMIT')
+
+def close_all():
+    """Close this thread's connections, e.g. in a process about to fork"""
+    for conn in getattr(_local, 'conns', {}).values():
+        conn.close()
+    _local.conns = {}
@@ -0,0 +1,294 @@
+"""Timing spans, counters and the Prometheus /metrics text.
+
+Every Sheets and Twilio call goes through an Instrumented proxy that times
+it as a span. Spans and cache events are collected per request (or per
+outbox job) in a thread-local scope, which feeds the Server-Timing header,
+the slow-request log and the process counters.
+
+Counters are kept in memory and flushed every few seconds into the local
+SQLite database, where /metrics adds up the numbers of all gunicorn workers.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import local_db
+
+FLUSH_INTERVAL = 5  # Seconds between flushes of this worker's counters
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS metrics (name TEXT NOT NULL, labels TEXT NOT NULL, value REAL NOT NULL, '
+    'PRIMARY KEY (name, labels))',
+]
+
+HELP = {
+    'http_requests_total': ('counter', 'Requests handled, by route, method and status'),
+    'http_request_duration_seconds': ('histogram', 'Request duration, by route'),
+    'external_calls_total': ('counter', 'Sheets and Twilio API calls, by route, service and call'),
+    'external_call_errors_total': ('counter', 'Sheets and Twilio API calls that raised'),
+    'external_call_duration_seconds': ('histogram', 'Sheets and Twilio API call duration, by service and call'),
+    'cache_events_total': ('counter', 'Cache hits, stale hits, misses and errors, by key'),
+    'rate_limit_wait_seconds': ('histogram', 'Time calls waited for a rate limit token, by service and priority'),
+    'rate_limit_retries_total': ('counter', 'Calls retried after a 429, by service and call'),
+    'coalesced_calls_total': ('counter', 'Reads answered by an identical read already in flight'),
+}
+
+log = logging.getLogger('shopping_list.metrics')
+
+_config = {'path': None, 'slow_ms': 1000}
+_local = threading.local()
+_lock = threading.Lock()
+_pending = {}  # (name, labels) -> value not yet flushed
+_flushed = {'at': 0.0, 'pid': None}
+
+def configure(path, slow_ms=1000):
+    """Store counters in a SQLite file; requests slower than slow_ms are logged"""
+    _config['path'] = path
+    _config['slow_ms'] = slow_ms
+
+def _labels(**labels):
+    return json.dumps(labels, sort_keys=True)
+
+def _add(name, amount=1, **labels):
+    with _lock:
+        key = (name, _labels(**labels))
+        _pending[key] = _pending.get(key, 0) + amount
+
+def _observe(name, seconds, **labels):
+    """Histogram observation: cumulative buckets, sum and count"""
+    for bound in DURATION_BUCKETS:
+        if seconds <= bound:
+            _add(f'{name}_bucket', le=str(bound), **labels)
+    _add(f'{name}_bucket', le='+Inf', **labels)
+    _add(f'{name}_sum', seconds, **labels)
+    _add(f'{name}_count', **labels)
+
+@contextmanager
+def scope(route):
+    """Collect spans and cache events for one request or job on this thread"""
+    current = {'route': route, 'started': time.perf_counter(), 'spans': [], 'cache': {}, 'waits': {}}
+    previous = getattr(_local, 'scope', None)
+    _local.scope = current
+    try:
+        yield current
+    finally:
+        _local.scope = previous
+
+def begin(route):
+    """Start a request scope (paired with end() from Flask hooks)"""
+    _local.scope = {'route': route, 'started': time.perf_counter(), 'spans': [], 'cache': {}, 'waits': {}}
+
+def end():
+    """Finish the current request scope and return it, None if none was started"""
+    current = getattr(_local, 'scope', None)
+    _local.scope = None
+    return current
+
+def current_scope():
+    return getattr(_local, 'scope', None)
+
+@contextmanager
+def attached(current):
+    """Record this thread's calls in another thread's scope, e.g. for calls run concurrently"""
+    previous = getattr(_local, 'scope', None)
+    _local.scope = current
+    try:
+        yield current
+    finally:
+        _local.scope = previous
+
+def current_route():
+    current = getattr(_local, 'scope', None)
+    return current['route'] if current else 'background'
+
+@contextmanager
+def span(service, call, detail=''):
+    """Time one external call"""
+    started = time.perf_counter()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        route = current_route()
+        _add('external_calls_total', route=route, service=service, call=call)
+        _observe('external_call_duration_seconds', seconds, service=service, call=call)
+        if error is not None:
+            _add('external_call_errors_total', route=route, service=service, call=call)
+
+        current = getattr(_local, 'scope', None)
+        if current is not None:
+            current['spans'].append({
+                'service': service,
+                'call': f'{detail}.{call}' if detail else call,
+                'ms': round(seconds * 1000, 2),
+                'error': type(error).__name__ if error is not None else None,
+            })
+
+class Instrumented:
+    """Proxy that times every public method call of the wrapped object as a span"""
+
+    def __init__(self, target, service, detail=''):
+        self._target = target
+        self._service = service
+        self._detail = detail
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def _timed(*args, **kwargs):
+            with span(self._service, name, self._detail):
+                return attr(*args, **kwargs)
+
+        return _timed
+
+def job(kind, handler):
+    """Wrap an outbox handler so its calls are collected and logged like a request's"""
+    def _run(payload, step):
+        with scope(f'job:{kind}') as current:
+            try:
+                result = handler(payload, step)
+            except Exception as e:
+                finish_job(current, kind, e)
+                raise
+            finish_job(current, kind)
+            return result
+
+    return _run
+
+def record_wait(service, priority, seconds):
+    """Time a call spent waiting for a rate limit token"""
+    _observe('rate_limit_wait_seconds', seconds, service=service, priority=priority)
+    current = getattr(_local, 'scope', None)
+    if current is not None:
+        current['waits'][service] = current['waits'].get(service, 0.0) + seconds * 1000
+
+def record_retry(service, call):
+    _add('rate_limit_retries_total', route=current_route(), service=service, call=call)
+
+def record_coalesced(service, call):
+    _add('coalesced_calls_total', route=current_route(), service=service, call=call)
+
+def record_cache_event(key, event, amount=1):
+    """cache.py observer: count hits and misses for the process and the current request"""
+    if event not in ('hits', 'stale_hits', 'misses', 'errors'):
+        return
+    _add('cache_events_total', amount, key=key, event=event)
+    current = getattr(_local, 'scope', None)
+    if current is not None:
+        current['cache'][event] = current['cache'].get(event, 0) + amount
+
+def finish_request(current, method, status):
+    """Count a finished request; returns its Server-Timing header value"""
+    seconds = time.perf_counter() - current['started']
+    _add('http_requests_total', route=current['route'], method=method, status=str(status))
+    _observe('http_request_duration_seconds', seconds, route=current['route'])
+
+    if seconds * 1000 >= _config['slow_ms']:
+        log_slow(current, seconds, method=method, status=status)
+    flush()
+    return server_timing(current, seconds)
+
+def finish_job(current, kind, error=None):
+    """Log a slow outbox job the same way as a slow request"""
+    seconds = time.perf_counter() - current['started']
+    if seconds * 1000 >= _config['slow_ms']:
+        log_slow(current, seconds, job=kind, error=str(error) if error else None)
+    flush()
+
+def server_timing(current, seconds):
+    """Server-Timing value: total, then time and call count per external service"""
+    services = {}
+    for s in current['spans']:
+        ms, calls = services.get(s['service'], (0.0, 0))
+        services[s['service']] = (ms + s['ms'], calls + 1)
+
+    parts = [f'app;dur={seconds * 1000:.1f}']
+    for service, (ms, calls) in services.items():
+        parts.append(f'{service};dur={ms:.1f};desc="{calls} calls"')
+    for service, ms in current['waits'].items():
+        parts.append(f'{service}-quota;dur={ms:.1f};desc="rate limit wait"')
+    if current['cache']:
+        desc = ' '.join(f'{event}={count}' for event, count in sorted(current['cache'].items()))
+        parts.append(f'cache;desc="{desc}"')
+    return ', '.join(parts)
+
+def log_slow(current, seconds, **fields):
+    """One JSON line per slow request or job, with each external call"""
+    record = {
+        'event': 'slow_request',
+        'route': current['route'],
+        'duration_ms': round(seconds * 1000, 1),
+        'external_ms': round(sum(s['ms'] for s in current['spans']), 1),
+        'calls': current['spans'],
+        'cache': current['cache'],
+        'rate_limit_wait_ms': {service: round(ms, 1) for service, ms in current['waits'].items()},
+        'pid': os.getpid(),
+    }
+    record.update(fields)
+    log.warning(json.dumps(record, default=str))
+
+def flush(force=False):
+    """Add this worker's counters to the shared totals, at most every FLUSH_INTERVAL seconds"""
+    now = time.time()
+    if not force and now - _flushed['at'] < FLUSH_INTERVAL:
+        return
+    with _lock:
+        if _flushed['pid'] != os.getpid():
+            # Counts from before a fork belong to the parent
+            if _flushed['pid'] is not None:
+                _pending.clear()
+            _flushed['pid'] = os.getpid()
+        pending = list(_pending.items())
+        _pending.clear()
+        _flushed['at'] = now
+    if not pending or not _config['path']:
+        return
+
+    try:
+        conn = local_db.connect(_config['path'], SCHEMA)
+        with local_db.transaction(conn):
+            conn.executemany('INSERT INTO metrics (name, labels, value) VALUES (?, ?, ?) '
+                             'ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value',
+                             [(name, labels, value) for (name, labels), value in pending])
+    except Exception as e:
+        print(f"Error flushing metrics: {e}")
+        # Keep the counts for the next flush
+        with _lock:
+            for key, value in pending:
+                _pending[key] = _pending.get(key, 0) + value
+
+def _format_labels(labels):
+    labels = json.loads(labels)
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+def render_prometheus():
+    """All workers' counters in the Prometheus text exposition format"""
+    flush(force=True)
+    rows = local_db.connect(_config['path'], SCHEMA).execute(
+        'SELECT name, labels, value FROM metrics ORDER BY name, labels').fetchall()
+
+    lines = []
+    described = set()
+    for name, labels, value in rows:
+        family = next((f for f in HELP if name == f or name.startswith(f + '_')), None)
+        if family and family not in described:
+            kind, text = HELP[family]
+            lines.append(f'# HELP {family} {text}')
+            lines.append(f'# TYPE {family} {kind}')
+            described.add(family)
+        number = int(value) if value == int(value) else value
+        lines.append(f'{name}{_format_labels(labels)} {number}')
+    return '\n'.join(lines) + '\n'
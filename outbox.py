@@ -0,0 +1,240 @@
+"""Durable outbox for work that should not hold up a request.
+
+Jobs are persisted in the local SQLite database and run by a small pool of
+background threads in every worker. Jobs in the same queue run one at a time
+in the order they were enqueued; different queues run in parallel. A job's
+handler splits its work into named steps whose results are stored as they
+complete, so a retried job picks up after the last finished step instead of
+repeating it.
+
+A running job is leased to its worker, and the lease is renewed for as long
+as the worker process is alive, so a job held up by a slow step is never
+handed to a second worker. Only the job of a worker that died is picked up
+again, once its lease runs out.
+"""
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+import local_db
+
+MAX_ATTEMPTS = 6
+BACKOFF_BASE = 2  # Seconds before the first retry, doubled on each attempt
+BACKOFF_MAX = 300
+LEASE_SECONDS = 120  # A running job whose worker died is picked up again after this
+LEASE_RENEW_INTERVAL = 30  # Seconds between lease renewals of the jobs a process is running
+POLL_INTERVAL = 1.0
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS jobs ('
+    'id TEXT PRIMARY KEY, queue TEXT NOT NULL, kind TEXT NOT NULL, payload TEXT NOT NULL, '
+    'status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, steps TEXT NOT NULL DEFAULT \'{}\', '
+    'result TEXT, error TEXT, next_attempt_at REAL NOT NULL, locked_until REAL, '
+    'created_at REAL NOT NULL, updated_at REAL NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS idx_jobs_queue_status ON jobs (queue, status, created_at)',
+]
+
+_handlers = {}
+_config = {'path': None, 'workers': 2}
+_workers = {'pid': None, 'threads': []}
+_leases = {'pid': None, 'held': set()}
+_wakeup = threading.Event()
+_lock = threading.Lock()
+
+class JobStep:
+    """Handle passed to job handlers for recording finished steps"""
+
+    def __init__(self, job_id, steps):
+        self.job_id = job_id
+        self.steps = steps
+        # Independent steps may run concurrently, each recording its result when done
+        self._lock = threading.Lock()
+
+    def run(self, name, fn):
+        """Run a step once; a retry returns the stored result instead of re-running it"""
+        if name in self.steps:
+            return self.steps[name]
+
+        result = fn()
+        with self._lock:
+            self.steps[name] = result
+            conn = _conn()
+            now = time.time()
+            conn.execute('UPDATE jobs SET steps = ?, locked_until = ?, updated_at = ? WHERE id = ?',
+                         (json.dumps(self.steps), now + LEASE_SECONDS, now, self.job_id))
+        return result
+
+def configure(path, workers=2):
+    """Point the outbox at a SQLite file and set the worker pool size"""
+    _config['path'] = path
+    _config['workers'] = workers
+
+def register(kind, handler, queue=None):
+    """Register handler(payload, step) for a job kind; the return value is the job result"""
+    _handlers[kind] = (handler, queue or kind)
+
+def _conn():
+    return local_db.connect(_config['path'], SCHEMA)
+
+def enqueue(kind, payload, idempotency_key=None, delay=0):
+    """Persist a job and wake the workers; the same idempotency key returns the existing job"""
+    _, queue = _handlers[kind]
+    job_id = idempotency_key or uuid.uuid4().hex
+    now = time.time()
+
+    conn = _conn()
+    cursor = conn.execute(
+        'INSERT OR IGNORE INTO jobs (id, queue, kind, payload, status, next_attempt_at, created_at, updated_at) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        (job_id, queue, kind, json.dumps(payload), 'queued', now + delay, now, now))
+    created = cursor.rowcount == 1
+
+    start_workers()
+    _wakeup.set()
+    return job_id, created
+
+def get_job(job_id):
+    """Status, progress and result of a job, None if it does not exist"""
+    row = _conn().execute(
+        'SELECT id, kind, status, attempts, steps, result, error, next_attempt_at, created_at, updated_at '
+        'FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    if not row:
+        return None
+
+    job_id, kind, status, attempts, steps, result, error, next_attempt_at, created_at, updated_at = row
+    return {
+        'id': job_id,
+        'kind': kind,
+        'status': status,
+        'attempts': attempts,
+        'completed_steps': list(json.loads(steps)),
+        'result': json.loads(result) if result else None,
+        'error': error,
+        'next_attempt_at': next_attempt_at if status == 'retry' else None,
+        'created_at': created_at,
+        'updated_at': updated_at,
+    }
+
+def is_running(queue):
+    """Whether a job of the queue is running in a live worker (its lease has not run out)"""
+    row = _conn().execute("SELECT 1 FROM jobs WHERE queue = ? AND status = 'running' AND locked_until >= ? LIMIT 1",
+                          (queue, time.time())).fetchone()
+    return row is not None
+
+def is_waiting(queue):
+    """Whether a job of the queue is queued or waiting to be retried"""
+    row = _conn().execute("SELECT 1 FROM jobs WHERE queue = ? AND status IN ('queued', 'retry') LIMIT 1",
+                          (queue,)).fetchone()
+    return row is not None
+
+def _renew_leases():
+    while True:
+        time.sleep(LEASE_RENEW_INTERVAL)
+        try:
+            with _lock:
+                held = list(_leases['held'])
+            if held:
+                placeholders = ', '.join('?' * len(held))
+                _conn().execute(f"UPDATE jobs SET locked_until = ? WHERE status = 'running' AND id IN ({placeholders})",
+                                [time.time() + LEASE_SECONDS] + held)
+        except Exception as e:
+            print(f"Error renewing job leases: {e}")
+
+def _hold(job_id):
+    """Keep renewing a claimed job's lease until it is released (again after a fork)"""
+    with _lock:
+        if _leases['pid'] != os.getpid():
+            _leases['pid'] = os.getpid()
+            _leases['held'] = set()
+            threading.Thread(target=_renew_leases, name='outbox-leases', daemon=True).start()
+        _leases['held'].add(job_id)
+
+def _release(job_id):
+    with _lock:
+        _leases['held'].discard(job_id)
+
+def _claim():
+    """Lease the oldest due job of any queue that has nothing running"""
+    now = time.time()
+    conn = _conn()
+    with local_db.transaction(conn):
+        # Oldest unfinished job per queue; later jobs wait behind it to keep order
+        row = conn.execute(
+            'SELECT id, kind, payload, steps, attempts FROM jobs AS j '
+            'WHERE j.created_at = (SELECT MIN(created_at) FROM jobs AS o '
+            "  WHERE o.queue = j.queue AND o.status IN ('queued', 'retry', 'running')) "
+            "AND (j.status IN ('queued', 'retry') OR (j.status = 'running' AND j.locked_until < ?)) "
+            'AND j.next_attempt_at <= ? '
+            'ORDER BY j.created_at LIMIT 1', (now, now)).fetchone()
+        if not row:
+            return None
+
+        job_id, kind, payload, steps, attempts = row
+        conn.execute("UPDATE jobs SET status = 'running', attempts = ?, locked_until = ?, updated_at = ? WHERE id = ?",
+                     (attempts + 1, now + LEASE_SECONDS, now, job_id))
+    return job_id, kind, json.loads(payload), json.loads(steps), attempts + 1
+
+def _finish(job_id, result):
+    _conn().execute("UPDATE jobs SET status = 'done', result = ?, error = NULL, locked_until = NULL, "
+                    'updated_at = ? WHERE id = ?', (json.dumps(result), time.time(), job_id))
+
+def _fail(job_id, attempts, error):
+    now = time.time()
+    if attempts >= MAX_ATTEMPTS:
+        _conn().execute("UPDATE jobs SET status = 'failed', error = ?, locked_until = NULL, updated_at = ? "
+                        'WHERE id = ?', (str(error), now, job_id))
+        return
+
+    # Exponential backoff with jitter so retries from several workers spread out
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempts - 1)) * random.uniform(0.5, 1.5)
+    _conn().execute("UPDATE jobs SET status = 'retry', error = ?, next_attempt_at = ?, locked_until = NULL, "
+                    'updated_at = ? WHERE id = ?', (str(error), now + delay, now, job_id))
+
+def run_pending():
+    """Run due jobs until none are left; returns how many ran"""
+    ran = 0
+    while True:
+        claimed = _claim()
+        if not claimed:
+            return ran
+
+        job_id, kind, payload, steps, attempts = claimed
+        handler, _ = _handlers.get(kind, (None, None))
+        _hold(job_id)
+        try:
+            if handler is None:
+                raise RuntimeError(f"No handler registered for job kind '{kind}'")
+            result = handler(payload, JobStep(job_id, steps))
+        except Exception as e:
+            print(f"Error running job {job_id} ({kind}), attempt {attempts}: {e}")
+            _fail(job_id, attempts, e)
+        else:
+            _finish(job_id, result)
+        finally:
+            _release(job_id)
+        ran += 1
+
+def _worker_loop():
+    while True:
+        try:
+            if run_pending() == 0:
+                _wakeup.wait(POLL_INTERVAL)
+                _wakeup.clear()
+        except Exception as e:
+            print(f"Error in outbox worker: {e}")
+            time.sleep(POLL_INTERVAL)
+
+def start_workers():
+    """Start this process's worker threads once (again after a fork)"""
+    with _lock:
+        if _workers['pid'] == os.getpid():
+            return
+        _workers['pid'] = os.getpid()
+        _workers['threads'] = []
+        for i in range(_config['workers']):
+            thread = threading.Thread(target=_worker_loop, name=f'outbox-{i}', daemon=True)
+            thread.start()
+            _workers['threads'].append(thread)
@@ -0,0 +1,114 @@
+"""Append-only log of purchase count increments.
+
+Sends no longer read a count, add to it and write it back. Each trip
+appends one (trip, item, delta) row to the local database, which is atomic
+across workers, and a compaction job later folds the logged deltas into
+Purchase_Count in the store with one write. Until then, readers add the
+pending deltas to the stored counts.
+
+A trip can only be logged once per item, so a retried send job does not
+count twice. The trips logged are kept in their own table, which compaction
+leaves alone, so this holds after the trip's deltas have been folded in too.
+Compactions run one at a time (they share an outbox queue), and an
+interrupted one is resumed with the same batch rather than re-claimed.
+
+A compaction goes from running (batch claimed) to written (the store has
+the batch) to done (its deltas dropped). Pending totals leave out written
+batches, so a reader never adds a batch the store already has.
+"""
+import json
+import time
+import uuid
+
+import local_db
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS purchase_log ('
+    'id INTEGER PRIMARY KEY, trip TEXT NOT NULL, item_id TEXT NOT NULL, delta REAL NOT NULL, '
+    'created_at REAL NOT NULL, batch TEXT, UNIQUE (trip, item_id))',
+    'CREATE INDEX IF NOT EXISTS idx_purchase_log_batch ON purchase_log (batch)',
+    'CREATE TABLE IF NOT EXISTS purchase_log_trips ('
+    'trip TEXT NOT NULL, item_id TEXT NOT NULL, created_at REAL NOT NULL, PRIMARY KEY (trip, item_id))',
+    'CREATE TABLE IF NOT EXISTS purchase_log_compactions ('
+    'batch TEXT PRIMARY KEY, status TEXT NOT NULL, totals TEXT NOT NULL, started_at REAL NOT NULL, '
+    'finished_at REAL)',
+]
+
+_config = {'path': None}
+
+def configure(path):
+    """Point the log at a SQLite file"""
+    _config['path'] = path
+
+def _conn():
+    return local_db.connect(_config['path'], SCHEMA)
+
+def record(item_counts, trip=None):
+    """Log increments for one trip; returns the ones not already logged for it"""
+    trip = trip or uuid.uuid4().hex
+    now = time.time()
+    added = {}
+    conn = _conn()
+    with local_db.transaction(conn):
+        for item_id, delta in item_counts.items():
+            cursor = conn.execute('INSERT OR IGNORE INTO purchase_log_trips (trip, item_id, created_at) VALUES (?, ?, ?)',
+                                  (trip, item_id, now))
+            if cursor.rowcount == 1:
+                conn.execute('INSERT INTO purchase_log (trip, item_id, delta, created_at) VALUES (?, ?, ?, ?)',
+                             (trip, item_id, delta, now))
+                added[item_id] = delta
+    return added
+
+def pending_totals():
+    """Item ID -> sum of the deltas not yet folded into the store"""
+    rows = _conn().execute(
+        'SELECT item_id, SUM(delta) FROM purchase_log WHERE batch IS NULL OR batch NOT IN '
+        "(SELECT batch FROM purchase_log_compactions WHERE status = 'written') GROUP BY item_id").fetchall()
+    return {item_id: int(total) if total == int(total) else total for item_id, total in rows}
+
+def oldest_pending_id():
+    """ID of the oldest unclaimed delta, None if everything is claimed or folded"""
+    row = _conn().execute('SELECT MIN(id) FROM purchase_log WHERE batch IS NULL').fetchone()
+    return row[0] if row else None
+
+def state():
+    """(written compactions, compaction being written) - unchanged across a read means it was consistent"""
+    written, running = _conn().execute(
+        "SELECT COUNT(CASE WHEN status != 'running' THEN 1 END), COUNT(CASE WHEN status = 'running' THEN 1 END) "
+        'FROM purchase_log_compactions').fetchone()
+    return written, running > 0
+
+def claim():
+    """Claim every unclaimed delta for a compaction; {'batch', 'totals', 'written'} or None if there is nothing to do"""
+    conn = _conn()
+    with local_db.transaction(conn):
+        # A compaction that was interrupted is finished before a new one starts
+        row = conn.execute("SELECT batch, totals, status FROM purchase_log_compactions "
+                           "WHERE status IN ('running', 'written')").fetchone()
+        if row:
+            return {'batch': row[0], 'totals': json.loads(row[1]), 'written': row[2] == 'written'}
+
+        batch = uuid.uuid4().hex
+        conn.execute('UPDATE purchase_log SET batch = ? WHERE batch IS NULL', (batch,))
+        rows = conn.execute('SELECT item_id, SUM(delta) FROM purchase_log WHERE batch = ? GROUP BY item_id',
+                            (batch,)).fetchall()
+        if not rows:
+            return None
+
+        totals = {item_id: int(total) if total == int(total) else total for item_id, total in rows}
+        conn.execute("INSERT INTO purchase_log_compactions (batch, status, totals, started_at) VALUES (?, 'running', ?, ?)",
+                     (batch, json.dumps(totals), time.time()))
+    return {'batch': batch, 'totals': totals, 'written': False}
+
+def written(batch):
+    """Note that the store has a batch, so its deltas no longer count as pending"""
+    _conn().execute("UPDATE purchase_log_compactions SET status = 'written' WHERE batch = ? AND status = 'running'",
+                    (batch,))
+
+def finish(batch):
+    """Drop a batch's deltas once the store has them"""
+    conn = _conn()
+    with local_db.transaction(conn):
+        conn.execute('DELETE FROM purchase_log WHERE batch = ?', (batch,))
+        conn.execute("UPDATE purchase_log_compactions SET status = 'done', finished_at = ? WHERE batch = ?",
+                     (time.time(), batch))
@@ -0,0 +1,239 @@
+"""Quota-aware scheduling of Google Sheets API calls.
+
+Sheets allows about 60 requests per minute per user, shared by every worker,
+browser tab and background thread. Every call on a Scheduled handle:
+
+- takes a token from a bucket kept in the local SQLite database, so all
+  gunicorn workers draw from the same budget;
+- by priority class: writes may use the last token, reads made for a request
+  or job leave a reserve for writes, and background reads (cache refreshes,
+  sync polls) leave a larger one;
+- is retried on 429 with jittered exponential backoff, pausing the whole
+  bucket so other workers back off too;
+- if it is a read, is shared with identical reads already in flight in this
+  process instead of being sent again.
+"""
+import copy
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import local_db
+import metrics
+
+WRITE = 'write'
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+RANK = {WRITE: 0, INTERACTIVE: 1, BACKGROUND: 2}
+# Share of the bucket a class must leave for higher classes when taking a token
+RESERVE = {WRITE: 0.0, INTERACTIVE: 0.25, BACKGROUND: 0.5}
+# Seconds a call waits for a token before giving up
+MAX_WAIT = {WRITE: 60, INTERACTIVE: 15, BACKGROUND: 120}
+
+MAX_RETRIES = 5
+BACKOFF_BASE = 1  # Seconds before the first 429 retry, doubled on each attempt
+BACKOFF_MAX = 32
+
+# Calls that only read values, so identical concurrent ones can share one request
+READS = {
+    'get', 'batch_get', 'get_all_records', 'get_all_values', 'row_values', 'col_values', 'cell',
+    'values_batch_get', 'get_lastUpdateTime',
+}
+# Reads that return handles, which are not copied between callers
+HANDLE_READS = {'worksheet', 'worksheets', 'open', 'open_by_key'}
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS rate_limits (name TEXT PRIMARY KEY, tokens REAL NOT NULL, '
+    'updated_at REAL NOT NULL, blocked_until REAL NOT NULL DEFAULT 0)',
+]
+
+_config = {'path': None, 'name': 'sheets', 'per_minute': 60, 'burst': 20}
+_local = threading.local()
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+def configure(path, per_minute=60, burst=20, name='sheets'):
+    """Share a bucket of `per_minute` tokens (0 for no limit) through a SQLite file"""
+    _config.update(path=path, per_minute=per_minute, burst=max(1, burst), name=name)
+
+@contextmanager
+def priority(cls):
+    """Run calls made inside the block with the given priority class"""
+    previous = getattr(_local, 'priority', None)
+    _local.priority = cls
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+def explicit_priority():
+    """Class set with priority() on this thread, None if none was"""
+    return getattr(_local, 'priority', None)
+
+def current_priority(call):
+    """Explicit class if set, else writes first, then reads for requests and jobs, then the rest"""
+    explicit = explicit_priority()
+    if explicit:
+        return explicit
+    if call not in READS and call not in HANDLE_READS:
+        return WRITE
+    # Threads without a request or job scope are cache refreshes and the sync worker
+    return BACKGROUND if metrics.current_route() == 'background' else INTERACTIVE
+
+def _take(cls):
+    """Take a token if the class may; returns 0, or the seconds to wait before trying again"""
+    rate = _config['per_minute'] / 60
+    burst = _config['burst']
+    reserve = RESERVE[cls] * burst
+    now = time.time()
+
+    conn = local_db.connect(_config['path'], SCHEMA)
+    with local_db.transaction(conn):
+        row = conn.execute('SELECT tokens, updated_at, blocked_until FROM rate_limits WHERE name = ?',
+                           (_config['name'],)).fetchone()
+        tokens, updated_at, blocked_until = row if row else (burst, now, 0)
+        tokens = min(burst, tokens + max(0, now - updated_at) * rate)
+
+        if now < blocked_until:
+            wait = blocked_until - now
+        elif tokens - 1 >= reserve:
+            tokens -= 1
+            wait = 0
+        else:
+            wait = (reserve + 1 - tokens) / rate
+
+        conn.execute('INSERT OR REPLACE INTO rate_limits (name, tokens, updated_at, blocked_until) '
+                     'VALUES (?, ?, ?, ?)', (_config['name'], tokens, now, blocked_until))
+    return wait
+
+def acquire(cls):
+    """Wait for a token; returns the seconds waited"""
+    if not _config['per_minute'] or not _config['path']:
+        return 0
+
+    started = time.monotonic()
+    while True:
+        try:
+            wait = _take(cls)
+        except sqlite3.Error as e:
+            # Better to risk a 429 than to stop talking to Sheets
+            print(f"Error using shared rate limit, not waiting: {e}")
+            return time.monotonic() - started
+        if not wait:
+            return time.monotonic() - started
+
+        waited = time.monotonic() - started
+        if waited + wait > MAX_WAIT[cls]:
+            raise RuntimeError(f"{_config['name']} quota exhausted: no {cls} token within {MAX_WAIT[cls]}s")
+        # A little jitter so workers woken together do not all retry at once
+        time.sleep(wait * random.uniform(1, 1.2))
+
+def _block(seconds):
+    """Pause the whole bucket after a 429 so every worker backs off"""
+    if not _config['path']:
+        time.sleep(seconds)
+        return
+
+    now = time.time()
+    try:
+        conn = local_db.connect(_config['path'], SCHEMA)
+        with local_db.transaction(conn):
+            row = conn.execute('SELECT blocked_until FROM rate_limits WHERE name = ?',
+                               (_config['name'],)).fetchone()
+            blocked_until = max(row[0] if row else 0, now + seconds)
+            conn.execute('INSERT OR REPLACE INTO rate_limits (name, tokens, updated_at, blocked_until) '
+                         'VALUES (?, 0, ?, ?)', (_config['name'], now, blocked_until))
+    except sqlite3.Error as e:
+        print(f"Error using shared rate limit: {e}")
+        time.sleep(seconds)
+
+def is_rate_limited(error):
+    """True for a 429 Too Many Requests answer"""
+    return getattr(getattr(error, 'response', None), 'status_code', None) == 429
+
+def backoff_delay(attempt, error=None):
+    """Retry-After if the answer had one, else exponential backoff with jitter"""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    retry_after = headers.get('Retry-After')
+    if retry_after and str(retry_after).isdigit():
+        return float(retry_after)
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+def _run(fn, call):
+    cls = current_priority(call)
+    for attempt in range(MAX_RETRIES + 1):
+        waited = acquire(cls)
+        if waited:
+            metrics.record_wait(_config['name'], cls, waited)
+        try:
+            return fn()
+        except Exception as e:
+            if not is_rate_limited(e) or attempt == MAX_RETRIES:
+                raise
+            delay = backoff_delay(attempt, e)
+            print(f"Rate limited on {call}, retrying in {delay:.1f}s")
+            metrics.record_retry(_config['name'], call)
+            _block(delay)
+
+def _shared(key, fn, call):
+    """Run fn once for concurrent callers with the same key; each gets its own copy"""
+    cls = current_priority(call)
+    with _inflight_lock:
+        shared = _inflight.get(key)
+        owner = shared is None
+        if owner:
+            shared = _inflight[key] = {'future': Future(), 'waiters': 0, 'priority': cls}
+        elif RANK[shared['priority']] > RANK[cls]:
+            # Waiting on a lower class's read would inherit its wait for a token
+            shared = None
+        else:
+            shared['waiters'] += 1
+
+    if shared is None:
+        return fn()
+    if not owner:
+        metrics.record_coalesced(_config['name'], call)
+        return copy.deepcopy(shared['future'].result())
+
+    try:
+        result = fn()
+    except BaseException as e:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+        shared['future'].set_exception(e)
+        raise
+    with _inflight_lock:
+        _inflight.pop(key, None)
+    # The owner may modify its result, so waiting callers get a copy taken now
+    shared['future'].set_result(copy.deepcopy(result) if shared['waiters'] else None)
+    return result
+
+def call(fn, name, detail='', args=(), kwargs=None):
+    """Run one API call through the bucket, sharing identical concurrent reads"""
+    if name in READS:
+        # The pid keeps a forked worker from waiting on a read its parent had in flight
+        key = (os.getpid(), detail, name, repr(args), repr(sorted((kwargs or {}).items())))
+        return _shared(key, lambda: _run(fn, name), name)
+    return _run(fn, name)
+
+class Scheduled:
+    """Proxy that runs every public method call of the wrapped object through the scheduler"""
+
+    def __init__(self, target, detail=''):
+        self._target = target
+        self._detail = detail
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def _scheduled(*args, **kwargs):
+            return call(lambda: attr(*args, **kwargs), name, self._detail, args, kwargs)
+
+        return _scheduled
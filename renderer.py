@@ -0,0 +1,117 @@
+"""WhatsApp message rendering.
+
+A list is rendered as one block per category, built from the templates below
+with joins. Blocks are memoized by their content, so re-sending a list where
+only one aisle changed renders just that aisle again.
+
+Twilio rejects bodies over MAX_LENGTH characters, so a long list is packed
+into several messages, numbered in the title and sent in order. A category
+that does not fit in what is left of a message is continued in the next.
+
+Updates can be sent as just the changes against the previous list (added,
+removed and changed lines) rather than the whole list again.
+"""
+from functools import lru_cache
+
+MAX_LENGTH = 1600  # Twilio's limit for a WhatsApp message body, in characters
+
+TITLE = "🛒 *Shopping List{label}{part}*\n\n"
+PART = " ({number}/{total})"
+CATEGORY = "\n📍 *{category}*\n"
+CATEGORY_CONTINUED = "\n📍 *{category} (cont.)*\n"
+FOOTER = "\n✅ Happy shopping!"
+NO_CHANGES = "\nNo changes to the list.\n"
+
+LINE_WEIGHT = "  {mark} {name} - {quantity} kg\n"
+LINE_COUNT = "  {mark} {name} × {quantity}\n"
+LINE_SINGLE = "  {mark} {name}\n"
+LINE_REMOVED = "  ➖ ~{name}~\n"
+CHANGED_SUFFIX = " (was {old})"
+
+MARKS = {'listed': '•', 'added': '➕', 'changed': '✏️'}
+
+def _length(text):
+    # Counted in UTF-16 units like Twilio does, so each emoji counts as two
+    return len(text.encode('utf-16-le')) // 2
+
+def _line(name, quantity, unit_type, change='listed', old_quantity=None):
+    if change == 'removed':
+        return LINE_REMOVED.format(name=name)
+    mark = MARKS[change]
+    if unit_type == 'weight':
+        line = LINE_WEIGHT.format(mark=mark, name=name, quantity=quantity)
+    elif quantity > 1:
+        line = LINE_COUNT.format(mark=mark, name=name, quantity=quantity)
+    else:
+        line = LINE_SINGLE.format(mark=mark, name=name)
+    if change == 'changed':
+        line = line[:-1] + CHANGED_SUFFIX.format(old=old_quantity) + '\n'
+    return line
+
+@lru_cache(maxsize=1024)
+def _block_lines(entries):
+    """Rendered lines for one category's entries, memoized by content"""
+    return tuple(_line(*entry) for entry in entries)
+
+def _entry(item):
+    return (item.get('Item', 'Unknown'), item.get('quantity', 1), item.get('Unit_Type', 'quantity'),
+            item.get('change', 'listed'), item.get('old_quantity'))
+
+def _blocks(sorted_items):
+    """(category, lines) per run of items in the same category, in order"""
+    runs = []
+    for item in sorted_items:
+        category = item.get('Category', 'Other')
+        if not runs or runs[-1][0] != category:
+            runs.append((category, []))
+        runs[-1][1].append(_entry(item))
+    return [(category, _block_lines(tuple(entries))) for category, entries in runs]
+
+def _pack(blocks, label='', empty=''):
+    """Messages of at most MAX_LENGTH characters, titled and numbered if more than one"""
+    # Room for the longest title a part can get, and the footer on the last one
+    overhead = _length(TITLE.format(label=label, part=PART.format(number=99, total=99))) + _length(FOOTER)
+    budget = MAX_LENGTH - overhead
+
+    parts = [[]]
+    used = 0
+    for category, lines in blocks:
+        header = CATEGORY.format(category=category)
+        block = header + ''.join(lines)
+        if used + _length(block) <= budget:
+            parts[-1].append(block)
+            used += _length(block)
+            continue
+        # Fill the rest of this message and continue the category in the next
+        for line in lines:
+            if used and used + _length(header) + _length(line) > budget:
+                parts.append([])
+                used = 0
+                if not header:
+                    header = CATEGORY_CONTINUED.format(category=category)
+            if header:
+                parts[-1].append(header)
+                used += _length(header)
+                header = ''
+            parts[-1].append(line)
+            used += _length(line)
+
+    total = len(parts)
+    messages = []
+    for number, body in enumerate(parts, 1):
+        part = PART.format(number=number, total=total) if total > 1 else ''
+        messages.append(''.join([TITLE.format(label=label, part=part), ''.join(body) or empty,
+                                 FOOTER if number == total else '']))
+    return messages
+
+def render_list(sorted_items, is_update=False):
+    """Messages for a whole list of items already sorted by aisle"""
+    return _pack(_blocks(sorted_items), ' (UPDATED)' if is_update else '')
+
+def render_changes(sorted_changes):
+    """Messages for just the changed lines of an updated list, sorted by aisle.
+
+    Each change is an item with 'change' set to added, removed or changed;
+    changed items also carry their previous 'old_quantity'.
+    """
+    return _pack(_blocks(sorted_changes), ' (CHANGES)', NO_CHANGES)
@@ -0,0 +1,233 @@
+"""In-memory search index over the item catalog.
+
+The index is built from the cached items and rebuilt whenever their cache
+version changes. Names and categories are normalized (case folded, with
+Lithuanian and other diacritics removed) and every 1-3 character substring
+is indexed, so a search only touches the items that can match instead of
+scanning the whole catalog.
+
+Each sort order is kept as a sorted list of (key, position) pairs. Count
+changes and new items written through the cache move or insert single
+entries with bisect instead of rebuilding or re-sorting the index.
+
+A published index is never modified, as requests search it without a lock.
+Patches are made to a copy that shares every posting set and category list
+it does not change, and the copy replaces the current index.
+"""
+import bisect
+import threading
+import unicodedata
+
+NGRAM = 3
+MAX_LIMIT = 500
+SORTS = ('popularity', 'name', 'aisle')
+
+_lock = threading.Lock()
+_current = {'version': None, 'index': None}
+
+def normalize(text):
+    """Lowercase and strip diacritics, so 'Šaltibarščiai' matches 'saltibarsciai'"""
+    decomposed = unicodedata.normalize('NFKD', str(text or ''))
+    stripped = ''.join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return ' '.join(stripped.casefold().split())
+
+def _grams(text):
+    grams = set()
+    for size in range(1, NGRAM + 1):
+        for start in range(len(text) - size + 1):
+            grams.add(text[start:start + size])
+    return grams
+
+def to_int(value, default=0):
+    """Int from a sheet value that may be a number, a numeric string or blank"""
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return default
+
+class CatalogIndex:
+    """N-gram postings, category buckets and sorted orders for one catalog version"""
+
+    def __init__(self, items):
+        self.items = []
+        self.texts = []
+        self.postings = {}
+        self.by_category = {}
+        self.by_id = {}
+        self.by_name = {}
+        self.keys = {sort: [] for sort in SORTS}
+        for item in items:
+            self._index_item(item)
+
+        self.orders = {sort: sorted(zip(keys, range(len(keys)))) for sort, keys in self.keys.items()}
+
+    def _sort_keys(self, pos):
+        item = self.items[pos]
+        name, category = self.texts[pos].split('\n', 1)
+        return {
+            'popularity': (-(item.get('Purchase_Count') or 0), name),
+            'name': (name,),
+            # Category breaks aisle ties so each category stays one contiguous group
+            'aisle': (item.get('Aisle_Order', 999), category, name),
+        }
+
+    def _index_item(self, item, shared=False):
+        # With shared set, posting sets and category lists are also used by a published index
+        # and are replaced rather than changed in place
+        pos = len(self.items)
+        self.items.append(item)
+
+        name = normalize(item.get('Item', ''))
+        # Search matches the item name or its category, like the old client-side filter
+        text = f"{name}\n{normalize(item.get('Category', ''))}"
+        self.texts.append(text)
+        category = item.get('Category', '')
+        if shared:
+            for gram in _grams(text):
+                self.postings[gram] = self.postings.get(gram, set()) | {pos}
+            self.by_category[category] = self.by_category.get(category, []) + [pos]
+        else:
+            for gram in _grams(text):
+                self.postings.setdefault(gram, set()).add(pos)
+            self.by_category.setdefault(category, []).append(pos)
+        if item.get('Item_ID'):
+            self.by_id.setdefault(item['Item_ID'], pos)
+        self.by_name.setdefault(name, pos)
+
+        for sort, key in self._sort_keys(pos).items():
+            self.keys[sort].append(key)
+        return pos
+
+    def _copy(self):
+        """Copy whose top-level containers can be patched while this index is being searched"""
+        other = CatalogIndex([])
+        other.items = list(self.items)
+        other.texts = list(self.texts)
+        other.postings = dict(self.postings)
+        other.by_category = dict(self.by_category)
+        other.by_id = dict(self.by_id)
+        other.by_name = dict(self.by_name)
+        other.keys = {sort: list(keys) for sort, keys in self.keys.items()}
+        other.orders = {sort: list(order) for sort, order in self.orders.items()}
+        return other
+
+    def with_items(self, items):
+        """Copy with new items inserted into every order without re-sorting"""
+        index = self._copy()
+        for item in items:
+            if item.get('Item_ID') in index.by_id:
+                continue
+            pos = index._index_item(item, shared=True)
+            for sort, order in index.orders.items():
+                bisect.insort(order, (index.keys[sort][pos], pos))
+        return index
+
+    def with_purchase_counts(self, new_counts):
+        """Copy with items whose Purchase_Count changed moved to their new place in the popularity order"""
+        index = self._copy()
+        order = index.orders['popularity']
+        for item_id, count in new_counts.items():
+            pos = index.by_id.get(item_id)
+            if pos is None:
+                continue
+
+            old_key = index.keys['popularity'][pos]
+            del order[bisect.bisect_left(order, (old_key, pos))]
+
+            index.items[pos] = dict(index.items[pos], Purchase_Count=count)
+            new_key = (-(count or 0), old_key[1])
+            index.keys['popularity'][pos] = new_key
+            bisect.insort(order, (new_key, pos))
+        return index
+
+    def _candidates(self, query):
+        """Positions whose name or category contains the normalized query"""
+        if len(query) <= NGRAM:
+            return set(self.postings.get(query, ()))
+
+        grams = [query[i:i + NGRAM] for i in range(len(query) - NGRAM + 1)]
+        postings = sorted((self.postings.get(gram, set()) for gram in grams), key=len)
+        candidates = set.intersection(*postings)
+        return {pos for pos in candidates if query in self.texts[pos]}
+
+    def search(self, query='', category='', sort='popularity', limit=None, offset=0):
+        """Return (items, total) for one page of matches in the requested order"""
+        sort = sort if sort in self.orders else 'popularity'
+        order = self.orders[sort]
+        query = normalize(query)
+
+        matches = None
+        if query:
+            matches = self._candidates(query)
+        if category:
+            in_category = self.by_category.get(category, [])
+            matches = set(in_category) if matches is None else matches.intersection(in_category)
+
+        if matches is None:
+            ordered = [pos for _, pos in order]
+        elif len(matches) * 4 < len(order):
+            # Few matches - sorting them by their stored keys beats walking the full order
+            keys = self.keys[sort]
+            ordered = sorted(matches, key=lambda pos: (keys[pos], pos))
+        else:
+            ordered = [pos for _, pos in order if pos in matches]
+
+        page = ordered[offset:offset + limit] if limit is not None else ordered[offset:]
+        return [self.items[pos] for pos in page], len(ordered)
+
+    def sort_selection(self, items, sort='aisle'):
+        """Sort a list of selected items (e.g. from a request) by a catalog order"""
+        keys = self.keys[sort]
+        fallback = len(self.items)
+
+        def _key(item):
+            pos = self.by_id.get(item.get('Item_ID'))
+            if pos is not None:
+                return keys[pos], pos
+            # Unknown to the catalog - rank it by its own fields after the known ones
+            return (to_int(item.get('Aisle_Order', 999), 999), normalize(item.get('Category', '')),
+                    normalize(item.get('Item', ''))), fallback
+
+        return sorted(items, key=_key)
+
+    def lookup(self, item_ids=(), names=()):
+        """Items by exact ID or by normalized name, for resolving saved lists"""
+        found = {}
+        for item_id in item_ids:
+            pos = self.by_id.get(item_id)
+            if pos is not None:
+                found[pos] = self.items[pos]
+        for name in names:
+            pos = self.by_name.get(normalize(name))
+            if pos is not None:
+                found[pos] = self.items[pos]
+        return list(found.values())
+
+def get_index(items, version):
+    """Index for a catalog version, rebuilt only when the version changes"""
+    with _lock:
+        if _current['index'] is None or version is None or _current['version'] != version:
+            _current['index'] = CatalogIndex(items)
+            _current['version'] = version
+        return _current['index']
+
+def current_index():
+    """Most recently built index, or an empty one before the catalog has loaded"""
+    with _lock:
+        return _current['index'] or CatalogIndex([])
+
+def _apply(patch, old_version, new_version):
+    """Swap in a patched copy of the index if it is still at old_version"""
+    with _lock:
+        index = _current['index']
+        if index is not None and old_version is not None and _current['version'] == old_version:
+            _current['index'] = patch(index)
+            _current['version'] = new_version
+
+def apply_counts(new_counts, old_version, new_version):
+    """Patch the index for a count change written through the cache (old -> new version)"""
+    _apply(lambda index: index.with_purchase_counts(new_counts), old_version, new_version)
+
+def apply_new_items(items, old_version, new_version):
+    """Patch the index for items added through the cache (old -> new version)"""
+    _apply(lambda index: index.with_items(items), old_version, new_version)
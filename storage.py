@@ -0,0 +1,416 @@
+"""Storage backends for items, categories and shopping history.
+
+Both backends return the same plain records, so app.py does not need to
+know where the data lives:
+
+- SheetsStorage reads and writes the Google Sheets workbook, as the app
+  always has.
+- SqliteStorage keeps the same data in the local database, indexed on
+  Item_ID, Category and Timestamp, so reads need no network at all. With
+  track_changes on, every write also lands in a change log in the same
+  transaction, which sync.py pushes to Sheets in the background.
+
+Items and categories are dicts keyed by the sheet headers (Item, Category,
+Item_ID, Purchase_Count, Unit_Type / Category, Aisle_Order). History rows
+are history.ShoppingList objects. Methods raise on failure; callers decide
+how to report it.
+"""
+import json
+import time
+
+import history
+import local_db
+import search
+
+ITEM_HEADERS = ['Item', 'Category', 'Item_ID', 'Purchase_Count', 'Unit_Type']
+CATEGORY_HEADERS = ['Category', 'Aisle_Order']
+HISTORY_HEADERS = ['Timestamp', 'Date', 'Total_Items', 'Unique_Items', 'Items_JSON', 'Items_Display']
+
+# Default Items sheet layout: Item | Category | Item_ID | Purchase_Count | Unit_Type
+ITEM_ID_COLUMN = 'C'
+PURCHASE_COUNT_COLUMN = 'D'
+
+def _count(value):
+    try:
+        return int(value) if value else 0
+    except (TypeError, ValueError):
+        return 0
+
+def _records(values):
+    """Rows under a header row as dicts, with numbers converted like get_all_records"""
+    if not values:
+        return []
+    # gspread is imported where it is used, so the sqlite backend never loads it
+    from gspread.utils import numericise_all
+
+    headers = values[0]
+    records = []
+    for row in values[1:]:
+        row = list(row) + [''] * (len(headers) - len(row))
+        records.append(dict(zip(headers, numericise_all(row[:len(headers)], default_blank=''))))
+    return records
+
+class SheetsStorage:
+    """Items, Categories and Shopping_History worksheets of the workbook"""
+    name = 'sheets'
+
+    def __init__(self, workbook, worksheet, headers):
+        # Connection helpers from app.py, which owns the shared gspread client
+        self._workbook = workbook
+        self._worksheet = worksheet
+        self._headers = headers
+
+    def _sheet(self, title):
+        sheet = self._worksheet(title)
+        if not sheet:
+            raise ConnectionError('Google Sheets is not available')
+        return sheet
+
+    def load_items(self):
+        items = self._sheet('Items').get_all_records()
+        return [item for item in items if str(item.get('Item', '')).strip()]
+
+    def load_categories(self):
+        return self._sheet('Categories').get_all_records()
+
+    def load_bootstrap(self, history_count):
+        """(items, categories, recent history) from one values_batch_get across the three sheets"""
+        workbook = self._workbook()
+        if not workbook:
+            raise ConnectionError('Google Sheets is not available')
+
+        # The history tail is only known once the row index exists; until then it is read on its own
+        tail = history.tail_range(history_count)
+        ranges = ["'Items'!A:Z", "'Categories'!A:Z"]
+        if tail:
+            ranges.append(f"'Shopping_History'!{tail}")
+        value_ranges = workbook.values_batch_get(ranges)['valueRanges']
+        values = [value_range.get('values', []) for value_range in value_ranges]
+
+        items = [item for item in _records(values[0]) if str(item.get('Item', '')).strip()]
+        categories = _records(values[1])
+        lists = history.lists_from_tail(tail, values[2], history_count) if tail else None
+        if lists is None:
+            lists = self.recent_history(history_count)
+        return items, categories, lists
+
+    def append_items(self, items):
+        """Append items in one request, using only the columns the sheet has"""
+        sheet = self._sheet('Items')
+        headers = self._headers('Items')
+
+        # Older sheets lack some of the trailing columns
+        width = 2
+        for column, header in enumerate(ITEM_HEADERS[2:], start=3):
+            if header not in headers:
+                break
+            width = column
+
+        rows = [[item.get(header, '') for header in ITEM_HEADERS[:width]] for item in items]
+        sheet.append_rows(rows)
+
+    def _read_id_and_count_columns(self, sheet):
+        """Read Item_ID and Purchase_Count columns in one range fetch"""
+        id_letter = ITEM_ID_COLUMN
+        count_letter = PURCHASE_COUNT_COLUMN
+        id_values, count_values = sheet.batch_get([f'{id_letter}:{id_letter}', f'{count_letter}:{count_letter}'])
+
+        header_ok = (id_values and id_values[0] and id_values[0][0] == 'Item_ID' and
+                     count_values and count_values[0] and count_values[0][0] == 'Purchase_Count')
+        if not header_ok:
+            # Sheet layout differs from the default - locate the columns by header
+            headers = self._headers('Items')
+            if 'Item_ID' not in headers or 'Purchase_Count' not in headers:
+                return None
+
+            from gspread.utils import rowcol_to_a1
+            id_letter = rowcol_to_a1(1, headers.index('Item_ID') + 1).rstrip('1')
+            count_letter = rowcol_to_a1(1, headers.index('Purchase_Count') + 1).rstrip('1')
+            id_values, count_values = sheet.batch_get([f'{id_letter}:{id_letter}', f'{count_letter}:{count_letter}'])
+
+        ids = [row[0] if row else '' for row in id_values]
+        counts = [row[0] if row else '' for row in count_values]
+        return ids, counts, count_letter
+
+    def add_purchase_counts(self, item_counts):
+        """Add quantities to purchase counts with one read and one batch write; returns the new counts"""
+        sheet = self._sheet('Items')
+        columns = self._read_id_and_count_columns(sheet)
+        if columns is None:
+            raise ValueError('Items sheet has no Item_ID / Purchase_Count columns')
+
+        ids, counts, count_letter = columns
+
+        # First occurrence wins, like the old list.index() lookup
+        row_by_id = {}
+        for row_idx, item_id in enumerate(ids, start=1):
+            if row_idx > 1 and item_id:
+                row_by_id.setdefault(item_id, row_idx)
+
+        updates = []
+        new_counts = {}
+        for item_id, quantity in item_counts.items():
+            row_idx = row_by_id.get(item_id)
+            if row_idx is None:
+                continue
+
+            current_count = _count(counts[row_idx - 1] if row_idx <= len(counts) else '')
+            new_counts[item_id] = current_count + quantity
+            updates.append({'range': f'{count_letter}{row_idx}', 'values': [[new_counts[item_id]]]})
+
+        if updates:
+            sheet.batch_update(updates)
+        return new_counts
+
+    def ensure_history_sheet(self):
+        """Create Shopping_History with its header row if it does not exist"""
+        from gspread.exceptions import WorksheetNotFound
+        try:
+            return self._sheet('Shopping_History')
+        except WorksheetNotFound:
+            self._workbook().add_worksheet(title='Shopping_History', rows=100, cols=6)
+            # Through the cached handle, so the header write is timed and rate limited too
+            sheet = self._sheet('Shopping_History')
+            sheet.append_row(HISTORY_HEADERS)
+            return sheet
+
+    def _history_sheet(self):
+        """Shopping_History, or None before the first list is saved (append_history creates it)"""
+        from gspread.exceptions import WorksheetNotFound
+        try:
+            return self._sheet('Shopping_History')
+        except WorksheetNotFound:
+            return None
+
+    def recent_history(self, count):
+        sheet = self._history_sheet()
+        if sheet is None:
+            return []
+        # Only the last N rows are downloaded, newest first
+        return history.recent_lists(sheet, count)
+
+    def revision(self):
+        """Last modified time of the workbook - one small Drive metadata request"""
+        workbook = self._workbook()
+        if not workbook:
+            raise ConnectionError('Google Sheets is not available')
+        return workbook.get_lastUpdateTime()
+
+    def load_history(self):
+        """Every saved list, oldest first"""
+        sheet = self._history_sheet()
+        if sheet is None:
+            return []
+        values = sheet.get_all_values()
+        return [history.ShoppingList.from_values(row, row_values)
+                for row, row_values in enumerate(values, start=1) if row > 1 and row_values and row_values[0]]
+
+    def history_before(self, cutoff):
+        """Lists sent before `cutoff` (an ISO timestamp) from the top of the sheet, oldest first"""
+        sheet = self._history_sheet()
+        if sheet is None:
+            return []
+        timestamps = sheet.col_values(1)[1:]
+        count = 0
+        while count < len(timestamps) and timestamps[count] and timestamps[count] < cutoff:
+            count += 1
+        if not count:
+            return []
+        values = sheet.get(f'{history.COLUMNS[0]}2:{history.COLUMNS[1]}{count + 1}')
+        return [history.ShoppingList.from_values(row, row_values)
+                for row, row_values in enumerate(values, start=2) if row_values and row_values[0]]
+
+    def delete_history(self, timestamps):
+        """Delete the run of oldest rows whose timestamps are given; returns how many were deleted"""
+        sheet = self._history_sheet()
+        if sheet is None:
+            return 0
+        current = sheet.col_values(1)[1:]
+        count = 0
+        # Rows are appended in time order, so archived ones are always the first few
+        while count < len(current) and current[count] in timestamps:
+            count += 1
+        if count:
+            sheet.delete_rows(2, count + 1)
+            history.forget_rows(count)
+        return count
+
+    def append_history(self, values):
+        sheet = self.ensure_history_sheet()
+        response = sheet.append_row(values)
+
+        row = history.appended_row_number(response)
+        history.record_row(row, values[0])
+        return history.parse_row(row, values)
+
+    def replace_history(self, row, values):
+        sheet = self._sheet('Shopping_History')
+        sheet.update(f'A{row}:F{row}', [values])
+        history.record_row(row, values[0])
+        return history.parse_row(row, values)
+
+class SqliteStorage:
+    """The same data in local tables; writes are single transactions"""
+    name = 'sqlite'
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS items ('
+        'id INTEGER PRIMARY KEY, item_id TEXT NOT NULL DEFAULT \'\', name TEXT NOT NULL, '
+        'category TEXT NOT NULL DEFAULT \'\', purchase_count INTEGER NOT NULL DEFAULT 0, '
+        'unit_type TEXT NOT NULL DEFAULT \'quantity\')',
+        'CREATE INDEX IF NOT EXISTS idx_items_item_id ON items (item_id)',
+        'CREATE INDEX IF NOT EXISTS idx_items_category ON items (category)',
+        'CREATE TABLE IF NOT EXISTS categories ('
+        'id INTEGER PRIMARY KEY, category TEXT NOT NULL UNIQUE, aisle_order INTEGER NOT NULL DEFAULT 999)',
+        'CREATE TABLE IF NOT EXISTS shopping_history ('
+        'id INTEGER PRIMARY KEY, timestamp TEXT NOT NULL, date TEXT, total_items TEXT, unique_items TEXT, '
+        'items_json TEXT, items_display TEXT)',
+        'CREATE INDEX IF NOT EXISTS idx_shopping_history_timestamp ON shopping_history (timestamp)',
+        # Local writes not yet pushed to Sheets, oldest first
+        'CREATE TABLE IF NOT EXISTS sync_changes ('
+        'id INTEGER PRIMARY KEY, kind TEXT NOT NULL, key TEXT NOT NULL, payload TEXT NOT NULL, created_at REAL NOT NULL)',
+    ]
+
+    def __init__(self, path, track_changes=False):
+        self.path = path
+        self.track_changes = track_changes
+
+    def _conn(self):
+        return local_db.connect(self.path, self.SCHEMA)
+
+    def connection(self):
+        """This thread's connection, for sync.py to merge remote changes"""
+        return self._conn()
+
+    def _record_change(self, conn, kind, key, payload):
+        if self.track_changes:
+            conn.execute('INSERT INTO sync_changes (kind, key, payload, created_at) VALUES (?, ?, ?, ?)',
+                         (kind, key, json.dumps(payload), time.time()))
+
+    def is_empty(self):
+        conn = self._conn()
+        return not any(conn.execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone()
+                       for table in ('items', 'categories', 'shopping_history'))
+
+    def load_items(self):
+        rows = self._conn().execute(
+            'SELECT name, category, item_id, purchase_count, unit_type FROM items ORDER BY id').fetchall()
+        return [dict(zip(ITEM_HEADERS, row)) for row in rows]
+
+    def load_categories(self):
+        rows = self._conn().execute('SELECT category, aisle_order FROM categories ORDER BY id').fetchall()
+        return [dict(zip(CATEGORY_HEADERS, row)) for row in rows]
+
+    def load_bootstrap(self, history_count):
+        """(items, categories, recent history) - all local, so simply the three reads"""
+        return self.load_items(), self.load_categories(), self.recent_history(history_count)
+
+    def append_items(self, items):
+        conn = self._conn()
+        with local_db.transaction(conn):
+            self._insert_items(conn, items)
+            for item in items:
+                self._record_change(conn, 'item', item.get('Item_ID') or '', item)
+
+    def _insert_items(self, conn, items):
+        conn.executemany(
+            'INSERT INTO items (name, category, item_id, purchase_count, unit_type) VALUES (?, ?, ?, ?, ?)',
+            [(item.get('Item', ''), item.get('Category', ''), item.get('Item_ID') or '',
+              _count(item.get('Purchase_Count')), item.get('Unit_Type') or 'quantity') for item in items])
+
+    def add_purchase_counts(self, item_counts):
+        """Increment counts in place - no read-modify-write, so concurrent sends never lose one"""
+        conn = self._conn()
+        new_counts = {}
+        with local_db.transaction(conn):
+            for item_id, quantity in item_counts.items():
+                # First occurrence wins, as in the sheet
+                row = conn.execute('SELECT MIN(id) FROM items WHERE item_id = ?', (item_id,)).fetchone()
+                if not row or row[0] is None:
+                    continue
+                conn.execute('UPDATE items SET purchase_count = purchase_count + ? WHERE id = ?', (quantity, row[0]))
+                self._record_change(conn, 'count', item_id, quantity)
+                new_counts[item_id] = conn.execute(
+                    'SELECT purchase_count FROM items WHERE id = ?', (row[0],)).fetchone()[0]
+        return new_counts
+
+    def _history_list(self, row):
+        row_id, values = row[0], [str(value) if value is not None else '' for value in row[1:]]
+        return history.ShoppingList.from_values(row_id, values)
+
+    def recent_history(self, count):
+        rows = self._conn().execute(
+            'SELECT id, timestamp, date, total_items, unique_items, items_json, items_display '
+            'FROM shopping_history ORDER BY timestamp DESC, id DESC LIMIT ?', (count,)).fetchall()
+        return [self._history_list(row) for row in rows]
+
+    def load_history(self):
+        rows = self._conn().execute(
+            'SELECT id, timestamp, date, total_items, unique_items, items_json, items_display '
+            'FROM shopping_history ORDER BY timestamp, id').fetchall()
+        return [self._history_list(row) for row in rows]
+
+    def history_before(self, cutoff):
+        rows = self._conn().execute(
+            'SELECT id, timestamp, date, total_items, unique_items, items_json, items_display '
+            'FROM shopping_history WHERE timestamp < ? ORDER BY timestamp, id', (cutoff,)).fetchall()
+        return [self._history_list(row) for row in rows]
+
+    def delete_history(self, timestamps):
+        """Delete archived lists; not recorded as changes, the workbook mirror is trimmed separately"""
+        timestamps = list(timestamps)
+        conn = self._conn()
+        deleted = 0
+        with local_db.transaction(conn):
+            for start in range(0, len(timestamps), 500):
+                chunk = timestamps[start:start + 500]
+                deleted += conn.execute(f"DELETE FROM shopping_history WHERE timestamp IN ({', '.join('?' * len(chunk))})",
+                                        chunk).rowcount
+        return deleted
+
+    def append_history(self, values):
+        values = [str(value) for value in values[:6]]
+        conn = self._conn()
+        with local_db.transaction(conn):
+            cursor = conn.execute(
+                'INSERT INTO shopping_history (timestamp, date, total_items, unique_items, items_json, items_display) '
+                'VALUES (?, ?, ?, ?, ?, ?)', values)
+            self._record_change(conn, 'history', str(cursor.lastrowid), {'values': values, 'replaces': None})
+        return self._history_list([cursor.lastrowid] + values)
+
+    def replace_history(self, row, values):
+        values = [str(value) for value in values[:6]]
+        conn = self._conn()
+        with local_db.transaction(conn):
+            previous = conn.execute('SELECT timestamp FROM shopping_history WHERE id = ?', (row,)).fetchone()
+            conn.execute(
+                'UPDATE shopping_history SET timestamp = ?, date = ?, total_items = ?, unique_items = ?, '
+                'items_json = ?, items_display = ? WHERE id = ?', values + [row])
+            # Rows are matched up with the sheet by timestamp, so remember which one this was
+            self._record_change(conn, 'history', str(row),
+                                {'values': values, 'replaces': previous[0] if previous else None})
+        return self._history_list([row] + values)
+
+    def import_from(self, source):
+        """Copy everything from another backend into an empty store; False if it already had data"""
+        items = source.load_items()
+        categories = source.load_categories()
+        lists = source.load_history()
+
+        conn = self._conn()
+        with local_db.transaction(conn):
+            # Another worker may have seeded the store while we were reading
+            if not self.is_empty():
+                return False
+
+            self._insert_items(conn, items)
+            conn.executemany(
+                'INSERT OR IGNORE INTO categories (category, aisle_order) VALUES (?, ?)',
+                [(cat.get('Category', ''), search.to_int(cat.get('Aisle_Order', 999), 999))
+                 for cat in categories if cat.get('Category')])
+            conn.executemany(
+                'INSERT INTO shopping_history (timestamp, date, total_items, unique_items, items_json, items_display) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(l.timestamp, l.date, str(l.total_items), str(l.unique_items),
+                  json.dumps([item.to_dict() for item in l.items]), l.display) for l in lists])
+        return True
@@ -0,0 +1,73 @@
+""""Usual items" suggestions from the rolled-up purchase history.
+
+Three rankings, each a single indexed query over the tables archive.py keeps
+up to date with every saved list, so they cost the same after years of
+history as after a week:
+
+- usual: recency-weighted trip count. Older trips fade with a half-life of
+  archive.RECENCY_HALF_LIFE_DAYS, so a staple bought weekly ranks above
+  something bought often two years ago.
+- due: items whose usual interval between purchases has passed since the
+  last one, most overdue first (a score of 1.0 means due today). Items more
+  than DUE_GIVE_UP intervals overdue are taken to be no longer bought.
+- together: items most often bought on the same trip as the ones already
+  picked, as the share of the picked item's trips that also had them.
+"""
+from datetime import datetime
+
+import archive
+
+DUE_GIVE_UP = 3  # Intervals overdue after which an item no longer counts as due
+
+def _score(value):
+    # Significant digits, as decayed scores of long-unbought items get very small
+    return float(f'{value:.4g}')
+
+def usual(limit=20, exclude=()):
+    """Items by recency-weighted trip count; score is the number of trips as if all were today"""
+    now_weight = archive.recency_weight(datetime.now().isoformat())
+    rows = archive.connect().execute(
+        "SELECT s.item_id, r.weight FROM item_recency r JOIN item_stats s ON s.key = r.key "
+        "WHERE s.item_id != '' ORDER BY r.weight DESC LIMIT ?", (limit + len(exclude),)).fetchall()
+    return [{'item_id': item_id, 'score': _score(weight / now_weight)}
+            for item_id, weight in rows if item_id not in exclude][:limit]
+
+def due(limit=20, exclude=(), now=None):
+    """Items past their usual purchase interval, with the predicted due date"""
+    now = (now or datetime.now()).isoformat()
+    rows = archive.connect().execute(
+        "SELECT item_id, last_at, interval_days, "
+        "(julianday(?) - julianday(last_at)) / interval_days AS overdue FROM ("
+        "  SELECT item_id, last_at, (julianday(last_at) - julianday(first_at)) / (trips - 1) AS interval_days "
+        "  FROM item_stats WHERE trips > 1 AND item_id != '') "
+        "WHERE interval_days > 0 AND overdue BETWEEN 1 AND ? ORDER BY overdue DESC LIMIT ?",
+        (now, DUE_GIVE_UP, limit + len(exclude))).fetchall()
+
+    result = []
+    for item_id, last_at, interval_days, overdue in rows:
+        if item_id in exclude:
+            continue
+        due_at = datetime.fromisoformat(last_at).timestamp() + interval_days * 86400
+        result.append({
+            'item_id': item_id,
+            'score': _score(overdue),
+            'last_purchase': last_at,
+            'interval_days': round(interval_days, 1),
+            'due_date': datetime.fromtimestamp(due_at).date().isoformat(),
+        })
+    return result[:limit]
+
+def together(picked, limit=20):
+    """Items bought on the same trips as the picked ones, by summed conditional frequency"""
+    picked = [item_id for item_id in picked if item_id]
+    if not picked:
+        return []
+    placeholders = ', '.join('?' * len(picked))
+    rows = archive.connect().execute(
+        "SELECT o.item_id, SUM(p.trips * 1.0 / s.trips) AS score FROM item_pairs p "
+        "JOIN item_stats s ON s.key = p.key "
+        "JOIN item_stats o ON o.key = p.other "
+        f"WHERE p.key IN ({placeholders}) AND p.other NOT IN ({placeholders}) AND o.item_id != '' "
+        "GROUP BY o.item_id ORDER BY score DESC LIMIT ?",
+        picked + picked + [limit]).fetchall()
+    return [{'item_id': item_id, 'score': _score(score)} for item_id, score in rows]
@@ -0,0 +1,352 @@
+"""Background sync between the local SQLite store and Google Sheets.
+
+With STORAGE_BACKEND=sqlite, requests only touch the local store and the
+workbook becomes a mirror kept up to date from here:
+
+- Push: local writes queued in sync_changes are sent in coalesced batches -
+  new items in one append, count increments summed per item into one batch
+  update, and only the latest version of each history row.
+- Pull: the workbook's modified time is polled (one small Drive request);
+  only when it moves are Items, Categories and the history tail read and
+  merged row by row. Purchase counts merge additively: the local count is
+  the sheet's count plus any increments not pushed yet, so hand edits and
+  local sends both survive.
+
+One worker at a time holds the sync lease, renewed while a round runs, and
+each write to the sheet first checks it is still held: count increments are
+not idempotent, so two workers must never push the same changes. Every
+worker watches the local revision number and drops its cached copies when a
+pull changed something.
+"""
+import json
+import os
+import socket
+import threading
+import time
+
+import local_db
+import search
+
+PUSH_INTERVAL = 2  # Seconds between pushes; writes in between go out as one batch
+POLL_INTERVAL = 30  # Seconds between remote modified-time checks
+LEASE_SECONDS = 30
+HISTORY_PULL_ROWS = 20  # Remote history rows merged on each pull
+MAX_BATCH = 500  # Changes pushed per round
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS sync_state (name TEXT PRIMARY KEY, value TEXT)',
+]
+
+_config = {'local': None, 'remote': None, 'on_error': None, 'on_change': None,
+           'push_interval': PUSH_INTERVAL, 'poll_interval': POLL_INTERVAL}
+_worker = {'pid': None, 'thread': None, 'revision': None, 'in_round': False}
+_lock = threading.Lock()
+
+def configure(local, remote, on_error=None, on_change=None, push_interval=PUSH_INTERVAL,
+              poll_interval=POLL_INTERVAL):
+    """Sync `local` (SqliteStorage with track_changes) with `remote` (SheetsStorage)"""
+    _config.update(local=local, remote=remote, on_error=on_error, on_change=on_change,
+                   push_interval=push_interval, poll_interval=poll_interval)
+
+def _conn():
+    return local_db.connect(_config['local'].path, SCHEMA)
+
+def _get_state(conn, name, default=None):
+    row = conn.execute('SELECT value FROM sync_state WHERE name = ?', (name,)).fetchone()
+    return json.loads(row[0]) if row else default
+
+def _set_state(conn, **values):
+    conn.executemany('INSERT OR REPLACE INTO sync_state (name, value) VALUES (?, ?)',
+                     [(name, json.dumps(value)) for name, value in values.items()])
+
+def _bump_state(conn, name, amount=1):
+    _set_state(conn, **{name: _get_state(conn, name, 0) + amount})
+
+def _acquire_lease():
+    """Hold the sync lease for this process; only the holder talks to Sheets"""
+    holder = f'{socket.gethostname()}:{os.getpid()}'
+    now = time.time()
+    conn = _conn()
+    with local_db.transaction(conn):
+        lease = _get_state(conn, 'lease')
+        if lease and lease['holder'] != holder and lease['until'] > now:
+            return False
+        _set_state(conn, lease={'holder': holder, 'until': now + LEASE_SECONDS})
+    return True
+
+def _check_lease():
+    """Renew the lease before a write to the sheet; raises if another worker has taken it"""
+    if not _acquire_lease():
+        raise RuntimeError('Sync lease taken over by another worker, round abandoned')
+
+def _keep_lease_loop():
+    while True:
+        time.sleep(LEASE_SECONDS / 3)
+        if _worker['in_round']:
+            try:
+                _acquire_lease()
+            except Exception as e:
+                print(f"Error renewing sync lease: {e}")
+
+def _pending_changes(conn, limit=None):
+    query = 'SELECT id, kind, key, payload, created_at FROM sync_changes ORDER BY id'
+    rows = conn.execute(query + (' LIMIT ?' if limit else ''), (limit,) if limit else ()).fetchall()
+    return [(row_id, kind, key, json.loads(payload), created_at) for row_id, kind, key, payload, created_at in rows]
+
+def _coalesce(changes):
+    """Collapse a run of changes into (new items, count deltas, history rows)"""
+    items = {}
+    deltas = {}
+    rows = {}
+    for _, kind, key, payload, _ in changes:
+        if kind == 'item':
+            items.setdefault(key or payload.get('Item', ''), payload)
+        elif kind == 'count':
+            deltas[key] = deltas.get(key, 0) + payload
+        elif kind == 'history':
+            previous = rows.get(key)
+            # Keep the first row this replaced - that is what the sheet still has
+            replaces = previous['replaces'] if previous else payload['replaces']
+            appended = previous['appended'] if previous else payload['replaces'] is None
+            rows[key] = {'values': payload['values'], 'replaces': replaces, 'appended': appended}
+    return list(items.values()), deltas, list(rows.values())
+
+def _done(conn, changes, kind):
+    """Drop pushed changes of one kind, so a later step failing cannot make a retry replay them"""
+    ids = [row_id for row_id, change_kind, _, _, _ in changes if change_kind == kind]
+    with local_db.transaction(conn):
+        conn.executemany('DELETE FROM sync_changes WHERE id = ?', [(row_id,) for row_id in ids])
+
+def push():
+    """Send pending local changes to the workbook; returns how many were pushed"""
+    remote = _config['remote']
+    conn = _conn()
+    changes = _pending_changes(conn, MAX_BATCH)
+    if not changes:
+        return 0
+
+    items, deltas, rows = _coalesce(changes)
+
+    if items:
+        # A retried push must not add the same items twice
+        existing = {item.get('Item_ID') for item in remote.load_items() if item.get('Item_ID')}
+        items = [item for item in items if not item.get('Item_ID') or item['Item_ID'] not in existing]
+        if items:
+            _check_lease()
+            remote.append_items(items)
+    _done(conn, changes, 'item')
+
+    if deltas:
+        # Increments are not idempotent - they are forgotten as soon as the sheet has them
+        _check_lease()
+        remote.add_purchase_counts(deltas)
+    _done(conn, changes, 'count')
+
+    if rows:
+        recent = {l.timestamp: l.row for l in remote.recent_history(HISTORY_PULL_ROWS)}
+        for row in rows:
+            if row['values'][0] in recent:
+                continue  # Already pushed by an earlier, interrupted round
+            _check_lease()
+            remote_row = None if row['appended'] else recent.get(row['replaces'])
+            if remote_row:
+                remote.replace_history(remote_row, row['values'])
+            else:
+                remote.append_history(row['values'])
+    _done(conn, changes, 'history')
+
+    with local_db.transaction(conn):
+        _set_state(conn, last_push_at=time.time())
+        _bump_state(conn, 'pushed_changes', len(changes))
+    return len(changes)
+
+def _merge_items(conn, remote_items, pending):
+    """Merge remote item rows into the local table; returns (changed, conflicts)"""
+    _, deltas, _ = _coalesce(pending)
+    pending_items = {key for _, kind, key, _, _ in pending if kind == 'item'}
+
+    local_rows = {}
+    for row_id, item_id, name, category, count, unit_type in conn.execute(
+            'SELECT id, item_id, name, category, purchase_count, unit_type FROM items ORDER BY id'):
+        local_rows.setdefault(item_id or name, (row_id, name, category, count, unit_type))
+
+    changed = 0
+    conflicts = 0
+    seen = set()
+    for item in remote_items:
+        item_id = str(item.get('Item_ID') or '')
+        key = item_id or str(item.get('Item', ''))
+        if key in seen:
+            continue
+        seen.add(key)
+
+        name = str(item.get('Item', ''))
+        category = str(item.get('Category', ''))
+        unit_type = str(item.get('Unit_Type') or 'quantity')
+        try:
+            remote_count = int(item.get('Purchase_Count') or 0)
+        except (TypeError, ValueError):
+            remote_count = 0
+        # Additive merge: the sheet's count plus increments it has not seen yet
+        count = remote_count + deltas.get(item_id, 0)
+
+        local_row = local_rows.get(key)
+        if local_row is None:
+            conn.execute('INSERT INTO items (item_id, name, category, purchase_count, unit_type) VALUES (?, ?, ?, ?, ?)',
+                         (item_id, name, category, count, unit_type))
+            changed += 1
+        elif local_row[1:] != (name, category, count, unit_type):
+            if item_id in deltas and local_row[3] != count:
+                # Counted on both sides since the last pull - both kept, but worth knowing about
+                conflicts += 1
+            conn.execute('UPDATE items SET name = ?, category = ?, purchase_count = ?, unit_type = ? WHERE id = ?',
+                         (name, category, count, unit_type, local_row[0]))
+            changed += 1
+
+    # Rows deleted from the sheet by hand, unless they were added here and not pushed yet
+    for key, local_row in local_rows.items():
+        if key not in seen and key not in pending_items:
+            conn.execute('DELETE FROM items WHERE id = ?', (local_row[0],))
+            changed += 1
+    return changed, conflicts
+
+def _merge_categories(conn, remote_categories):
+    remote_rows = [(str(cat.get('Category', '')), search.to_int(cat.get('Aisle_Order', 999), 999))
+                   for cat in remote_categories if cat.get('Category')]
+    local_rows = conn.execute('SELECT category, aisle_order FROM categories ORDER BY id').fetchall()
+    if [tuple(row) for row in local_rows] == remote_rows:
+        return 0
+
+    # Categories are only ever edited in the sheet, so it simply wins
+    conn.execute('DELETE FROM categories')
+    conn.executemany('INSERT OR IGNORE INTO categories (category, aisle_order) VALUES (?, ?)', remote_rows)
+    return 1
+
+def _merge_history(conn, remote_lists, pending):
+    """Add or update recent remote history rows; returns (changed, conflicts)"""
+    _, _, rows = _coalesce(pending)
+    pending_timestamps = {row['replaces'] for row in rows} | {row['values'][0] for row in rows}
+
+    changed = 0
+    conflicts = 0
+    for remote_list in remote_lists:
+        values = [remote_list.timestamp, remote_list.date, str(remote_list.total_items),
+                  str(remote_list.unique_items), json.dumps([item.to_dict() for item in remote_list.items]),
+                  remote_list.display]
+        local = conn.execute('SELECT id, items_display FROM shopping_history WHERE timestamp = ?',
+                             (remote_list.timestamp,)).fetchone()
+        if remote_list.timestamp in pending_timestamps:
+            if local is not None and local[1] != remote_list.display:
+                # Edited here and in the sheet - the local edit is pushed over it
+                conflicts += 1
+            continue
+
+        if local is None:
+            conn.execute('INSERT INTO shopping_history (timestamp, date, total_items, unique_items, items_json, '
+                         'items_display) VALUES (?, ?, ?, ?, ?, ?)', values)
+            changed += 1
+        elif local[1] != remote_list.display:
+            conn.execute('UPDATE shopping_history SET date = ?, total_items = ?, unique_items = ?, items_json = ?, '
+                         'items_display = ? WHERE id = ?', values[1:] + [local[0]])
+            changed += 1
+    return changed, conflicts
+
+def pull(force=False):
+    """Merge remote changes if the workbook changed since the last pull; returns rows changed"""
+    remote = _config['remote']
+    conn = _conn()
+
+    revision = remote.revision()
+    if not force and revision and revision == _get_state(conn, 'remote_revision'):
+        _set_state(conn, last_poll_at=time.time())
+        return 0
+
+    remote_items = remote.load_items()
+    remote_categories = remote.load_categories()
+    remote_lists = remote.recent_history(HISTORY_PULL_ROWS)
+
+    with local_db.transaction(conn):
+        # Read pending changes inside the transaction so a write cannot slip between
+        pending = _pending_changes(conn)
+        items_changed, item_conflicts = _merge_items(conn, remote_items, pending)
+        categories_changed = _merge_categories(conn, remote_categories)
+        history_changed, history_conflicts = _merge_history(conn, remote_lists, pending)
+
+        changed = items_changed + categories_changed + history_changed
+        now = time.time()
+        _set_state(conn, remote_revision=revision, last_pull_at=now, last_poll_at=now)
+        if item_conflicts or history_conflicts:
+            _bump_state(conn, 'conflicts', item_conflicts + history_conflicts)
+        if changed:
+            _bump_state(conn, 'local_revision')
+    return changed
+
+def _check_local_revision():
+    """Tell this worker to drop cached data when any worker pulled changes"""
+    revision = _get_state(_conn(), 'local_revision', 0)
+    if _worker['revision'] is None:
+        _worker['revision'] = revision
+    elif revision != _worker['revision']:
+        _worker['revision'] = revision
+        if _config['on_change']:
+            _config['on_change']()
+
+def run_once(force_pull=False):
+    """One sync round: push, then pull if it is time (or forced)"""
+    conn = _conn()
+    try:
+        push()
+        last_poll = _get_state(conn, 'last_poll_at', 0)
+        if force_pull or time.time() - last_poll >= _config['poll_interval']:
+            pull(force=force_pull)
+        _set_state(conn, last_error=None)
+    except Exception as e:
+        print(f"Error syncing with Google Sheets: {e}")
+        _set_state(conn, last_error=str(e), last_error_at=time.time())
+        if _config['on_error']:
+            _config['on_error'](e)
+
+def _worker_loop():
+    while True:
+        try:
+            if _acquire_lease():
+                # Reads in a round can wait minutes on the quota; the lease must outlast them
+                _worker['in_round'] = True
+                try:
+                    run_once()
+                finally:
+                    _worker['in_round'] = False
+            _check_local_revision()
+        except Exception as e:
+            print(f"Error in sync worker: {e}")
+        time.sleep(_config['push_interval'])
+
+def start():
+    """Start this process's sync thread once (again after a fork)"""
+    with _lock:
+        if _worker['pid'] == os.getpid() or _config['local'] is None:
+            return
+        _worker['pid'] = os.getpid()
+        _worker['revision'] = None
+        _worker['in_round'] = False
+        _worker['thread'] = threading.Thread(target=_worker_loop, name='sheets-sync', daemon=True)
+        _worker['thread'].start()
+        threading.Thread(target=_keep_lease_loop, name='sheets-sync-lease', daemon=True).start()
+
+def get_status():
+    """Lag, backlog and conflict numbers for monitoring"""
+    conn = _conn()
+    now = time.time()
+    pending, oldest = conn.execute('SELECT COUNT(*), MIN(created_at) FROM sync_changes').fetchone()
+    last_pull_at = _get_state(conn, 'last_pull_at')
+    return {
+        'pending_changes': pending,
+        'push_lag_seconds': round(now - oldest, 3) if oldest else 0,
+        'pull_age_seconds': round(now - last_pull_at, 3) if last_pull_at else None,
+        'last_push_at': _get_state(conn, 'last_push_at'),
+        'last_pull_at': last_pull_at,
+        'pushed_changes': _get_state(conn, 'pushed_changes', 0),
+        'conflicts': _get_state(conn, 'conflicts', 0),
+        'last_error': _get_state(conn, 'last_error'),
+        'lease_holder': (_get_state(conn, 'lease') or {}).get('holder'),
+    }
@@ -0,0 +1,45 @@
+"""Purchase count compaction against the in-process Sheets fakes."""
+import os
+import tempfile
+import unittest
+
+os.environ.update(DATA_DIR=tempfile.mkdtemp(), OUTBOX_WORKERS='0', STARTUP_WARMUP='off',
+                  HISTORY_ARCHIVE_DAYS='0')
+
+import app
+import outbox
+import purchase_log
+from benchmarks import fakes
+
+class CountCompactionTest(unittest.TestCase):
+    def setUp(self):
+        self.workbook = fakes.make_workbook(fakes.Service(), items=10, history_rows=0)
+        fakes.install(app, self.workbook)
+        app.COUNT_COMPACT_DELAY = 0
+        self.item_id = app.get_all_items()[0]['Item_ID']
+
+    def sheet_count(self):
+        items = app.get_storage().load_items()
+        return [item['Purchase_Count'] for item in items if item['Item_ID'] == self.item_id][0]
+
+    def test_compacts_again_after_the_log_has_emptied(self):
+        start = self.sheet_count()
+        for trip in ('trip-1', 'trip-2', 'trip-3'):
+            self.assertTrue(app.update_purchase_counts({self.item_id: 1}, trip=trip))
+            outbox.run_pending()
+            # Every compaction empties the log, so the next one starts from reused row IDs
+            self.assertEqual(purchase_log.pending_totals(), {})
+
+        self.assertEqual(self.sheet_count(), start + 3)
+
+    def test_a_trip_is_counted_once_after_compaction(self):
+        start = self.sheet_count()
+        app.update_purchase_counts({self.item_id: 2}, trip='retried-trip')
+        outbox.run_pending()
+        app.update_purchase_counts({self.item_id: 2}, trip='retried-trip')
+        outbox.run_pending()
+
+        self.assertEqual(self.sheet_count(), start + 2)
+
+if __name__ == '__main__':
+    unittest.main()